@@ -0,0 +1,132 @@
+import asyncio
+import atexit
+import os
+import sqlite3
+import tempfile
+
+from benchmarks.harness import Scenario
+from cogs.music.database import Database, StoredTrack
+from cogs.music.migrations import migrate
+from config import MAX_NUM_PLAYLISTS
+
+SONGS_PER_PLAYLIST = 50
+
+class SeededDatabase:
+    """A migrated SQLite file filled with `playlists` playlists of SONGS_PER_PLAYLIST songs, MAX_NUM_PLAYLISTS per author"""
+
+    def __init__(self, playlists : int):
+        self.playlists : int = playlists
+        self.authors : int = max(1, playlists // MAX_NUM_PLAYLISTS)
+        self.directory = tempfile.TemporaryDirectory(prefix = "musicbot-bench-")
+        self.path : str = os.path.join(self.directory.name, "bench.db")
+        self.__seed()
+
+        self.loop = asyncio.new_event_loop()
+        self.database = Database(path = self.path)
+        self.run(self.database.setup())
+
+    def __seed(self):
+        connection = sqlite3.connect(self.path, isolation_level = None)
+        migrate(connection)
+        connection.execute("BEGIN")
+        connection.executemany("INSERT INTO PLAYLIST (ID, author_id, name) VALUES (?, ?, ?)", [(i + 1, i % self.authors, f"playlist {i}") for i in range(self.playlists)])
+        connection.executemany("INSERT INTO SONG_PLAYLIST (playlist_id, track_id, source, uri, title, author, length) VALUES (?, ?, 'youtube', ?, ?, 'Artist', 200000)", [(i + 1, *get_song(i * SONGS_PER_PLAYLIST + j)) for i in range(self.playlists) for j in range(SONGS_PER_PLAYLIST)])
+        connection.execute("COMMIT")
+        connection.close()
+
+    def run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def close(self):
+        self.database.close()
+        self.loop.close()
+        self.directory.cleanup()
+
+def get_song(index : int) -> tuple[str, str, str]:
+    """(track_id, uri, title) of a seeded song, one in ten added before playlists kept the metadata"""
+    track_id = f"{index:011d}"
+    return track_id, f"https://www.youtube.com/watch?v={track_id}", f"Song {index}" if index % 10 else None
+
+def get_stored_tracks(count : int) -> list[StoredTrack]:
+    return [StoredTrack(track_id = f"bench{i:06d}", encoded = "QAAA" * 50, title = f"Song {i}", author = "Artist", length = 200_000, updated_at = 0, uri = f"https://www.youtube.com/watch?v=bench{i:06d}") for i in range(count)]
+
+def get_resolved_tracks(songs : int, count : int) -> list[StoredTrack]:
+    """Seeded songs missing their metadata, as stored again when their playlist is played"""
+    tracks = []
+    for index in range(0, songs, songs // count):
+        track_id, uri, _ = get_song(index)
+        tracks.append(StoredTrack(track_id = track_id, encoded = "QAAA" * 50, title = f"Song {index}", author = "Artist", length = 200_000, updated_at = 0, uri = uri))
+    return tracks
+
+def read_playlists(seeded : SeededDatabase, count : int):
+    async def read():
+        for i in range(count):
+            await seeded.database.get_playlists(author_id = i % seeded.authors)
+    seeded.run(read())
+
+def read_songs(seeded : SeededDatabase, count : int):
+    async def read():
+        for i in range(count):
+            playlist = i * 7919 % seeded.playlists
+            await seeded.database.get_songs_from_playlist(author_id = playlist % seeded.authors, playlist_name = f"playlist {playlist}")
+    seeded.run(read())
+
+def read_previews(seeded : SeededDatabase, count : int):
+    async def read():
+        for i in range(count):
+            playlist = i * 7919 % seeded.playlists
+            await seeded.database.get_playlist_preview(author_id = playlist % seeded.authors, playlist_name = f"playlist {playlist}")
+    seeded.run(read())
+
+def add_and_delete_songs(seeded : SeededDatabase, count : int):
+    # Every added song is deleted again so all repeats run on the same data
+    track = get_stored_tracks(1)[0]
+    async def write():
+        for i in range(count):
+            await seeded.database.add_song_to_playlist(track = track, playlist_name = f"playlist {i}", autor_id = i % seeded.authors)
+            await seeded.database.delete_song_from_playlist(track_id = track.track_id, playlist_name = f"playlist {i}", autor_id = i % seeded.authors)
+    seeded.run(write())
+
+def store_tracks(seeded : SeededDatabase, tracks : list[StoredTrack]):
+    # Only the first repeat has entries left to fill, the later ones measure finding none
+    seeded.run(seeded.database.store_tracks(tracks = tracks))
+
+def create_and_delete_playlists(seeded : SeededDatabase, count : int):
+    # Deleted right away, authors are limited to MAX_NUM_PLAYLISTS
+    async def write():
+        for i in range(count):
+            await seeded.database.create_playlist(playlist_name = f"bench {i}", author_id = 10_000_000)
+            await seeded.database.delete_playlist(playlist_name = f"bench {i}", author_id = 10_000_000)
+    seeded.run(write())
+
+def save_and_delete_playlist(seeded : SeededDatabase, tracks : list[StoredTrack]):
+    async def write():
+        await seeded.database.save_playlist(tracks = tracks, playlist_name = "bench import", author_id = 10_000_001)
+        await seeded.database.delete_playlist(playlist_name = "bench import", author_id = 10_000_001)
+    seeded.run(write())
+
+def get_scenarios(quick : bool) -> list[Scenario]:
+    playlists = 1_000 if quick else 20_000
+    calls = 50 if quick else 200
+    seeded = None
+
+    def setup() -> SeededDatabase:
+        # Seeding is slow, the same file is shared by every database scenario
+        nonlocal seeded
+        if seeded is None:
+            seeded = SeededDatabase(playlists = playlists)
+            atexit.register(seeded.close)
+        return seeded
+
+    tracks = get_stored_tracks(500)
+    resolved = get_resolved_tracks(songs = playlists * SONGS_PER_PLAYLIST, count = 200)
+    params = {"playlists" : playlists, "songs" : playlists * SONGS_PER_PLAYLIST}
+    return [
+        Scenario(name = "database.get_playlists", params = params, setup = setup, run = lambda seeded: read_playlists(seeded, calls), operations = calls),
+        Scenario(name = "database.get_songs_from_playlist", params = params, setup = setup, run = lambda seeded: read_songs(seeded, calls), operations = calls),
+        Scenario(name = "database.get_playlist_preview", params = params, setup = setup, run = lambda seeded: read_previews(seeded, calls), operations = calls),
+        Scenario(name = "database.add_delete_song", params = params, setup = setup, run = lambda seeded: add_and_delete_songs(seeded, calls), operations = calls * 2),
+        Scenario(name = "database.store_tracks", params = {**params, "tracks" : len(resolved)}, setup = setup, run = lambda seeded: store_tracks(seeded, resolved)),
+        Scenario(name = "database.create_delete_playlist", params = params, setup = setup, run = lambda seeded: create_and_delete_playlists(seeded, calls), operations = calls * 2),
+        Scenario(name = "database.save_playlist", params = {**params, "tracks" : len(tracks)}, setup = setup, run = lambda seeded: save_and_delete_playlist(seeded, tracks)),
+    ]
@@ -0,0 +1,24 @@
+from benchmarks.harness import Scenario
+from cogs.music.menus.menu import ITEMS_PER_PAGE, Menu
+
+def page_through(menu : Menu):
+    # Same paging as the next button, without the Discord calls
+    for page_idx in range(0, len(menu.options), ITEMS_PER_PAGE):
+        menu.page_idx = page_idx
+        menu._Menu__get_message_content()
+
+def get_scenarios(quick : bool) -> list[Scenario]:
+    sizes = [1_000] if quick else [100, 1_000, 10_000]
+    scenarios = []
+
+    for size in sizes:
+        options = [f"Artist {i % 97} - Some Song Title Number {i} (Official Video)" for i in range(size)]
+        scenarios.append(Scenario(
+            name = "menu.get_message_content",
+            params = {"options" : size},
+            setup = lambda options = options: Menu(text_channel = None, name = "bench", options = options),
+            run = page_through,
+            operations = -(-size // ITEMS_PER_PAGE)
+        ))
+
+    return scenarios
@@ -0,0 +1,42 @@
+import random
+
+from benchmarks.harness import Scenario
+from cogs.music.queue import Queue
+
+def filled_queue(size : int, played : int = 0) -> Queue:
+    random.seed(size)
+    queue = Queue()
+    queue.add_tracks([f"track-{i}" for i in range(size)])
+    for _ in range(played):
+        queue.get_next_track()
+    return queue
+
+def add_one_by_one(state : tuple[Queue, list[str]]):
+    queue, tracks = state
+    for track in tracks:
+        queue.add_track(track)
+
+def advance_all(queue : Queue):
+    while queue.get_next_track() is not None:
+        pass
+
+def remove_front(queue : Queue):
+    for _ in range(1000):
+        queue.remove_track(0)
+
+def get_scenarios(quick : bool) -> list[Scenario]:
+    sizes = [10_000] if quick else [10_000, 100_000]
+    scenarios = []
+
+    for size in sizes:
+        tracks = [f"track-{i}" for i in range(size)]
+        scenarios += [
+            Scenario(name = "queue.add_track", params = {"tracks" : size}, setup = lambda tracks = tracks: (Queue(), tracks), run = add_one_by_one, operations = size),
+            Scenario(name = "queue.add_tracks", params = {"tracks" : size}, setup = Queue, run = lambda queue, tracks = tracks: queue.add_tracks(tracks)),
+            Scenario(name = "queue.get_next_track", params = {"tracks" : size}, setup = lambda size = size: filled_queue(size), run = advance_all, operations = size),
+            Scenario(name = "queue.shuffle", params = {"tracks" : size}, setup = lambda size = size: filled_queue(size, played = size // 2), run = lambda queue: queue.shuffle()),
+            Scenario(name = "queue.remove_track", params = {"tracks" : size}, setup = lambda size = size: filled_queue(size), run = remove_front, operations = 1000),
+            Scenario(name = "queue.get_queued_tracks", params = {"tracks" : size}, setup = lambda size = size: filled_queue(size, played = size // 2), run = lambda queue: queue.get_queued_tracks()),
+        ]
+
+    return scenarios
@@ -0,0 +1,21 @@
+import random
+
+from benchmarks.harness import Scenario
+from cogs.music.utils import format_input
+
+ARTISTS = ["Daft Punk", "Beyoncé", "Queen", "Linkin Park", "Röyksopp", "Hans Zimmer", "BTS", "AC/DC"]
+SONGS = ["Around The World", "Halo", "Bohemian Rhapsody", "Numb", "Eple", "Time", "Dynamite", "Thunderstruck"]
+DECORATIONS = ["", " (Official Video)", " [HD]", " (Lyrics)", " - Official Music Video", " (Live at Wembley, 1986)", " \"Remastered\"", ".mp3", " (Official Audio) [4K]"]
+
+def get_titles(count : int) -> list[str]:
+    rng = random.Random(count)
+    return [f"{rng.choice(ARTISTS)} - {rng.choice(SONGS)}{rng.choice(DECORATIONS)}{rng.choice(DECORATIONS)}" for _ in range(count)]
+
+def format_all(titles : list[str]):
+    for title in titles:
+        format_input(title)
+
+def get_scenarios(quick : bool) -> list[Scenario]:
+    count = 2_000 if quick else 20_000
+    titles = get_titles(count)
+    return [Scenario(name = "utils.format_input", params = {"titles" : count}, setup = lambda: titles, run = format_all, operations = count)]
@@ -0,0 +1,393 @@
+"""Offline stand-in for Discord: REST calls and interaction responses are answered in process,
+gateway events (guilds, messages, component presses, voice) are fed straight into the bot's parsers."""
+import asyncio
+import random
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from itertools import count
+from time import monotonic, time
+from typing import Any, Callable
+
+from discord.errors import HTTPException, NotFound
+from discord.ext import commands
+from discord.http import Route
+from discord.webhook.async_ import AsyncWebhookAdapter, async_context
+
+DISCORD_EPOCH = 1420070400000
+EPHEMERAL = 64
+
+@dataclass
+class Event:
+    """Something the bot did that a simulated user could see or hear"""
+    kind : str
+    guild_id : int
+    at : float = field(default_factory = monotonic)
+    channel_id : int = None
+    message_id : int = None
+    token : str = None
+    content : str = ""
+    data : Any = None
+
+@dataclass
+class Waiter:
+    predicate : Callable[[Event], bool]
+    future : asyncio.Future
+
+class Recorder:
+    """Fans the bot's outputs out to the simulated users waiting for them"""
+
+    def __init__(self):
+        self.__waiters : dict[int, list[Waiter]] = defaultdict(list)
+        self.counts : dict[str, int] = defaultdict(int)
+
+    def emit(self, event : Event):
+        self.counts[event.kind] += 1
+        waiters = self.__waiters.get(event.guild_id)
+        if not waiters:
+            return
+
+        for waiter in list(waiters):
+            if not waiter.future.done() and waiter.predicate(event):
+                waiter.future.set_result(event)
+                waiters.remove(waiter)
+
+    def expect(self, guild_id : int, predicate : Callable[[Event], bool]) -> asyncio.Future:
+        """Returns a future of the next event of guild_id matching predicate. Call it before causing the event."""
+        waiter = Waiter(predicate = predicate, future = asyncio.get_running_loop().create_future())
+        self.__waiters[guild_id].append(waiter)
+        return waiter.future
+
+    async def wait(self, guild_id : int, future : asyncio.Future, timeout : float) -> Event:
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout = timeout)
+        finally:
+            if not future.done():
+                future.cancel()
+                self.__waiters[guild_id] = [waiter for waiter in self.__waiters[guild_id] if waiter.future is not future]
+
+@dataclass
+class FakeGuild:
+    id : int
+    text_channel_id : int
+    voice_channel_id : int
+    user_ids : list[int]
+    music_channel_id : int = None
+
+@dataclass
+class FakeInteraction:
+    guild_id : int
+    channel_id : int
+    message_id : int
+    original_id : int = None
+
+class FakeResponse:
+    """What discord.HTTPException reads from an aiohttp response"""
+    def __init__(self, status : int, reason : str):
+        self.status : int = status
+        self.reason : str = reason
+
+def get_params(route : Route) -> dict[str, str]:
+    """Values of the {placeholders} of route.path, read back from its url"""
+    template = route.path.strip("/").split("/")
+    values = route.url[len(Route.BASE):].split("?")[0].strip("/").split("/")
+    return {name[1:-1] : value for name, value in zip(template, values) if name.startswith("{")}
+
+def timestamp() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+class FakeDiscord:
+    def __init__(self, bot : commands.Bot, recorder : Recorder, latency : float = 0.05, jitter : float = 0.02, error_rate : float = 0.0, seed : int = 0):
+        self.bot : commands.Bot = bot
+        self.recorder : Recorder = recorder
+        self.__latency : float = latency
+        self.__jitter : float = jitter
+        self.__error_rate : float = error_rate
+        self.__rng : random.Random = random.Random(seed)
+        self.__sequence = count()
+
+        self.bot_id : int = self.next_id()
+        self.application_id : int = self.bot_id
+        self.guilds : dict[int, FakeGuild] = {}
+        self.requests : dict[str, int] = defaultdict(int)
+
+        self.__messages : dict[int, dict] = {}
+        self.__channel_guilds : dict[int, int] = {}
+        self.__interactions : dict[str, FakeInteraction] = {}
+
+    def next_id(self) -> int:
+        return (int(time() * 1000) - DISCORD_EPOCH) << 22 | next(self.__sequence) & 0x3FFFFF
+
+    def install(self):
+        """Routes the bot's REST calls, interaction responses and voice requests to this fake. Call it from the task
+        that feeds the events: interaction responses look their adapter up in a context variable inherited by every task created after."""
+        self.bot.http.request = self.__request
+        self.bot.ws = FakeGateway(discord = self)
+        async_context.set(FakeWebhookAdapter(discord = self))
+
+    def dispatch(self, event : str, data : dict):
+        """Same entry point as the gateway: the parsers, with the music channel filter in front of them"""
+        self.bot._connection.parsers[event](data)
+
+    # ---------------------- PAYLOADS --------------------------#
+    def user(self, user_id : int) -> dict:
+        return {"id" : str(user_id), "username" : f"user{user_id % 100000}", "discriminator" : "0", "global_name" : None, "avatar" : None, "bot" : user_id == self.bot_id}
+
+    def member(self, user_id : int) -> dict:
+        return {"user" : self.user(user_id = user_id), "roles" : [], "joined_at" : timestamp(), "deaf" : False, "mute" : False, "flags" : 0}
+
+    def voice_state(self, guild_id : int, channel_id : int, user_id : int) -> dict:
+        return {
+            "guild_id" : str(guild_id), "channel_id" : str(channel_id) if channel_id else None, "user_id" : str(user_id), "member" : self.member(user_id = user_id),
+            "session_id" : f"voice-{user_id}", "deaf" : False, "mute" : False, "self_deaf" : False, "self_mute" : False, "self_video" : False, "suppress" : False, "request_to_speak_timestamp" : None,
+        }
+
+    def channel(self, guild_id : int, channel_id : int, name : str, type : int = 0, position : int = 0) -> dict:
+        return {"id" : str(channel_id), "guild_id" : str(guild_id), "type" : type, "name" : name, "position" : position, "permission_overwrites" : [], "nsfw" : False, "parent_id" : None, "topic" : None, "rate_limit_per_user" : 0, "last_message_id" : None, "bitrate" : 64000, "user_limit" : 0, "rtc_region" : None}
+
+    def guild(self, guild : FakeGuild) -> dict:
+        return {
+            "id" : str(guild.id), "name" : f"Guild {guild.id % 100000}", "icon" : None, "owner_id" : str(guild.user_ids[0]), "unavailable" : False, "large" : False, "member_count" : len(guild.user_ids) + 1,
+            "afk_channel_id" : None, "afk_timeout" : 300, "verification_level" : 0, "default_message_notifications" : 0, "explicit_content_filter" : 0, "mfa_level" : 0, "nsfw_level" : 0, "premium_tier" : 0,
+            "system_channel_id" : None, "system_channel_flags" : 0, "rules_channel_id" : None, "public_updates_channel_id" : None, "preferred_locale" : "en-US", "features" : [], "emojis" : [], "stickers" : [],
+            "roles" : [{"id" : str(guild.id), "name" : "@everyone", "permissions" : str(2**41 - 1), "position" : 0, "color" : 0, "hoist" : False, "managed" : False, "mentionable" : False, "flags" : 0}],
+            "channels" : [self.channel(guild_id = guild.id, channel_id = guild.text_channel_id, name = "general"), self.channel(guild_id = guild.id, channel_id = guild.voice_channel_id, name = "Music", type = 2, position = 1)],
+            "members" : [self.member(user_id = self.bot_id)] + [self.member(user_id = user_id) for user_id in guild.user_ids],
+            "voice_states" : [self.voice_state(guild_id = guild.id, channel_id = guild.voice_channel_id, user_id = user_id) for user_id in guild.user_ids],
+            "threads" : [], "presences" : [], "stage_instances" : [], "guild_scheduled_events" : [], "soundboard_sounds" : [],
+        }
+
+    def message(self, message_id : int, channel_id : int, author_id : int, content : str = "", components : list = None, embeds : list = None, flags : int = 0) -> dict:
+        data = {
+            "id" : str(message_id), "channel_id" : str(channel_id), "author" : self.user(user_id = author_id), "content" : content or "", "timestamp" : timestamp(), "edited_timestamp" : None,
+            "tts" : False, "mention_everyone" : False, "mentions" : [], "mention_roles" : [], "attachments" : [], "embeds" : embeds or [], "pinned" : False, "type" : 0, "flags" : flags, "components" : components or [],
+        }
+        guild_id = self.__channel_guilds.get(channel_id)
+        if guild_id is not None:
+            data["guild_id"] = str(guild_id)
+        return data
+
+    # ---------------------- GATEWAY --------------------------#
+    def add_guild(self, users : int = 1) -> FakeGuild:
+        guild = FakeGuild(id = self.next_id(), text_channel_id = self.next_id(), voice_channel_id = self.next_id(), user_ids = [self.next_id() for _ in range(users)])
+        self.guilds[guild.id] = guild
+        self.__channel_guilds[guild.text_channel_id] = guild.id
+        self.__channel_guilds[guild.voice_channel_id] = guild.id
+        return guild
+
+    def ready(self):
+        self.bot._connection.guild_ready_timeout = 0
+        self.dispatch("READY", {
+            "v" : 10, "user" : {**self.user(user_id = self.bot_id), "verified" : True, "mfa_enabled" : False, "flags" : 0},
+            "guilds" : [self.guild(guild = guild) for guild in self.guilds.values()],
+            "session_id" : "fake", "resume_gateway_url" : "wss://localhost", "application" : {"id" : str(self.application_id), "flags" : 0},
+        })
+
+    def send_message(self, guild : FakeGuild, user_id : int, content : str, channel_id : int = None) -> int:
+        message_id = self.next_id()
+        data = self.message(message_id = message_id, channel_id = channel_id or guild.music_channel_id, author_id = user_id, content = content)
+        data["member"] = {key : value for key, value in self.member(user_id = user_id).items() if key != "user"}
+        self.dispatch("MESSAGE_CREATE", data)
+        return message_id
+
+    def press(self, guild : FakeGuild, user_id : int, message : dict, custom_id : str, values : list[str] = None) -> str:
+        """A click on a button, or a choice in a select menu when values are given. Returns the interaction token."""
+        interaction_id = self.next_id()
+        token = f"token-{interaction_id}"
+        channel_id = int(message["channel_id"])
+        self.__interactions[token] = FakeInteraction(guild_id = guild.id, channel_id = channel_id, message_id = int(message["id"]))
+
+        component = {"custom_id" : custom_id, "component_type" : 2 if values is None else 3}
+        if values is not None:
+            component["values"] = values
+
+        self.dispatch("INTERACTION_CREATE", {
+            "id" : str(interaction_id), "application_id" : str(self.application_id), "type" : 3, "token" : token, "version" : 1,
+            "guild_id" : str(guild.id), "channel_id" : str(channel_id), "channel" : {"id" : str(channel_id), "type" : 0},
+            "member" : {**self.member(user_id = user_id), "permissions" : str(2**41 - 1)}, "message" : message, "data" : component,
+            "app_permissions" : str(2**41 - 1), "locale" : "en-US", "guild_locale" : "en-US", "entitlements" : [], "authorizing_integration_owners" : {}, "context" : 0, "attachment_size_limit" : 8 * 2**20,
+        })
+        return token
+
+    def join_voice(self, guild_id : int, channel_id : int):
+        """Answers a voice state change of the bot like Discord does: its voice state, then the voice server to connect to"""
+        self.dispatch("VOICE_STATE_UPDATE", self.voice_state(guild_id = guild_id, channel_id = channel_id, user_id = self.bot_id))
+        if channel_id is not None:
+            self.dispatch("VOICE_SERVER_UPDATE", {"guild_id" : str(guild_id), "token" : f"voice-token-{guild_id}", "endpoint" : "localhost:1"})
+
+    # ---------------------- MESSAGES --------------------------#
+    def get_message(self, message_id : int) -> dict:
+        return self.__messages.get(message_id)
+
+    def find_message(self, channel_id : int, custom_id_prefix : str) -> dict:
+        """The newest message of channel_id with a component whose custom_id starts with custom_id_prefix"""
+        for message in reversed(list(self.__messages.values())):
+            if int(message["channel_id"]) != channel_id:
+                continue
+            for row in message["components"]:
+                if any(component.get("custom_id", "").startswith(custom_id_prefix) for component in row.get("components", [])):
+                    return message
+        return None
+
+    def __create_message(self, channel_id : int, payload : dict) -> dict:
+        message = self.message(message_id = self.next_id(), channel_id = channel_id, author_id = self.bot_id, content = payload.get("content"), components = payload.get("components"), embeds = payload.get("embeds"), flags = payload.get("flags", 0))
+        self.__messages[int(message["id"])] = message
+        return message
+
+    def __edit_message(self, message_id : int, payload : dict) -> dict:
+        message = self.__messages.get(message_id)
+        if message is None:
+            raise NotFound(FakeResponse(404, "Not Found"), {"message" : "Unknown Message", "code" : 10008})
+
+        for key in ("content", "components", "embeds", "flags"):
+            if key in payload:
+                message[key] = payload[key] if payload[key] is not None else ("" if key == "content" else [])
+        message["edited_timestamp"] = timestamp()
+        return message
+
+    @staticmethod
+    def get_route_key(route : Route) -> str:
+        # route.key can carry rate limit metadata, like the sub-10-seconds of deletes
+        return f"{route.method} {route.path}"
+
+    async def __delay(self, route : str):
+        self.requests[route] += 1
+        await asyncio.sleep(self.__latency + self.__rng.random() * self.__jitter)
+        if self.__rng.random() < self.__error_rate:
+            raise HTTPException(FakeResponse(500, "Internal Server Error"), {"message" : "Injected failure", "code" : 0})
+
+    # ---------------------- REST --------------------------#
+    async def __request(self, route : Route, *, files = None, form = None, **kwargs) -> Any:
+        key = self.get_route_key(route = route)
+        await self.__delay(route = key)
+        params = get_params(route = route)
+        payload = kwargs.get("json") or {}
+        channel_id = int(params["channel_id"]) if "channel_id" in params else None
+        guild_id = self.__channel_guilds.get(channel_id) if channel_id is not None else None
+
+        if key == "POST /channels/{channel_id}/messages":
+            message = self.__create_message(channel_id = channel_id, payload = payload)
+            self.recorder.emit(Event(kind = "send", guild_id = guild_id, channel_id = channel_id, message_id = int(message["id"]), content = message["content"], data = message))
+            return message
+
+        if key == "PATCH /channels/{channel_id}/messages/{message_id}":
+            message = self.__edit_message(message_id = int(params["message_id"]), payload = payload)
+            self.recorder.emit(Event(kind = "edit", guild_id = guild_id, channel_id = channel_id, message_id = int(message["id"]), content = message["content"], data = message))
+            return message
+
+        if key == "DELETE /channels/{channel_id}/messages/{message_id}":
+            self.__messages.pop(int(params["message_id"]), None)
+            self.recorder.emit(Event(kind = "delete", guild_id = guild_id, channel_id = channel_id, message_id = int(params["message_id"])))
+            return None
+
+        if key == "GET /channels/{channel_id}/messages/{message_id}":
+            message = self.__messages.get(int(params["message_id"]))
+            if message is None:
+                raise NotFound(FakeResponse(404, "Not Found"), {"message" : "Unknown Message", "code" : 10008})
+            return message
+
+        if key == "GET /channels/{channel_id}/messages":
+            return [message for message in reversed(self.__messages.values()) if int(message["channel_id"]) == channel_id][:int(kwargs.get("params", {}).get("limit", 50))]
+
+        if key in ("DELETE /channels/{channel_id}/messages/{message_id}/reactions", "POST /channels/{channel_id}/messages/bulk-delete"):
+            return None
+
+        if key == "POST /guilds/{guild_id}/channels":
+            guild_id = int(params["guild_id"])
+            channel = self.channel(guild_id = guild_id, channel_id = self.next_id(), name = payload["name"], type = payload.get("type", 0), position = 2)
+            self.__channel_guilds[int(channel["id"])] = guild_id
+            self.guilds[guild_id].music_channel_id = int(channel["id"])
+            # Discord announces the channel on the gateway as well, that is what puts it in the guild's cache
+            self.dispatch("CHANNEL_CREATE", channel)
+            return channel
+
+        if key == "GET /oauth2/applications/@me":
+            return {"id" : str(self.application_id), "name" : "Music Bot", "description" : "", "icon" : None, "bot_public" : False, "bot_require_code_grant" : False, "owner" : self.user(user_id = self.bot_id), "verify_key" : "", "flags" : 0}
+
+        raise NotImplementedError(f"Fake Discord does not answer {key}")
+
+    # ---------------------- INTERACTIONS --------------------------#
+    async def webhook_request(self, route : Route, payload : dict = None, multipart : list = None, params : dict = None) -> Any:
+        key = self.get_route_key(route = route)
+        await self.__delay(route = key)
+        route_params = get_params(route = route)
+        payload = payload or {}
+        token = route_params.get("webhook_token")
+        interaction = self.__interactions.get(token)
+        if interaction is None:
+            raise NotFound(FakeResponse(404, "Not Found"), {"message" : "Unknown Webhook", "code" : 10015})
+
+        if key == "POST /interactions/{webhook_id}/{webhook_token}/callback":
+            return self.__respond(token = token, interaction = interaction, interaction_id = int(route_params["webhook_id"]), payload = payload)
+
+        if key == "POST /webhooks/{webhook_id}/{webhook_token}":
+            message = self.__create_message(channel_id = interaction.channel_id, payload = payload)
+            message["webhook_id"] = str(self.application_id)
+            self.recorder.emit(Event(kind = "followup", guild_id = interaction.guild_id, message_id = int(message["id"]), token = token, content = message["content"], data = message))
+            return message
+
+        message_id = route_params.get("message_id")
+        message_id = interaction.original_id if message_id == "@original" else int(message_id) if message_id else None
+
+        if route.method == "GET":
+            message = self.__messages.get(message_id)
+            if message is None:
+                raise NotFound(FakeResponse(404, "Not Found"), {"message" : "Unknown Message", "code" : 10008})
+            return message
+
+        if route.method == "PATCH":
+            message = self.__edit_message(message_id = message_id, payload = payload)
+            self.recorder.emit(Event(kind = "webhook_edit", guild_id = interaction.guild_id, message_id = message_id, token = token, content = message["content"], data = message))
+            return message
+
+        if route.method == "DELETE":
+            self.__messages.pop(message_id, None)
+            return None
+
+        raise NotImplementedError(f"Fake Discord does not answer {key}")
+
+    def __respond(self, token : str, interaction : FakeInteraction, interaction_id : int, payload : dict) -> dict:
+        response_type, data = payload.get("type"), payload.get("data") or {}
+        message = None
+
+        if response_type in (4, 5):
+            message = self.__create_message(channel_id = interaction.channel_id, payload = data)
+            interaction.original_id = int(message["id"])
+        elif response_type in (6, 7):
+            # Updates answer with the message the component is on, which becomes the original response
+            interaction.original_id = interaction.message_id
+            if response_type == 7:
+                message = self.__edit_message(message_id = interaction.message_id, payload = data)
+
+        self.recorder.emit(Event(kind = "response", guild_id = interaction.guild_id, message_id = int(message["id"]) if message else None, token = token, content = message["content"] if message else "", data = response_type))
+
+        response = {"interaction" : {"id" : str(interaction_id), "type" : 3, "response_message_id" : message["id"] if message else None, "response_message_loading" : response_type == 5, "response_message_ephemeral" : bool(data.get("flags", 0) & EPHEMERAL)}}
+        if message is not None:
+            response["resource"] = {"type" : response_type, "message" : message}
+        return response
+
+class FakeWebhookAdapter(AsyncWebhookAdapter):
+    """Every interaction response, followup and ephemeral edit goes through request()"""
+
+    def __init__(self, discord : FakeDiscord):
+        super().__init__()
+        self.__discord : FakeDiscord = discord
+
+    async def request(self, route : Route, session = None, *, payload : dict = None, multipart : list = None, params : dict = None, **kwargs) -> Any:
+        return await self.__discord.webhook_request(route = route, payload = payload, multipart = multipart, params = params)
+
+class FakeGateway:
+    """The parts of discord.py's gateway websocket the cog reaches: voice state changes"""
+
+    def __init__(self, discord : FakeDiscord):
+        self.__discord : FakeDiscord = discord
+        self.latency : float = 0.0
+
+    def is_ratelimited(self) -> bool:
+        return False
+
+    async def voice_state(self, guild_id : int, channel_id : int, self_mute : bool = False, self_deaf : bool = False):
+        asyncio.get_running_loop().call_soon(self.__discord.join_voice, guild_id, channel_id)
+
+    async def change_presence(self, **kwargs):
+        pass
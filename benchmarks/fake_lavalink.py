@@ -0,0 +1,424 @@
+"""Stand-in Lavalink v4 server for offline runs: REST load/decode/sessions/players/stats and the websocket,
+with tracks generated from the query instead of fetched from YouTube. Run it alone with
+
+    python -m benchmarks.fake_lavalink [--port 2333] [--latency 0.05] [--load-failure-rate 0.01]
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from itertools import count
+from time import monotonic, time
+from urllib.parse import parse_qs, urlparse
+
+from aiohttp import WSMsgType, web
+
+from config import LAVALINK_PASSWORD, LAVALINK_PORT
+
+WORDS = ["night", "drive", "summer", "heart", "fire", "dream", "city", "light", "dance", "river", "gold", "echo", "storm", "blue", "wild", "home"]
+ARTISTS = ["The Midnight", "Aurora", "Daft Punk", "Khruangbin", "Phoenix", "Tame Impala", "Bonobo", "M83", "Air", "Röyksopp"]
+
+@dataclass
+class FakeLavalinkConfig:
+    password : str = LAVALINK_PASSWORD
+    latency : float = 0.02 # Seconds added to every REST answer
+    jitter : float = 0.01 # Up to this many more seconds, uniformly
+    load_failure_rate : float = 0.0 # Share of track loads answered with loadType "error"
+    http_error_rate : float = 0.0 # Share of REST calls answered with a 500
+    unavailable_rate : float = 0.0 # Share of video ids that load as "empty" and fail when played
+    search_results : int = 10
+    playlist_length : int = 50
+    track_seconds : float = 30.0 # Real seconds a track plays before its TrackEndEvent
+    player_update_interval : float = 5.0
+    stats_interval : float = 60.0
+    cpu_load : float = 0.05 # System load reported in the stats
+    seed : int = 0
+
+@dataclass
+class FakePlayer:
+    guild_id : str
+    track : dict = None
+    paused : bool = False
+    volume : int = 100
+    voice : dict = field(default_factory = dict)
+    # Position of the track when it was last (re)started or paused, and when that was
+    position : int = 0
+    started_at : float = 0.0
+    end_task : asyncio.Task = None
+
+    def get_position(self) -> int:
+        if self.track is None:
+            return 0
+        if self.paused:
+            return self.position
+        return min(self.track["info"]["length"], self.position + int((monotonic() - self.started_at) * 1000))
+
+    def to_dict(self) -> dict:
+        return {
+            "guildId" : self.guild_id,
+            "track" : self.track,
+            "volume" : self.volume,
+            "paused" : self.paused,
+            "state" : {"time" : int(time() * 1000), "position" : self.get_position(), "connected" : bool(self.voice), "ping" : 1},
+            "voice" : self.voice,
+            "filters" : {},
+        }
+
+@dataclass
+class FakeSession:
+    id : str
+    socket : web.WebSocketResponse
+    transport : asyncio.Transport
+    players : dict[str, FakePlayer] = field(default_factory = dict)
+    tasks : list[asyncio.Task] = field(default_factory = list)
+
+def get_video_id(seed : str) -> str:
+    return base64.urlsafe_b64encode(hashlib.sha1(seed.encode()).digest()).decode()[:11]
+
+def make_track(video_id : str) -> dict:
+    """The encoded string is the track info itself, so any fake node decodes tracks made by any other"""
+    rng = random.Random(video_id)
+    info = {
+        "identifier" : video_id,
+        "isSeekable" : True,
+        "author" : rng.choice(ARTISTS),
+        "length" : rng.randint(120, 420) * 1000,
+        "isStream" : False,
+        "position" : 0,
+        "title" : " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title(),
+        "uri" : f"https://www.youtube.com/watch?v={video_id}",
+        "artworkUrl" : f"https://i.ytimg.com/vi/{video_id}/mqdefault.jpg",
+        "isrc" : None,
+        "sourceName" : "youtube",
+    }
+    encoded = base64.urlsafe_b64encode(json.dumps(info).encode()).decode()
+    return {"encoded" : encoded, "info" : info, "pluginInfo" : {}, "userData" : {}}
+
+def decode_track(encoded : str) -> dict:
+    info = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+    return {"encoded" : encoded, "info" : info, "pluginInfo" : {}, "userData" : {}}
+
+class FakeLavalink:
+    def __init__(self, config : FakeLavalinkConfig = None, identifier : str = "fake"):
+        self.config : FakeLavalinkConfig = config or FakeLavalinkConfig()
+        self.identifier : str = identifier
+        self.requests : dict[str, int] = {}
+        self.__rng : random.Random = random.Random(self.config.seed)
+        self.__sessions : dict[str, FakeSession] = {}
+        self.__session_ids = count(1)
+        self.__started_at : float = monotonic()
+        self.__runner : web.AppRunner = None
+        self.port : int = None
+
+        # Called with (guild id, track or None) on every player change, the load harness times plays with it
+        self.on_play = None
+
+        self.app = web.Application(middlewares = [self.__middleware])
+        self.app.add_routes([
+            web.get("/version", self.__version),
+            web.get("/v4/info", self.__info),
+            web.get("/v4/stats", self.__stats),
+            web.get("/v4/websocket", self.__websocket),
+            web.get("/v4/loadtracks", self.__load_tracks),
+            web.get("/v4/decodetrack", self.__decode_track),
+            web.post("/v4/decodetracks", self.__decode_tracks),
+            web.patch("/v4/sessions/{session_id}", self.__update_session),
+            web.get("/v4/sessions/{session_id}/players", self.__get_players),
+            web.get("/v4/sessions/{session_id}/players/{guild_id}", self.__get_player),
+            web.patch("/v4/sessions/{session_id}/players/{guild_id}", self.__update_player),
+            web.delete("/v4/sessions/{session_id}/players/{guild_id}", self.__destroy_player),
+        ])
+
+    # ---------------------- SERVER --------------------------#
+    async def start(self, host : str = "127.0.0.1", port : int = 0) -> int:
+        """Serves on host:port, port 0 picks a free one. Returns the port."""
+        self.__runner = web.AppRunner(self.app, access_log = None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, host = host, port = port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self):
+        await self.disconnect()
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    async def disconnect(self):
+        """Drops every connection without a close frame, like a crashed node. Players and sessions are gone."""
+        for session in list(self.__sessions.values()):
+            await self.__close_session(session = session, abort = True)
+
+    def get_player_count(self) -> int:
+        return sum(len(session.players) for session in self.__sessions.values())
+
+    @web.middleware
+    async def __middleware(self, request : web.Request, handler) -> web.StreamResponse:
+        if request.headers.get("Authorization") != self.config.password:
+            return self.__error(request = request, status = 401, message = "Unauthorized")
+
+        route = f"{request.method} {request.match_info.route.resource.canonical if request.match_info.route.resource else request.path}"
+        self.requests[route] = self.requests.get(route, 0) + 1
+
+        if request.path == "/v4/websocket":
+            return await handler(request)
+
+        await asyncio.sleep(self.config.latency + self.__rng.random() * self.config.jitter)
+        if self.__rng.random() < self.config.http_error_rate:
+            return self.__error(request = request, status = 500, message = "Injected failure")
+        return await handler(request)
+
+    @staticmethod
+    def __error(request : web.Request, status : int, message : str) -> web.Response:
+        return web.json_response({"timestamp" : int(time() * 1000), "status" : status, "error" : HTTPStatus(status).phrase, "message" : message, "path" : request.path}, status = status)
+
+    def __get_session(self, request : web.Request) -> FakeSession:
+        session = self.__sessions.get(request.match_info["session_id"])
+        if session is None:
+            raise web.HTTPNotFound(text = json.dumps({"timestamp" : int(time() * 1000), "status" : 404, "error" : HTTPStatus(404).phrase, "message" : "Session not found", "path" : request.path}), content_type = "application/json")
+        return session
+
+    # ---------------------- INFO --------------------------#
+    async def __version(self, request : web.Request) -> web.Response:
+        return web.Response(text = "4.0.8")
+
+    async def __info(self, request : web.Request) -> web.Response:
+        return web.json_response({
+            "version" : {"semver" : "4.0.8", "major" : 4, "minor" : 0, "patch" : 8, "preRelease" : None, "build" : None},
+            "buildTime" : 0, "git" : {"branch" : "fake", "commit" : "fake", "commitTime" : 0},
+            "jvm" : "none", "lavaplayer" : "fake", "sourceManagers" : ["youtube"], "filters" : [], "plugins" : [],
+        })
+
+    def get_stats(self) -> dict:
+        players = [player for session in self.__sessions.values() for player in session.players.values()]
+        return {
+            "players" : len(players),
+            "playingPlayers" : sum(1 for player in players if player.track is not None and not player.paused),
+            "uptime" : int((monotonic() - self.__started_at) * 1000),
+            "memory" : {"free" : 2**28, "used" : 2**28, "allocated" : 2**29, "reservable" : 2**30},
+            "cpu" : {"cores" : 4, "systemLoad" : self.config.cpu_load, "lavalinkLoad" : self.config.cpu_load / 2},
+            "frameStats" : {"sent" : 3000 * len(players), "nulled" : 0, "deficit" : 0},
+        }
+
+    async def __stats(self, request : web.Request) -> web.Response:
+        return web.json_response(self.get_stats())
+
+    # ---------------------- TRACKS --------------------------#
+    def is_unavailable(self, video_id : str) -> bool:
+        return int(hashlib.sha1(video_id.encode()).hexdigest()[:8], 16) / 0xFFFFFFFF < self.config.unavailable_rate
+
+    def load(self, identifier : str) -> dict:
+        """Lavalink's loadtracks answer for identifier: a search, a video url or a playlist url"""
+        if self.__rng.random() < self.config.load_failure_rate:
+            return {"loadType" : "error", "data" : {"message" : "Injected load failure", "severity" : "common", "cause" : "FakeLavalink"}}
+
+        if ":" in identifier and not identifier.startswith("http"):
+            query = identifier.split(":", 1)[1]
+            tracks = [make_track(get_video_id(f"{query}#{i}")) for i in range(self.config.search_results)]
+            return {"loadType" : "search", "data" : [track for track in tracks if not self.is_unavailable(track["info"]["identifier"])]}
+
+        parameters = parse_qs(urlparse(identifier).query)
+        if "list" in parameters:
+            playlist_id = parameters["list"][0]
+            tracks = [make_track(get_video_id(f"{playlist_id}#{i}")) for i in range(self.config.playlist_length)]
+            return {"loadType" : "playlist", "data" : {"info" : {"name" : f"Playlist {playlist_id}", "selectedTrack" : -1}, "pluginInfo" : {}, "tracks" : tracks}}
+
+        video_id = parameters.get("v", [identifier.rstrip("/").split("/")[-1]])[0]
+        if self.is_unavailable(video_id):
+            return {"loadType" : "empty", "data" : {}}
+        return {"loadType" : "track", "data" : make_track(video_id)}
+
+    async def __load_tracks(self, request : web.Request) -> web.Response:
+        return web.json_response(self.load(identifier = request.query.get("identifier", "")))
+
+    async def __decode_track(self, request : web.Request) -> web.Response:
+        return web.json_response(decode_track(request.query["encodedTrack"]))
+
+    async def __decode_tracks(self, request : web.Request) -> web.Response:
+        return web.json_response([decode_track(encoded) for encoded in await request.json()])
+
+    # ---------------------- SESSIONS --------------------------#
+    async def __websocket(self, request : web.Request) -> web.WebSocketResponse:
+        socket = web.WebSocketResponse()
+        await socket.prepare(request)
+
+        session = FakeSession(id = f"{self.identifier}-{next(self.__session_ids)}", socket = socket, transport = request.transport)
+        self.__sessions[session.id] = session
+        await socket.send_json({"op" : "ready", "resumed" : False, "sessionId" : session.id})
+        session.tasks = [asyncio.create_task(self.__send_stats(session = session)), asyncio.create_task(self.__send_player_updates(session = session))]
+
+        try:
+            async for message in socket:
+                if message.type in (WSMsgType.ERROR, WSMsgType.CLOSE):
+                    break
+        finally:
+            await self.__close_session(session = session)
+        return socket
+
+    async def __close_session(self, session : FakeSession, abort : bool = False):
+        if self.__sessions.pop(session.id, None) is None:
+            return
+
+        for task in session.tasks:
+            task.cancel()
+        for player in session.players.values():
+            if player.end_task is not None:
+                player.end_task.cancel()
+
+        if abort and session.transport is not None:
+            session.transport.abort()
+        else:
+            await session.socket.close()
+
+    async def __send(self, session : FakeSession, data : dict):
+        if not session.socket.closed:
+            try:
+                await session.socket.send_json(data)
+            except ConnectionError:
+                pass
+
+    async def __send_stats(self, session : FakeSession):
+        while True:
+            await self.__send(session = session, data = {"op" : "stats", **self.get_stats()})
+            await asyncio.sleep(self.config.stats_interval)
+
+    async def __send_player_updates(self, session : FakeSession):
+        while True:
+            await asyncio.sleep(self.config.player_update_interval)
+            for player in list(session.players.values()):
+                if player.track is not None:
+                    await self.__send(session = session, data = {"op" : "playerUpdate", "guildId" : player.guild_id, "state" : player.to_dict()["state"]})
+
+    async def __update_session(self, request : web.Request) -> web.Response:
+        self.__get_session(request = request)
+        data = await request.json()
+        return web.json_response({"resuming" : data.get("resuming", False), "timeout" : data.get("timeout", 60)})
+
+    # ---------------------- PLAYERS --------------------------#
+    async def __get_players(self, request : web.Request) -> web.Response:
+        return web.json_response([player.to_dict() for player in self.__get_session(request = request).players.values()])
+
+    async def __get_player(self, request : web.Request) -> web.Response:
+        player = self.__get_session(request = request).players.get(request.match_info["guild_id"])
+        if player is None:
+            raise web.HTTPNotFound(text = "Player not found")
+        return web.json_response(player.to_dict())
+
+    async def __destroy_player(self, request : web.Request) -> web.Response:
+        session = self.__get_session(request = request)
+        player = session.players.pop(request.match_info["guild_id"], None)
+        if player is not None and player.end_task is not None:
+            player.end_task.cancel()
+        return web.Response(status = 204)
+
+    async def __update_player(self, request : web.Request) -> web.Response:
+        session = self.__get_session(request = request)
+        guild_id = request.match_info["guild_id"]
+        data = await request.json()
+
+        player = session.players.get(guild_id)
+        if player is None:
+            player = session.players[guild_id] = FakePlayer(guild_id = guild_id)
+
+        if "voice" in data:
+            player.voice = data["voice"]
+        if "volume" in data:
+            player.volume = data["volume"]
+        if "paused" in data and data["paused"] != player.paused:
+            player.position, player.started_at = player.get_position(), monotonic()
+            player.paused = data["paused"]
+            self.__schedule_end(session = session, player = player)
+
+        if "track" in data:
+            no_replace = request.query.get("noReplace", "false").lower() == "true"
+            if not (no_replace and player.track is not None):
+                await self.__set_track(session = session, player = player, encoded = data["track"].get("encoded"), user_data = data["track"].get("userData", {}), position = data.get("position", 0))
+
+        return web.json_response(player.to_dict())
+
+    async def __set_track(self, session : FakeSession, player : FakePlayer, encoded : str, user_data : dict, position : int):
+        previous = player.track
+        player.track = None
+        if player.end_task is not None:
+            player.end_task.cancel()
+            player.end_task = None
+
+        if previous is not None:
+            reason = "stopped" if encoded is None else "replaced"
+            await self.__send(session = session, data = {"op" : "event", "type" : "TrackEndEvent", "guildId" : player.guild_id, "track" : previous, "reason" : reason})
+
+        if encoded is None:
+            if self.on_play is not None:
+                self.on_play(int(player.guild_id), None)
+            return
+
+        track = {**decode_track(encoded), "userData" : user_data}
+        if self.is_unavailable(track["info"]["identifier"]):
+            await self.__send(session = session, data = {"op" : "event", "type" : "TrackExceptionEvent", "guildId" : player.guild_id, "track" : track, "exception" : {"message" : "This video is unavailable", "severity" : "common", "cause" : "FakeLavalink"}})
+            await self.__send(session = session, data = {"op" : "event", "type" : "TrackEndEvent", "guildId" : player.guild_id, "track" : track, "reason" : "loadFailed"})
+            return
+
+        player.track, player.position, player.started_at = track, position or 0, monotonic()
+        if self.on_play is not None:
+            self.on_play(int(player.guild_id), track)
+        await self.__send(session = session, data = {"op" : "event", "type" : "TrackStartEvent", "guildId" : player.guild_id, "track" : track})
+        self.__schedule_end(session = session, player = player)
+
+    def __schedule_end(self, session : FakeSession, player : FakePlayer):
+        if player.end_task is not None:
+            player.end_task.cancel()
+            player.end_task = None
+        if player.track is not None and not player.paused:
+            player.end_task = asyncio.create_task(self.__end_track(session = session, player = player, track = player.track))
+
+    async def __end_track(self, session : FakeSession, player : FakePlayer, track : dict):
+        # Every track plays for track_seconds whatever its length, resumed tracks for what is left of it
+        remaining = 1 - player.position / max(1, track["info"]["length"])
+        await asyncio.sleep(self.config.track_seconds * remaining)
+        if player.track is not track:
+            return
+
+        player.track, player.end_task = None, None
+        await self.__send(session = session, data = {"op" : "event", "type" : "TrackEndEvent", "guildId" : player.guild_id, "track" : track, "reason" : "finished"})
+
+
+async def serve(config : FakeLavalinkConfig, host : str, port : int):
+    node = FakeLavalink(config = config)
+    port = await node.start(host = host, port = port)
+    print(f"Fake Lavalink listening on http://{host}:{port}, password {config.password}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await node.close()
+
+def add_config_arguments(parser : argparse.ArgumentParser):
+    defaults = FakeLavalinkConfig()
+    parser.add_argument("--latency", type = float, default = defaults.latency, help = "seconds added to every Lavalink REST answer")
+    parser.add_argument("--jitter", type = float, default = defaults.jitter, help = "up to this many more seconds of Lavalink latency")
+    parser.add_argument("--load-failure-rate", type = float, default = defaults.load_failure_rate, help = "share of track loads that fail")
+    parser.add_argument("--http-error-rate", type = float, default = defaults.http_error_rate, help = "share of Lavalink REST calls answered with a 500")
+    parser.add_argument("--unavailable-rate", type = float, default = defaults.unavailable_rate, help = "share of videos that are unavailable")
+    parser.add_argument("--track-seconds", type = float, default = defaults.track_seconds, help = "real seconds every track plays")
+
+def get_config(args : argparse.Namespace) -> FakeLavalinkConfig:
+    return FakeLavalinkConfig(latency = args.latency, jitter = args.jitter, load_failure_rate = args.load_failure_rate, http_error_rate = args.http_error_rate, unavailable_rate = args.unavailable_rate, track_seconds = args.track_seconds)
+
+def main():
+    parser = argparse.ArgumentParser(description = "Runs a fake Lavalink v4 node")
+    parser.add_argument("--host", default = "127.0.0.1")
+    parser.add_argument("--port", type = int, default = LAVALINK_PORT)
+    add_config_arguments(parser = parser)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(config = get_config(args = args), host = args.host, port = args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
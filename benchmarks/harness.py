@@ -0,0 +1,51 @@
+from dataclasses import dataclass, field
+from statistics import mean, median
+from time import perf_counter
+from typing import Any, Callable
+
+@dataclass
+class Scenario:
+    """setup() builds fresh state before every repeat, run(state) performs `operations` operations on it and is the only part timed"""
+    name : str
+    params : dict
+    run : Callable[[Any], Any]
+    setup : Callable[[], Any] = lambda: None
+    operations : int = 1
+    repeat : int = 5
+
+    def get_key(self) -> str:
+        return self.name + "".join(f" {name}={value}" for name, value in sorted(self.params.items()))
+
+@dataclass
+class Result:
+    key : str
+    name : str
+    params : dict
+    operations : int
+    times : list[float] = field(default_factory = list)
+
+    def to_dict(self) -> dict:
+        best, middle = min(self.times), median(self.times)
+        return {
+            "key" : self.key,
+            "name" : self.name,
+            "params" : self.params,
+            "operations" : self.operations,
+            "repeat" : len(self.times),
+            "min_s" : best,
+            "median_s" : middle,
+            "mean_s" : mean(self.times),
+            "median_per_op_s" : middle / self.operations,
+            "ops_per_s" : self.operations / middle if middle > 0 else None,
+        }
+
+def measure(scenario : Scenario, repeat : int = None) -> Result:
+    result = Result(key = scenario.get_key(), name = scenario.name, params = scenario.params, operations = scenario.operations)
+
+    for _ in range(repeat or scenario.repeat):
+        state = scenario.setup()
+        start = perf_counter()
+        scenario.run(state)
+        result.times.append(perf_counter() - start)
+
+    return result
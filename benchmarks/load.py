@@ -0,0 +1,356 @@
+"""End to end load test of the music cog, fully offline: simulated guilds use the menus of a real MusicCog
+while Discord and Lavalink are faked in process. Run from the repository root:
+
+    python -m benchmarks.load [--guilds 10 100 1000] [--searches 3] [--skips 3] [--output load.json]
+
+Each guild sets the bot up, plays a stored playlist, searches and queues songs, skips and stops.
+Every concurrency level runs in its own process, the cog keeps its state in module singletons.
+"""
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+from collections import defaultdict
+from contextlib import redirect_stdout
+from dataclasses import asdict, dataclass, field
+from time import monotonic, time
+
+import wavelink
+from discord.ext import commands
+
+import config
+from benchmarks.fake_discord import Event, FakeDiscord, FakeGuild, Recorder
+from benchmarks.fake_lavalink import WORDS, FakeLavalink, FakeLavalinkConfig, add_config_arguments, get_config, get_video_id, make_track
+from bot import Bot
+from cogs.music.database import Database, StoredTrack
+from cogs.music.event_filter import event_filter
+from cogs.music.metrics import metrics
+from cogs.music.queue_journal import queue_journal
+from cogs.music_cog import MusicCog
+
+OPERATIONS = ["setup", "playlist", "search", "enqueue", "skip", "stop"]
+QUERIES = [f"{a} {b}" for a in WORDS for b in WORDS if a != b]
+
+@dataclass
+class LoadOptions:
+    guilds : int = 10
+    users : int = 2 # Members sitting in the voice channel of each guild
+    searches : int = 3 # Songs searched and queued per guild
+    skips : int = 3
+    playlist_length : int = 50 # Songs of the stored playlist of each guild, half of them stale and resolved again
+    think : float = 0.2 # Up to this many seconds between two steps of a guild
+    ramp : float = 1.0 # Guilds start within this many seconds
+    timeout : float = 30.0 # Seconds a step may take before counting as failed
+    discord_latency : float = 0.05
+    discord_jitter : float = 0.02
+    discord_error_rate : float = 0.0
+    nodes : int = 1
+    kill_node_after : float = None # Seconds after the start before the first node drops its websocket
+    seed : int = 0
+
+@dataclass
+class Stats:
+    latencies : dict[str, list[float]] = field(default_factory = lambda: defaultdict(list))
+    failures : dict[str, int] = field(default_factory = lambda: defaultdict(int))
+
+    def add(self, operation : str, latency : float):
+        self.latencies[operation].append(latency)
+
+    def fail(self, operation : str):
+        self.failures[operation] += 1
+
+def percentile(values : list[float], share : float) -> float:
+    """Nearest rank percentile, share in [0, 1]"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(share * len(values)) - 1)]
+
+def summarize(stats : Stats, duration : float) -> dict[str, dict]:
+    summary = {}
+    for operation in OPERATIONS:
+        latencies = stats.latencies.get(operation, [])
+        summary[operation] = {
+            "count" : len(latencies),
+            "failed" : stats.failures.get(operation, 0),
+            "p50_s" : percentile(latencies, 0.5),
+            "p99_s" : percentile(latencies, 0.99),
+            "max_s" : max(latencies, default = 0.0),
+            "per_s" : len(latencies) / duration if duration > 0 else 0.0,
+        }
+    return summary
+
+# ---------------------- SIMULATED GUILD --------------------------#
+class GuildDriver:
+    def __init__(self, discord : FakeDiscord, recorder : Recorder, guild : FakeGuild, options : LoadOptions, stats : Stats, rng : random.Random):
+        self.__discord : FakeDiscord = discord
+        self.__recorder : Recorder = recorder
+        self.__guild : FakeGuild = guild
+        self.__options : LoadOptions = options
+        self.__stats : Stats = stats
+        self.__rng : random.Random = rng
+        self.__user_id : int = guild.user_ids[0]
+
+    async def __step(self, operation : str, predicate, action, timed : bool = True) -> Event:
+        """Runs action and times it until the bot does what predicate waits for. Returns None, counted as a failure of operation, if it never did."""
+        future = self.__recorder.expect(guild_id = self.__guild.id, predicate = predicate)
+        start = monotonic()
+        action()
+        try:
+            event = await self.__recorder.wait(guild_id = self.__guild.id, future = future, timeout = self.__options.timeout)
+        except asyncio.TimeoutError:
+            self.__stats.fail(operation)
+            return None
+
+        if timed:
+            self.__stats.add(operation, event.at - start)
+        return event
+
+    async def __think(self):
+        await asyncio.sleep(self.__rng.random() * self.__options.think)
+
+    def __press(self, message : dict, custom_id : str, values : list[str] = None):
+        return lambda: self.__discord.press(guild = self.__guild, user_id = self.__user_id, message = message, custom_id = custom_id, values = values)
+
+    async def __open_session(self, operation : str, command_message : dict, command_index : int, header : str) -> dict:
+        """Picks a command, returns the ephemeral menu it answers with"""
+        event = await self.__step(
+            operation = operation,
+            predicate = lambda event: event.kind in ("response", "followup") and header in event.content,
+            action = self.__press(message = command_message, custom_id = "music:command:select", values = [str(command_index)]),
+            timed = False
+        )
+        return event.data if event is not None else None
+
+    async def run(self):
+        await asyncio.sleep(self.__rng.random() * self.__options.ramp)
+        guild = self.__guild
+
+        setup = await self.__step(
+            operation = "setup",
+            predicate = lambda event: event.kind == "setup",
+            action = lambda: self.__discord.send_message(guild = guild, user_id = self.__user_id, content = "!setup", channel_id = guild.text_channel_id)
+        )
+        if setup is None:
+            return
+
+        command_message = self.__discord.find_message(channel_id = guild.music_channel_id, custom_id_prefix = "music:command:")
+        player_message = self.__discord.find_message(channel_id = guild.music_channel_id, custom_id_prefix = "music:player:")
+
+        await self.__think()
+        session_message = await self.__open_session(operation = "playlist", command_message = command_message, command_index = 1, header = "Select **Playlist**")
+        if session_message is not None:
+            await self.__step(
+                operation = "playlist",
+                predicate = lambda event: event.kind == "play" and event.data is not None,
+                action = self.__press(message = session_message, custom_id = "music:session:select", values = ["0"])
+            )
+
+        for _ in range(self.__options.searches):
+            await self.__think()
+            if await self.__open_session(operation = "search", command_message = command_message, command_index = 0, header = "What song") is None:
+                continue
+
+            # A few popular queries and a long tail, like real users
+            query = QUERIES[min(len(QUERIES) - 1, int(self.__rng.paretovariate(1.2)) - 1)]
+            results = await self.__step(
+                operation = "search",
+                predicate = lambda event: event.kind == "webhook_edit" and "Select **Song**" in event.content,
+                action = lambda: self.__discord.send_message(guild = guild, user_id = self.__user_id, content = query)
+            )
+            if results is None:
+                continue
+
+            await self.__step(
+                operation = "enqueue",
+                predicate = lambda event: event.kind == "queue:add_tracks",
+                action = self.__press(message = results.data, custom_id = "music:session:select", values = [str(self.__rng.randrange(3))])
+            )
+
+        for _ in range(self.__options.skips):
+            await self.__think()
+            await self.__step(
+                operation = "skip",
+                predicate = lambda event: event.kind == "play" and event.data is not None,
+                action = self.__press(message = player_message, custom_id = "music:player:skip")
+            )
+
+        await self.__think()
+        # A player left on a node that went down has nothing to stop, the player message is all that changes then
+        await self.__step(
+            operation = "stop",
+            predicate = lambda event: (event.kind == "play" and event.data is None) or (event.kind in ("response", "edit") and "Not playing anything." in event.content),
+            action = self.__press(message = player_message, custom_id = "music:player:stop")
+        )
+
+# ---------------------- ONE LEVEL --------------------------#
+async def seed_playlists(database : Database, guilds : list[FakeGuild], length : int):
+    """One playlist per member, half of its stored tracks too old to be used without resolving them again"""
+    now = int(time())
+    for guild in guilds:
+        for user_id in guild.user_ids:
+            tracks = []
+            for i in range(length):
+                track = make_track(video_id = get_video_id(seed = f"{user_id}:{i}"))
+                info = track["info"]
+                tracks.append(StoredTrack(track_id = info["identifier"], encoded = track["encoded"], title = info["title"], author = info["author"], length = info["length"], updated_at = now if i % 2 == 0 else 0, uri = info["uri"], source = info["sourceName"]))
+            await database.save_playlist(tracks = tracks, playlist_name = "Favourites", author_id = user_id)
+
+def hook_events(recorder : Recorder, lavalinks : list[FakeLavalink]):
+    """Turns what the bot does internally into events: menus ready, songs queued, tracks played"""
+    for lavalink in lavalinks:
+        lavalink.on_play = lambda guild_id, track: recorder.emit(Event(kind = "play", guild_id = guild_id, data = track))
+
+    record = queue_journal.record
+    def record_and_emit(guild_id : int, op : str, *args):
+        record(guild_id, op, *args)
+        recorder.emit(Event(kind = f"queue:{op}", guild_id = guild_id))
+    queue_journal.record = record_and_emit
+
+    register = event_filter.register
+    def register_and_emit(guild_id : int, channel_id : int):
+        register(guild_id = guild_id, channel_id = channel_id)
+        recorder.emit(Event(kind = "setup", guild_id = guild_id))
+    event_filter.register = register_and_emit
+
+async def watch_loop_lag(samples : list[float], interval : float = 0.05):
+    while True:
+        start = monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, monotonic() - start - interval))
+
+async def wait_for_nodes(count : int, timeout : float):
+    deadline = monotonic() + timeout
+    while sum(node.status is wavelink.NodeStatus.CONNECTED for node in wavelink.Pool.nodes.values()) < count:
+        if monotonic() > deadline:
+            raise TimeoutError("The fake Lavalink nodes did not connect")
+        await asyncio.sleep(0.05)
+
+async def run_level(options : LoadOptions, lavalink_config : FakeLavalinkConfig) -> dict:
+    rng = random.Random(options.seed)
+    directory = tempfile.TemporaryDirectory()
+
+    lavalinks = [FakeLavalink(config = lavalink_config, identifier = f"fake-{i}") for i in range(options.nodes)]
+    ports = [await lavalink.start() for lavalink in lavalinks]
+    # node_pool reads this list when connecting
+    config.LAVALINK_NODES[:] = [{"identifier" : lavalink.identifier, "host" : "127.0.0.1", "port" : port, "password" : lavalink_config.password} for lavalink, port in zip(lavalinks, ports)]
+
+    recorder = Recorder()
+    bot : commands.Bot = Bot()
+    await bot._async_setup_hook()
+    discord = FakeDiscord(bot = bot, recorder = recorder, latency = options.discord_latency, jitter = options.discord_jitter, error_rate = options.discord_error_rate, seed = options.seed)
+    discord.install()
+    hook_events(recorder = recorder, lavalinks = lavalinks)
+
+    # Any free port, a running bot may own the configured one
+    await metrics.start(port = 0)
+    cog = MusicCog(bot, database = Database(path = os.path.join(directory.name, "load.db")))
+    await bot.add_cog(cog)
+
+    guilds = [discord.add_guild(users = options.users) for _ in range(options.guilds)]
+    await seed_playlists(database = cog.database, guilds = guilds, length = options.playlist_length)
+    discord.ready()
+    await bot.wait_until_ready()
+    await wait_for_nodes(count = options.nodes, timeout = 10)
+
+    lag : list[float] = []
+    lag_task = asyncio.create_task(watch_loop_lag(samples = lag))
+    stats = Stats()
+    drivers = [GuildDriver(discord = discord, recorder = recorder, guild = guild, options = options, stats = stats, rng = random.Random(rng.random())) for guild in guilds]
+
+    async def kill_node():
+        await asyncio.sleep(options.kill_node_after)
+        await lavalinks[0].disconnect()
+    killer = asyncio.create_task(kill_node()) if options.kill_node_after is not None else None
+
+    start = monotonic()
+    await asyncio.gather(*[driver.run() for driver in drivers])
+    duration = monotonic() - start
+
+    if killer is not None:
+        killer.cancel()
+    lag_task.cancel()
+    await bot.remove_cog(cog.qualified_name)
+    await wavelink.Pool.close()
+    for lavalink in lavalinks:
+        await lavalink.close()
+    directory.cleanup()
+
+    return {
+        "guilds" : options.guilds,
+        "duration_s" : duration,
+        "operations" : summarize(stats = stats, duration = duration),
+        "loop_lag_mean_s" : sum(lag) / len(lag) if lag else 0.0,
+        "loop_lag_p99_s" : percentile(lag, 0.99),
+        "discord_requests" : dict(discord.requests),
+        "lavalink_requests" : {route : sum(lavalink.requests.get(route, 0) for lavalink in lavalinks) for route in set().union(*[lavalink.requests for lavalink in lavalinks])},
+    }
+
+# ---------------------- REPORT --------------------------#
+def print_level(result : dict):
+    print(f"\n{result['guilds']} guilds in {result['duration_s']:.1f} s, event loop lag mean {result['loop_lag_mean_s'] * 1000:.1f} ms p99 {result['loop_lag_p99_s'] * 1000:.1f} ms")
+    for operation, summary in result["operations"].items():
+        print(f"  {operation:<10} {summary['count']:6d} ok {summary['failed']:5d} failed  p50 {summary['p50_s'] * 1000:8.1f} ms  p99 {summary['p99_s'] * 1000:8.1f} ms  max {summary['max_s'] * 1000:8.1f} ms  {summary['per_s']:8.1f}/s")
+    print(f"  Discord calls {sum(result['discord_requests'].values())}, Lavalink calls {sum(result['lavalink_requests'].values())}")
+
+def run_level_quietly(options : LoadOptions, lavalink_config : FakeLavalinkConfig, verbose : bool) -> dict:
+    """Entry point of the process of one concurrency level"""
+    if verbose:
+        return asyncio.run(run_level(options = options, lavalink_config = lavalink_config))
+
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        return asyncio.run(run_level(options = options, lavalink_config = lavalink_config))
+
+def run_in_process(options : LoadOptions, lavalink_config : FakeLavalinkConfig, verbose : bool) -> dict:
+    # Spawned, not forked: the cog's singletons start empty for every level
+    with multiprocessing.get_context("spawn").Pool(processes = 1) as pool:
+        return pool.apply(run_level_quietly, (options, lavalink_config, verbose))
+
+def get_options(args : argparse.Namespace, guilds : int) -> LoadOptions:
+    return LoadOptions(
+        guilds = guilds, users = args.users, searches = args.searches, skips = args.skips, playlist_length = args.playlist_length,
+        think = args.think, ramp = args.ramp, timeout = args.timeout, discord_latency = args.discord_latency, discord_jitter = args.discord_jitter,
+        discord_error_rate = args.discord_error_rate, nodes = args.nodes, kill_node_after = args.kill_node_after, seed = args.seed,
+    )
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = "Load tests the music cog against fake Discord and Lavalink")
+    parser.add_argument("--guilds", type = int, nargs = "+", default = [10, 100, 1000], help = "concurrency levels, guilds active at once (default 10 100 1000)")
+    parser.add_argument("--users", type = int, default = 2)
+    parser.add_argument("--searches", type = int, default = 3)
+    parser.add_argument("--skips", type = int, default = 3)
+    parser.add_argument("--playlist-length", type = int, default = 50)
+    parser.add_argument("--think", type = float, default = 0.2, help = "up to this many seconds between the steps of a guild")
+    parser.add_argument("--ramp", type = float, default = 1.0, help = "guilds start within this many seconds")
+    parser.add_argument("--timeout", type = float, default = 30.0, help = "seconds a step may take before it counts as failed")
+    parser.add_argument("--discord-latency", type = float, default = 0.05)
+    parser.add_argument("--discord-jitter", type = float, default = 0.02)
+    parser.add_argument("--discord-error-rate", type = float, default = 0.0)
+    parser.add_argument("--nodes", type = int, default = 1, help = "fake Lavalink nodes")
+    parser.add_argument("--kill-node-after", type = float, help = "seconds after the start before the first node drops its websocket")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", help = "write the results as JSON to this file")
+    parser.add_argument("--verbose", action = "store_true", help = "show the bot's output")
+    add_config_arguments(parser)
+    parser.set_defaults(track_seconds = 600.0)
+    args = parser.parse_args()
+
+    results = []
+    for guilds in args.guilds:
+        result = run_in_process(options = get_options(args = args, guilds = guilds), lavalink_config = get_config(args = args), verbose = args.verbose)
+        print_level(result = result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"options" : asdict(get_options(args = args, guilds = 0)), "lavalink" : asdict(get_config(args = args)), "levels" : results}, f, indent = 2)
+
+    return 1 if any(summary["failed"] for result in results for summary in result["operations"].values()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""Microbenchmarks of the hot paths of the bot. Run from the repository root:
+
+    python -m benchmarks.run [--quick] [--filter queue] [--output results.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+from time import time
+
+from benchmarks import bench_database, bench_menu, bench_queue, bench_utils
+from benchmarks.harness import Result, Scenario, measure
+
+MODULES = [bench_queue, bench_menu, bench_utils, bench_database]
+
+def get_scenarios(quick : bool, filter : str = None) -> list[Scenario]:
+    scenarios = [scenario for module in MODULES for scenario in module.get_scenarios(quick = quick)]
+    if filter:
+        scenarios = [scenario for scenario in scenarios if filter in scenario.name]
+    return scenarios
+
+def compare(results : list[dict], baseline : list[dict], threshold : float) -> list[str]:
+    """Returns the keys whose median got slower than the baseline by more than threshold (0.1 = 10%)"""
+    previous = {result["key"] : result for result in baseline}
+    regressions = []
+
+    for result in results:
+        old = previous.get(result["key"])
+        if old is None:
+            continue
+
+        change = result["median_s"] / old["median_s"] - 1 if old["median_s"] > 0 else 0.0
+        result["baseline_median_s"] = old["median_s"]
+        result["change"] = change
+        if change > threshold:
+            regressions.append(result["key"])
+
+    return regressions
+
+def print_result(result : dict):
+    change = f" {result['change']:+7.1%}" if "change" in result else ""
+    print(f"{result['key']:<70} median {result['median_s'] * 1000:10.3f} ms  per op {result['median_per_op_s'] * 1e6:10.3f} us{change}")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = "Runs the microbenchmarks")
+    parser.add_argument("--quick", action = "store_true", help = "smaller sizes and fewer repeats, for a quick check")
+    parser.add_argument("--filter", help = "only run scenarios whose name contains this")
+    parser.add_argument("--repeat", type = int, help = "override the number of repeats of every scenario")
+    parser.add_argument("--output", help = "write the results as JSON to this file")
+    parser.add_argument("--baseline", help = "JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "slowdown over the baseline reported as a regression, 0.1 = 10%% (default)")
+    args = parser.parse_args()
+
+    # Same shuffles and generated data on every run
+    random.seed(0)
+
+    results = []
+    for scenario in get_scenarios(quick = args.quick, filter = args.filter):
+        result : Result = measure(scenario = scenario, repeat = args.repeat or (2 if args.quick else None))
+        results.append(result.to_dict())
+        if not args.baseline:
+            print_result(results[-1])
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results = results, baseline = json.load(file)["results"], threshold = args.threshold)
+        for result in results:
+            print_result(result)
+
+    if args.output:
+        report = {
+            "created_at" : int(time()),
+            "python" : sys.version.split()[0],
+            "platform" : platform.platform(),
+            "quick" : args.quick,
+            "results" : results,
+        }
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent = 2)
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold:.0%}: " + ", ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,42 @@
+import os
 from pathlib import Path
 
 import discord
 from discord.ext import commands
 
+def get_intents() -> discord.Intents:
+    """Only what the music bot reads: its channel's messages and voice states (button presses need no intent)"""
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.message_content = True
+    intents.voice_states = True
+    return intents
+
+def get_memory_usage() -> int:
+    """Resident memory of the process, in bytes"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 class Bot(commands.Bot):
     def __init__(self):
         self.prefix = "!"
-        super().__init__(command_prefix = self.prefix, case_insensitive = True, intents = discord.Intents.all())
+        intents = get_intents()
+        super().__init__(
+            command_prefix = self.prefix, 
+            case_insensitive = True, 
+            intents = intents,
+            # Only members sitting in a voice channel are cached, menu presses arrive as interactions so no message cache is needed
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents),
+            max_messages = None,
+            chunk_guilds_at_startup = False
+        )
 
     async def setup_hook(self):
-        import os
         for filename in os.listdir("./cogs"):
             if filename.endswith(".py"):
                 cog_name = f"cogs.{filename[:-3]}"
@@ -19,3 +46,7 @@ class Bot(commands.Bot):
     async def on_ready(self):
         self.client_id = (await self.application_info()).id
         print("Bot is ready")
+
+        memory = get_memory_usage()
+        guilds = max(1, len(self.guilds))
+        print(f"Memory : {memory / 2**20:.1f} MiB for {len(self.guilds)} guilds ({memory / guilds / 2**10:.1f} KiB per guild)")
@@ -1,22 +1,47 @@
-from dataclasses import dataclass
+import asyncio
+from collections import OrderedDict
+from contextlib import aclosing
+from dataclasses import dataclass, field
 from datetime import timedelta
-from time import time
-from typing import Callable
+from time import monotonic
+from types import MethodType
+from typing import Any, Callable, Hashable
 
-from discord import Message, Reaction, TextChannel, Member
+from discord import Interaction, Message, TextChannel, Member
+import wavelink
 
 from cogs.music.commands import commands, Command
-from cogs.music.database import Database
+from cogs.music.database import Database, PlaylistSong, StoredTrack
+from cogs.music.dispatch import Check, Handler, Registry, Source
 from cogs.music.logger import Logger
+from cogs.music.metrics import metrics
+from cogs.music.profiler import profiler
 from cogs.music.menus.menu import Menu
 from cogs.music.menus.player_menu import PlayerMenu
-from config import SELECTION_WAIT_TIME
+from cogs.music.scheduler import Priority, scheduler
+from cogs.music.utils import get_custom_id, is_playlist_url, responding
+from config import MAX_SESSIONS, PLAYLIST_IMPORT_CHUNK, PLAYLIST_RESOLVE_CONCURRENCY, SESSION_IDLE_TIMEOUT
+
+SESSION_MENU_NAME = "session"
+
+HANDLER_LATENCY = metrics.histogram(name = "musicbot_handler_seconds", help = "Time spent handling one message or menu interaction, per state function", label = "state")
+
+# What each command of the command menu and each player button does, filled by the register decorators below
+COMMAND_HANDLERS = Registry(name = "command")
+BUTTON_HANDLERS = Registry(name = "player")
+
+ADD_SONG_HEADER = "Select **Playlist** to add song to:"
+REMOVE_SONG_HEADER = "Select **Playlist** to delete song from:"
 
 @dataclass
-class Request:
+class Session:
+    """Where one user is in a command, with their own selection menu and search results"""
     author_id : int
-    state_function : Callable[[Reaction, Message, Member], None]
-    state_value : str
+    state_function : Callable[[Interaction, Message, Member], None]
+    state_value : Any # What the next state needs: a playlist name, the track to add or remove...
+    menu : Menu
+    searched_tracks : list = None
+    last_used : float = field(default_factory = monotonic)
 
 class Control:
     def __init__(self, text_channel : TextChannel, database : Database, logger : Logger):
@@ -26,491 +51,683 @@ class Control:
         self.__text_channel : TextChannel = text_channel
         self.__comand_menu : Menu = Menu(
             text_channel = text_channel,
-            options = [command.description for command in commands],
-            fixed = True
+            name = "command",
+            options = [command.description for command in commands]
         )
         self.__selection_menu : Menu = Menu(
             text_channel = text_channel,
-            default_message = "> Select a command above."
+            name = "selection",
+            default_message = "> Select a command above, your options are only shown to you."
         )
         self.__player_menu = PlayerMenu(text_channel = text_channel)
 
-        self.__requests : dict[int, Request] = {}
-        self.__active_author_id : int = 0
-        self.__active_author_timestamp : int = 0
-        self.__start_function  : Callable[[Reaction, Message, Member], None] = self.__command_selection
-        self.__searched_tracks : list = None
-
-    async def setup(self):
-        await self.__comand_menu.display()
-        await self.__selection_menu.display()
-        await self.__player_menu.display()
+        # Least recently used first
+        self.__sessions : OrderedDict[int, Session] = OrderedDict()
+        # Pasted playlists still being queued, kept here so they are not garbage collected
+        self.__imports : set[asyncio.Task] = set()
+        self.__start_function  : Callable[[Interaction, Message, Member], None] = self.__command_selection
+
+    async def setup(self, messages : list[Message] = None):
+        """Sends the menus, or reattaches to messages (command, selection, player) left by a previous run"""
+        if messages is None:
+            await self.__comand_menu.display()
+            await self.__selection_menu.display()
+            await self.__player_menu.display()
+        else:
+            command_message, selection_message, player_message = messages
+            await self.__comand_menu.attach(message = command_message)
+            await self.__selection_menu.attach(message = selection_message)
+            await self.__player_menu.attach(message = player_message)
 
         self.__initialized = True
 
-    def reacted_to_me(self, reaction : Reaction) -> bool:
+    def get_menu_message_ids(self) -> tuple[int, int, int]:
+        return self.__comand_menu.get_message_id(), self.__selection_menu.get_message_id(), self.__player_menu.get_message_id()
+
+    def interacted_with_me(self, interaction : Interaction) -> bool:
         if not self.__initialized:
             return False
         
-        return self.__comand_menu.reacted_to_me(reaction = reaction) or self.__selection_menu.reacted_to_me(reaction = reaction) or self.__player_menu.reacted_to_me(reaction = reaction)
-    
-    async def __make_selection_request(self, author_id : int, options : list[str], header : str = "") -> bool:
-        if author_id == self.__active_author_id:
-            self.__selection_menu.change_options(options = options)
-            await self.__selection_menu.display(header = header)
-            return True
-        
-        if time() - self.__active_author_timestamp < SELECTION_WAIT_TIME:
-            return False
-        
-        self.__selection_menu.change_options(options = options)
-        await self.__selection_menu.display(header = header)
-        
-        self.__active_author_id = author_id
-        self.__active_author_timestamp = time()
-        
-        return True
+        return self.__comand_menu.interacted_with_me(interaction = interaction) or self.__is_session_interaction(interaction = interaction) or self.__player_menu.interacted_with_me(interaction = interaction)
+
+    @staticmethod
+    def __is_session_interaction(interaction : Interaction) -> bool:
+        return get_custom_id(interaction = interaction).startswith(f"music:{SESSION_MENU_NAME}:")
+
+    def __get_session(self, author_id : int) -> Session:
+        self.__expire_sessions()
+
+        session = self.__sessions.get(author_id)
+        if session is None:
+            session = Session(author_id = author_id, state_function = self.__start_function, state_value = "", menu = Menu(
+                text_channel = self.__text_channel,
+                name = SESSION_MENU_NAME,
+                ephemeral = True
+            ))
+            self.__sessions[author_id] = session
+            if len(self.__sessions) > MAX_SESSIONS:
+                self.__sessions.popitem(last = False)
+        else:
+            self.__sessions.move_to_end(author_id)
+            session.last_used = monotonic()
+
+        return session
+
+    def __expire_sessions(self):
+        deadline = monotonic() - SESSION_IDLE_TIMEOUT
+        while self.__sessions:
+            author_id, session = next(iter(self.__sessions.items()))
+            if session.last_used > deadline:
+                break
+            del self.__sessions[author_id]
+
+    def get_session_count(self) -> int:
+        return len(self.__sessions)
+
+    def get_queue_length(self) -> int:
+        return self.__player_menu.get_queue_length()
     
-    async def __reset_selection(self):
-        self.__selection_menu.change_options(options = [])
-        await self.__selection_menu.display()
-        self.__active_author_id = 0
-        self.__active_author_timestamp = 0
-        self.__searched_tracks = None
+    async def __delete_message(self, message : Message):
+        # Users' messages are housekeeping, they must not delay any menu update
+        await scheduler.delete(message = message, priority = Priority.CLEANUP, wait = False)
+
+    async def __make_selection_request(self, session : Session, options : list[str], header : str = "", interaction : Interaction = None):
+        session.menu.change_options(options = options)
+        await session.menu.display(header = header, interaction = interaction)
+
+    async def __close_session(self, session : Session, interaction : Interaction = None):
+        session.menu.change_options(options = [])
+        await session.menu.display(header = "> Done, select another command above.", interaction = interaction)
+        self.__sessions.pop(session.author_id, None)
 
     async def song_ended_notification(self):
         await self.__player_menu.play_next_track()
 
+    async def player_moved_notification(self):
+        await self.__player_menu.resume_stalled()
+
+    async def restore_queue(self, voice_channel_id : int, encoded : list[str], index : int, position : int) -> bool:
+        if not self.__initialized:
+            return False
+
+        return await self.__player_menu.restore(voice_channel_id = voice_channel_id, encoded = encoded, index = index, position = position)
+
     
-    async def process_input(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+    async def process_input(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if not self.__initialized:
             if message:
-                await message.delete()
+                await self.__delete_message(message = message)
             return
         
-        assert reaction or message, "[ERROR] Control - Process Input - Did not receive either reaction or message."
+        assert interaction or message, "[ERROR] Control - Process Input - Did not receive either interaction or message."
 
         author_id = message.author.id if message else user.id
 
         if message and message.channel.id != self.__text_channel.id:
             return
 
-        if reaction and self.__player_menu.reacted_to_me(reaction = reaction):
-            return await self.__player_reaction(reaction = reaction, user = user)
-
-        if author_id not in self.__requests:
-            self.__requests[author_id] = Request(author_id = author_id, state_function = self.__start_function, state_value = "")
-
-        return await self.__requests[author_id].state_function(reaction = reaction, message = message, user = user)
+        if interaction and self.__player_menu.interacted_with_me(interaction = interaction):
+            state = f"player:{self.__player_menu.get_action(interaction = interaction)}"
+            with HANDLER_LATENCY.time(state):
+                return await profiler.run(guild_id = self.__text_channel.guild.id, state = state, handler = self.__player_interaction(interaction = interaction, user = user))
+
+        self.__expire_sessions()
+        if interaction and self.__is_session_interaction(interaction = interaction) and author_id not in self.__sessions:
+            async with responding(interaction = interaction) as unanswered:
+                if unanswered:
+                    return await interaction.response.edit_message(content = "> This menu has expired, select a command above.", view = None)
+            return await interaction.edit_original_response(content = "> This menu has expired, select a command above.", view = None)
+
+        session = self.__get_session(author_id = author_id)
+        state = session.state_function.__name__.strip("_")
+        with HANDLER_LATENCY.time(state):
+            return await profiler.run(guild_id = self.__text_channel.guild.id, state = state, handler = session.state_function(interaction = interaction, message = message, user = user))
     
-    async def __command_selection(self, reaction : Reaction = None, message : Message = None, user : Member = None):
-        # Command select must receive a reaction, not a message
+    async def __command_selection(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        # Command select must receive an interaction, not a message
         if message:
-            return await message.delete()
+            return await self.__delete_message(message = message)
         
         # Must click on the command menu not on selection
-        if not self.__comand_menu.reacted_to_me(reaction = reaction):
+        if not self.__comand_menu.interacted_with_me(interaction = interaction):
             return
 
-        index = await self.__comand_menu.get_selection(reaction = reaction)
+        index = await self.__comand_menu.get_selection(interaction = interaction)
 
         if index == -1:
             return   
         
-        command_info = commands[index]
-        command = command_info.command
-
-        if command is Command.CREATE_PLAYLIST:
-            self.__requests[user.id].state_function = self.__create_playlist
-            return await self.__logger.send(text = f"<@{user.id}> What is the name of the playlist?")
-        
-        if command is Command.DELETE_PLAYLIST:
-            playlists = self.__database.get_playlists(author_id = user.id)
-
-            if len(playlists) == 0:
-                self.__requests[user.id].state_function = self.__start_function
-                return await self.__logger.send(f"<@{user.id}>  You have no playlists.")
-            
-            playlist_names = [playlist.name for playlist in playlists]
-
-            allowed = await self.__make_selection_request(author_id = user.id, options = playlist_names, header = f"<@{user.id}> Select **Playlist** to delete:")
-
-            if not allowed:
-                self.__requests[user.id].state_function = self.__start_function
-                return            
-            
-            self.__requests[user.id].state_function = self.__delete_playlist
-            return
-        
-        if command is Command.RENAME_PLAYLIST:
-            playlists = self.__database.get_playlists(author_id = user.id)
-
-            if len(playlists) == 0:
-                self.__requests[user.id].state_function = self.__start_function
-                return await self.__logger.send(f" <@{user.id}> You have no playlists.")
-            
-            playlist_names = [playlist.name for playlist in playlists]
-
-            allowed = await self.__make_selection_request(author_id = user.id, options = playlist_names, header = f"<@{user.id}> Select **Playlist** to rename:")
-
-            if not allowed:
-                self.__requests[user.id].state_function = self.__start_function
-                return            
-            
-            self.__requests[user.id].state_function = self.__rename_playlist_select
-            return
-        
-        if command is Command.SEARCH:
-            allowed = await self.__make_selection_request(author_id = user.id, options = [])
-            if not allowed:
-                self.__requests[user.id].state_function = self.__start_function
-                return
-            
-            await self.__logger.send(text = f"<@{user.id}>  What song do you want to search for?")
-            self.__requests[user.id].state_function = self.__query_search_song
-            return
-
-        if command is Command.PLAY_PLAYLIST:
-            playlists = self.__database.get_playlists(author_id = user.id)
-
-            if len(playlists) == 0:
-                self.__requests[user.id].state_function = self.__start_function
-                return await self.__logger.send(f"<@{user.id}>  You have no playlists.")
-            
-            playlist_names = [playlist.name for playlist in playlists]
+        return await self.__start(registry = COMMAND_HANDLERS, key = commands[index].command, interaction = interaction, user = user)
 
-            allowed = await self.__make_selection_request(author_id = user.id, options = playlist_names, header = f"<@{user.id}> Select **Playlist** to play:")
-
-            if not allowed:
-                self.__requests[user.id].state_function = self.__start_function
-                return            
-            
-            self.__requests[user.id].state_function = self.__play_playlist
+    async def __start(self, registry : Registry, key : Hashable, interaction : Interaction, user : Member):
+        """Runs the handler of a command or button once its checks pass, or first asks the user for what it needs"""
+        handler = registry.get(key)
+        if handler is None:
             return
 
-        print(f"Implement me at command selection state for command : {command}")
-
-    async def __create_playlist(self, reaction : Reaction = None, message : Message = None, user : Member = None):
-        if reaction:
-            if self.__comand_menu.reacted_to_me(reaction = reaction):
-                self.__requests[user.id].state_function = self.__command_selection
-                return await self.__requests[user.id].state_function(reaction = reaction, message = message, user = user)
+        with registry.count(key) as stats:
+            error = self.__check(handler = handler, user = user)
+            playlists = []
+            if error is None and handler.source is Source.PLAYLISTS:
+                playlists = await self.__database.get_playlists(author_id = user.id)
+                if len(playlists) < handler.min_playlists:
+                    error = "You have no playlists." if handler.min_playlists == 1 else f"You need at least {handler.min_playlists} playlists."
+
+            if error is not None:
+                stats.rejected += 1
+                return await self.__logger.send(text = f"<@{user.id}> {error}")
+
+            if handler.source is Source.NONE:
+                return await handler.function(self, interaction = interaction, user = user)
+
+            session = self.__get_session(author_id = user.id)
+            session.state_function = MethodType(handler.function, self)
+            if Check.TRACK in handler.checks:
+                session.state_value = self.__player_menu.get_current_track()
+            await self.__make_selection_request(session = session, options = [playlist.name for playlist in playlists], header = handler.header, interaction = interaction)
+
+    def __check(self, handler : Handler, user : Member) -> str:
+        """Returns why handler cannot run for user, or None"""
+        for check in handler.checks:
+            if check is Check.SAME_VOICE_CHANNEL:
+                voice_channel = self.__player_menu.get_voice_channel()
+                if voice_channel is None:
+                    return "Nothing is playing."
+                if not getattr(user.voice, 'channel', None):
+                    return "You are not in a voice channel."
+                if user.voice.channel.id != voice_channel.id:
+                    return "You are not in the same voice channel as me."
+
+            elif check is Check.TRACK and self.__player_menu.get_current_track() is None:
+                return "Not playing anything."
+
+            elif check is Check.SESSION_TRACKS and len(self.__get_session_tracks()) == 0:
+                return "Nothing to save, the queue is empty."
+
+        return None
+
+    @COMMAND_HANDLERS.register(Command.CREATE_PLAYLIST, source = Source.PROMPT, header = "> What is the name of the playlist? Type it in this channel.")
+    async def __create_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if interaction:
+            if self.__comand_menu.interacted_with_me(interaction = interaction):
+                self.__sessions[user.id].state_function = self.__command_selection
+                return await self.__sessions[user.id].state_function(interaction = interaction, message = message, user = user)
             return            
         
         playlist_name = message.content
-        await message.delete()
+        await self.__delete_message(message = message)
 
-        db_response = self.__database.create_playlist(playlist_name = playlist_name, author_id = message.author.id)
+        db_response = await self.__database.create_playlist(playlist_name = playlist_name, author_id = message.author.id)
 
-        del self.__requests[message.author.id]      
+        await self.__close_session(session = self.__sessions[message.author.id])
             
         return await self.__logger.send(db_response.message)
     
-    async def __delete_playlist(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+    @COMMAND_HANDLERS.register(Command.DELETE_PLAYLIST, source = Source.PLAYLISTS, header = "Select **Playlist** to delete:")
+    async def __delete_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if message:
-            return await message.delete()
+            return await self.__delete_message(message = message)
         
-        self.__requests[user.id].state_function = self.__start_function
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
 
-        if user.id != self.__active_author_id:
-            return
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        if self.__comand_menu.reacted_to_me(reaction = reaction):
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
-        
-        option_index = await self.__selection_menu.get_selection(reaction = reaction)
+        option_index = await session.menu.get_selection(interaction = interaction)
         if option_index == -1:
+            session.state_function = self.__delete_playlist
             return
         
-        playlist_name = self.__selection_menu.get_option(index = option_index)
+        playlist_name = session.menu.get_option(index = option_index)
 
-        response = self.__database.delete_playlist(author_id = user.id, playlist_name = playlist_name)
+        response = await self.__database.delete_playlist(author_id = user.id, playlist_name = playlist_name)
         await self.__logger.send(text = response.message)
 
-        del self.__requests[user.id]
-
-        return await self.__reset_selection()
+        return await self.__close_session(session = session, interaction = interaction)
     
-    async def __rename_playlist_select(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+    @COMMAND_HANDLERS.register(Command.RENAME_PLAYLIST, source = Source.PLAYLISTS, header = "Select **Playlist** to rename:")
+    async def __rename_playlist_select(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if message:
-            return await message.delete()
+            return await self.__delete_message(message = message)
         
-        self.__requests[user.id].state_function = self.__start_function
-    
-        if user.id != self.__active_author_id:
-            return
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
         
-        if self.__comand_menu.reacted_to_me(reaction = reaction):
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        option_index = await self.__selection_menu.get_selection(reaction = reaction)
+        option_index = await session.menu.get_selection(interaction = interaction)
         if option_index == -1:
+            session.state_function = self.__rename_playlist_select
             return
         
-        playlist_name = self.__selection_menu.get_option(index = option_index)
-        self.__requests[user.id].state_value = playlist_name
+        playlist_name = session.menu.get_option(index = option_index)
+        session.state_value = playlist_name
+        session.state_function = self.__rename_playlist
 
-        self.__requests[user.id].state_function = self.__rename_playlist
-
-        await self.__logger.send(text = f"<@{user.id}> What should **{playlist_name}** be renamed to?")
-        return await self.__reset_selection()
+        return await self.__make_selection_request(session = session, options = [], header = f"> What should **{playlist_name}** be renamed to? Type it in this channel.", interaction = interaction)
     
-    async def __rename_playlist(self, reaction : Reaction = None, message : Message = None, user : Member = None):
-        if reaction:
-            self.__requests[user.id].state_function = self.__start_function
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+    async def __rename_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if interaction:
+            self.__sessions[user.id].state_function = self.__start_function
+            return await self.__sessions[user.id].state_function(message = message, interaction = interaction, user = user)
         
         new_name = message.content
-        await message.delete()
-        old_name = self.__requests[message.author.id].state_value
+        await self.__delete_message(message = message)
+        session = self.__sessions[message.author.id]
+        old_name = session.state_value
 
-        db_response = self.__database.rename_playlist(author_id = message.author.id, old_name = old_name, new_name = new_name)
+        db_response = await self.__database.rename_playlist(author_id = message.author.id, old_name = old_name, new_name = new_name)
 
-        del self.__requests[message.author.id]
+        await self.__close_session(session = session)
 
         return await self.__logger.send(text = db_response.message)
     
-    async def __query_search_song(self, reaction : Reaction = None, message : Message = None, user : Member = None):
-        if reaction:
-            self.__requests[user.id].state_function = self.__start_function
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+    @COMMAND_HANDLERS.register(Command.SEARCH, source = Source.PROMPT, header = "> What song do you want to search for? Type it in this channel.")
+    async def __query_search_song(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if interaction:
+            self.__sessions[user.id].state_function = self.__start_function
+            return await self.__sessions[user.id].state_function(message = message, interaction = interaction, user = user)
         
         search_query = message.content
+        session = self.__sessions[message.author.id]
         
         # Garbage fix
         try:
-            await message.delete()
+            await self.__delete_message(message = message)
         except:
             pass
 
+        if is_playlist_url(search_query):
+            playlist = await self.__player_menu.load_playlist(url = search_query)
+            if playlist is not None and len(playlist) > 0:
+                return await self.__offer_playlist_import(session = session, playlist = playlist, user = message.author)
+
         tracks = await self.__player_menu.search_query(query = search_query)
 
         if len(tracks) == 0:
-            self.__requests[user.id].state_function = self.__start_function
-            return await self.__logger.send(text = f"<@{message.author.id}>  Did not find any songs that match your query.")
+            return await self.__make_selection_request(session = session, options = [], header = "> Did not find any songs that match your query, try another one.")
         
         options = [track.title for track in tracks]
-        self.__searched_tracks = tracks   
+        session.searched_tracks = tracks
 
-        allowed = await self.__make_selection_request(author_id = message.author.id, options = options,  header = f"<@{message.author.id}> Select **Song** to play:")
-        if not allowed:
-            self.__requests[message.author.id].state_function = self.__start_function
-            return
-        
-        self.__requests[message.author.id].state_function = self.__select_song
-        return
+        await self.__make_selection_request(session = session, options = options, header = "Select **Song** to play:")
+        session.state_function = self.__select_song
     
-    async def __select_song(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+    async def __select_song(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if message:
-            return await message.delete()
+            # Typing again searches again
+            self.__sessions[message.author.id].state_function = self.__query_search_song
+            return await self.__query_search_song(message = message)
         
-        self.__requests[user.id].state_function = self.__start_function
-    
-        if user.id != self.__active_author_id:
-            return
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
         
-        if self.__comand_menu.reacted_to_me(reaction = reaction):
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        option_index = await self.__selection_menu.get_selection(reaction = reaction)
+        option_index = await session.menu.get_selection(interaction = interaction)
         if option_index == -1:
+            session.state_function = self.__select_song
             return
         
-        track = self.__searched_tracks[option_index]
+        track = session.searched_tracks[option_index]
+        await self.__close_session(session = session, interaction = interaction)
 
         queued = await self.__player_menu.queue_track(track = track, user = user)
-        await self.__logger.send(text = f"<@{user.id}>  Added song to queue." if queued else f"<@{user.id}>  Join a voice channel")
+        return await self.__logger.send(text = f"<@{user.id}>  Added song to queue." if queued else f"<@{user.id}>  Join a voice channel")
 
-        return await self.__reset_selection()
 
+    async def __offer_playlist_import(self, session : Session, playlist : wavelink.Playlist, user : Member):
+        # Names are limited to 30 characters like the ones typed when creating a playlist
+        name = playlist.name[:30]
+        playlist_names = [saved.name for saved in await self.__database.get_playlists(author_id = user.id)]
 
-    async def __player_reaction(self, reaction : Reaction = None, user : Member = None):
-        if reaction.emoji not in self.__player_menu.get_reactions():
-            return
+        # A video opened from a playlist or a mix comes with the whole list, the video itself is offered first
+        selected = playlist.tracks[playlist.selected] if 0 <= playlist.selected < len(playlist) else None
+
+        session.searched_tracks = playlist.tracks
+        session.state_value = (name, playlist_names, selected)
+        session.state_function = self.__import_playlist
+
+        options = [f"Play {len(playlist)} songs.", f"Play and save as new playlist {name}."] + [f"Play and add to {playlist_name}." for playlist_name in playlist_names]
+        if selected is not None:
+            options.insert(0, f"Play just {selected.title}.")
+        await self.__make_selection_request(session = session, options = options, header = f"Playlist **{playlist.name}** ({len(playlist)} songs):")
+
+    async def __import_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if message:
+            # Typing again searches again
+            self.__sessions[message.author.id].state_function = self.__query_search_song
+            return await self.__query_search_song(message = message)
         
-        voice_channel = self.__player_menu.get_voice_channel()
-        if voice_channel is None:
-            return await self.__logger.send(text = f"<@{user.id}> Nothing is playing.")
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
         
-        if not getattr(user.voice, 'channel', None):
-            return await self.__logger.send(text = f"<@{user.id}> You are not in a voice channel.")
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        if user.voice.channel.id != voice_channel.id:
-            return await self.__logger.send(text = f"<@{user.id}> You are not in the same voice channel as me.")
+        option_index = await session.menu.get_selection(interaction = interaction)
+        if option_index == -1:
+            session.state_function = self.__import_playlist
+            return
         
-        if reaction.emoji == "⏮":
-            return await self.__player_menu.previous()
+        tracks = session.searched_tracks
+        name, playlist_names, selected = session.state_value
+        if selected is not None:
+            if option_index == 0:
+                await self.__close_session(session = session, interaction = interaction)
+                queued = await self.__player_menu.queue_track(track = selected, user = user)
+                return await self.__logger.send(text = f"<@{user.id}>  Added song to queue." if queued else f"<@{user.id}>  Join a voice channel")
+            option_index -= 1
+
+        # First option only plays, the second saves into a new playlist, the others add to an existing one
+        save_to = None if option_index == 0 else name if option_index == 1 else playlist_names[option_index - 2]
+        await self.__close_session(session = session, interaction = interaction)
+
+        # The first songs start playing before anything else is done
+        queued = await self.__player_menu.join_voice_channel(user = user) and await self.__player_menu.add_tracks(tracks = tracks[:PLAYLIST_IMPORT_CHUNK], requester_id = user.id)
+        if queued:
+            await self.__logger.send(text = f"<@{user.id}> Adding {len(tracks)} songs of **{name}** to the queue.")
+        else:
+            # Saving still goes on without playing
+            await self.__logger.send(text = f"<@{user.id}> Join a voice channel.")
+            if save_to is None:
+                return
+
+        task = asyncio.create_task(self.__import_tracks(tracks = tracks, user = user, queue = queued, save_to = save_to, create = option_index == 1))
+        self.__imports.add(task)
+        task.add_done_callback(self.__imports.discard)
+
+    async def __import_tracks(self, tracks : list, user : Member, queue : bool, save_to : str, create : bool):
+        """Saves a pasted playlist if asked and queues the rest of its songs chunk by chunk, the server's other commands run in between"""
+        # Nobody awaits this task, its failures would go unnoticed otherwise
+        try:
+            if save_to is not None:
+                stored_tracks = [StoredTrack.from_track(track = track) for track in tracks]
+                if create:
+                    response = await self.__database.save_playlist(tracks = stored_tracks, playlist_name = save_to, author_id = user.id)
+                else:
+                    response = await self.__database.add_songs_to_playlist(tracks = stored_tracks, playlist_name = save_to, author_id = user.id)
+                await self.__logger.send(text = f"<@{user.id}> {response.message}")
+
+            if not queue:
+                return
+
+            for start in range(PLAYLIST_IMPORT_CHUNK, len(tracks), PLAYLIST_IMPORT_CHUNK):
+                await asyncio.sleep(0)
+                # Playback was stopped while the playlist was still being queued
+                if not await self.__player_menu.add_tracks(tracks = tracks[start:start + PLAYLIST_IMPORT_CHUNK], requester_id = user.id):
+                    break
+        except Exception as e:
+            print(f"[DEBUG] Failed to import a playlist for {user.id} : {type(e).__name__} {e}")
+            await self.__logger.send(text = f"<@{user.id}> Something went wrong while importing the playlist.")
+
+    async def __player_interaction(self, interaction : Interaction = None, user : Member = None):
+        return await self.__start(registry = BUTTON_HANDLERS, key = self.__player_menu.get_action(interaction = interaction), interaction = interaction, user = user)
+
+    @BUTTON_HANDLERS.register("previous", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __previous(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        await self.__player_menu.previous(interaction = interaction)
+
+    @BUTTON_HANDLERS.register("pause", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __pause(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        await self.__player_menu.pause(interaction = interaction)
+
+    @BUTTON_HANDLERS.register("resume", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __resume(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        await self.__player_menu.resume(interaction = interaction)
+
+    @BUTTON_HANDLERS.register("skip", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __skip(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        await self.__player_menu.skip(interaction = interaction)
+
+    @BUTTON_HANDLERS.register("stop", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __stop(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        await self.__player_menu.stop(interaction = interaction)
+
+    @BUTTON_HANDLERS.register("restart", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __restart(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        await self.__player_menu.restart(interaction = interaction)
+
+    @BUTTON_HANDLERS.register("shuffle", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __shuffle(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        self.__player_menu.shuffle()
+        await self.__logger.send(text = f"<@{user.id}> Shuffled queue.")
+
+    @BUTTON_HANDLERS.register("info", checks = (Check.SAME_VOICE_CHANNEL, Check.TRACK))
+    async def __show_info(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        track = self.__player_menu.get_current_track()
+        await self.__logger.send(text = f"**Title : ** {track.title}\n**Author : ** {track.author}\n**Duration : ** {str(timedelta(milliseconds = track.length))}")
+
+    @COMMAND_HANDLERS.register(Command.HISTORY)
+    @BUTTON_HANDLERS.register("history", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __show_history(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        tracks = self.__player_menu.get_history_tracks()
+        if len(tracks) == 0:
+            return await self.__logger.send(text = f"<@{user.id}> No past songs to show.")
+
+        await self.__logger.send(text = "".join(f"> {track.title}\n" for track in reversed(tracks[-10:])))
+
+    @COMMAND_HANDLERS.register(Command.QUEUE)
+    @BUTTON_HANDLERS.register("queue", checks = (Check.SAME_VOICE_CHANNEL,))
+    async def __show_queue(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        tracks = self.__player_menu.get_queued_tracks()
+        if len(tracks) == 0:
+            return await self.__logger.send(text = f"<@{user.id}> No songs queued.")
 
-        if reaction.emoji == "⏸":
-            return await self.__player_menu.pause()
+        await self.__logger.send(text = "".join(f"{track.title}\n" for track in tracks[:10]))
+
+    @COMMAND_HANDLERS.register(Command.ADD_SONG_PLAYLIST, checks = (Check.TRACK,), source = Source.PLAYLISTS, header = ADD_SONG_HEADER)
+    @BUTTON_HANDLERS.register("add", checks = (Check.SAME_VOICE_CHANNEL, Check.TRACK), source = Source.PLAYLISTS, header = ADD_SONG_HEADER)
+    async def __add_song_to_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if message:
+            return await self.__delete_message(message = message)
         
-        if reaction.emoji == "▶":
-            return await self.__player_menu.resume()
+        session = self.__sessions[user.id]
         
-        if reaction.emoji =="⏭":
-            return await self.__player_menu.skip()
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            session.state_function = self.__start_function
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        if reaction.emoji =="⏹":
-            return await self.__player_menu.stop()
+        option_index = await session.menu.get_selection(interaction = interaction)
+        if option_index == -1:
+            return
         
-        if reaction.emoji =="🔄":
-            return await self.__player_menu.restart()
+        playlist_name = session.menu.get_option(index = option_index)
         
-        if reaction.emoji =="🔀":
-            self.__player_menu.shuffle()
-            return await self.__logger.send(text = f"<@{user.id}> Shuffled queue.")
+        response = await self.__database.add_song_to_playlist(autor_id = user.id, playlist_name = playlist_name, track = StoredTrack.from_track(track = session.state_value))
+        await self.__logger.send(text = response.message)
+
+        return await self.__close_session(session = session, interaction = interaction)
+    
+    @COMMAND_HANDLERS.register(Command.REMOVE_SONG_PLAYLIST, checks = (Check.TRACK,), source = Source.PLAYLISTS, header = REMOVE_SONG_HEADER)
+    @BUTTON_HANDLERS.register("remove", checks = (Check.SAME_VOICE_CHANNEL, Check.TRACK), source = Source.PLAYLISTS, header = REMOVE_SONG_HEADER)
+    async def __delete_song_from_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if message:
+            return await self.__delete_message(message = message)
         
-        if reaction.emoji =="❌":
-            playlists = self.__database.get_playlists(author_id = user.id)
+        session = self.__sessions[user.id]
+        
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            session.state_function = self.__start_function
+            return await session.state_function(message = message, interaction = interaction, user = user)
+        
+        option_index = await session.menu.get_selection(interaction = interaction)
+        if option_index == -1:
+            return
+        
+        playlist_name = session.menu.get_option(index = option_index)
+        
+        response = await self.__database.delete_song_from_playlist(autor_id = user.id, playlist_name = playlist_name, track_id = session.state_value.identifier)
+        await self.__logger.send(text = response.message)
 
-            if len(playlists) == 0:
-                return await self.__logger.send(f"<@{user.id}> You have no playlists.")
-            
-            playlist_names = [playlist.name for playlist in playlists]
+        return await self.__close_session(session = session, interaction = interaction)
+    
+    def __get_session_tracks(self) -> list:
+        """Returns every track of the current session: history, current and queued"""
+        current = self.__player_menu.get_current_track()
+        return self.__player_menu.get_history_tracks() + ([current] if current is not None else []) + self.__player_menu.get_queued_tracks()
 
-            allowed = await self.__make_selection_request(author_id = user.id, options = playlist_names, header = f"<@{user.id}> Select **Playlist** to delete song from:")
+    @COMMAND_HANDLERS.register(Command.SAVE_QUEUE_PLAYLIST, checks = (Check.SESSION_TRACKS,), source = Source.PROMPT, header = "> What is the name of the new playlist? Type it in this channel.")
+    async def __save_queue_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if interaction:
+            self.__sessions[user.id].state_function = self.__start_function
+            return await self.__sessions[user.id].state_function(message = message, interaction = interaction, user = user)
 
-            if not allowed:
-                return            
-            
-            track = self.__player_menu.get_current_track()
-            video_id = track.thumbnail.split("/")[-2]
-            self.__requests[user.id] = Request(author_id = user.id, state_function = self.__delete_song_from_playlist, state_value = video_id)
-            return
-        if reaction.emoji =="💿":
-            playlists = self.__database.get_playlists(author_id = user.id)
+        playlist_name = message.content
+        await self.__delete_message(message = message)
 
-            if len(playlists) == 0:
-                return await self.__logger.send(f"<@{user.id}> You have no playlists.")
-            
-            playlist_names = [playlist.name for playlist in playlists]
+        stored_tracks = [StoredTrack.from_track(track = track) for track in self.__get_session_tracks()]
+        response = await self.__database.save_playlist(tracks = stored_tracks, playlist_name = playlist_name, author_id = message.author.id)
 
-            allowed = await self.__make_selection_request(author_id = user.id, options = playlist_names, header = f"<@{user.id}> Select **Playlist** to add song to:")
+        await self.__close_session(session = self.__sessions[message.author.id])
 
-            if not allowed:
-                return            
-            
-            track = self.__player_menu.get_current_track()
-            video_id = track.thumbnail.split("/")[-2]
-            self.__requests[user.id] = Request(author_id = user.id, state_function = self.__add_song_to_playlist, state_value = video_id)
+        return await self.__logger.send(text = f"<@{message.author.id}> {response.message}")
+
+    @COMMAND_HANDLERS.register(Command.MERGE_PLAYLISTS, source = Source.PLAYLISTS, header = "Select **Playlist** to copy songs from:", min_playlists = 2)
+    async def __merge_playlists_select(self, interaction : Interaction = None, message : Message = None, user : Member = None):
+        if message:
+            return await self.__delete_message(message = message)
+        
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
+        
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
+        
+        option_index = await session.menu.get_selection(interaction = interaction)
+        if option_index == -1:
+            session.state_function = self.__merge_playlists_select
             return
         
-        if reaction.emoji =="ℹ️":
-            track = self.__player_menu.get_current_track()
-            if track is None:
-                return await self.__logger.send(text = f"<@{user.id}> Not playing anything.")
-            
-            message = f"**Title : ** {track.title}\n**Author : ** {track.author}\n**Duration : ** {str(timedelta(milliseconds = track.length))}"
-            return await self.__logger.send(text = message)
-        
-        if reaction.emoji == "🇭":
-            tracks = self.__player_menu.get_history_tracks()
-            if len(tracks) == 0:
-                return await self.__logger.send(text = f"<@{user.id}> No past songs to show.")
-            tracks = reversed(tracks[-10:])
-            message = ""
-            for track in tracks:
-                message += f"> {track.title}\n"
-            return await self.__logger.send(text = message)
-
-        if reaction.emoji == "🇶":
-            tracks = self.__player_menu.get_queued_tracks()
-            if len(tracks) == 0:
-                return await self.__logger.send(text = f"<@{user.id}> No songs queued.")
-            tracks = tracks[:10]
-            message = ""
-            for track in tracks:
-                message += f"{track.title}\n"
-            return await self.__logger.send(text = message)
-
-    async def __add_song_to_playlist(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+        source_name = session.menu.get_option(index = option_index)
+        playlist_names = [name for name in session.menu.options if name != source_name]
+
+        session.state_value = source_name
+        session.state_function = self.__merge_playlists
+        await self.__make_selection_request(session = session, options = playlist_names, header = f"Select **Playlist** to add the songs of **{source_name}** to:", interaction = interaction)
+
+    async def __merge_playlists(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if message:
-            return await message.delete()
+            return await self.__delete_message(message = message)
         
-        if user.id != self.__active_author_id:
-            self.__requests[user.id].state_function = self.__start_function
-            return
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
         
-        if self.__comand_menu.reacted_to_me(reaction = reaction):
-            await self.__reset_selection()
-            self.__requests[user.id].state_function = self.__start_function
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        option_index = await self.__selection_menu.get_selection(reaction = reaction)
+        option_index = await session.menu.get_selection(interaction = interaction)
         if option_index == -1:
+            session.state_function = self.__merge_playlists
             return
         
-        playlist_name = self.__selection_menu.get_option(index = option_index)
-        video_id = self.__requests[user.id].state_value
-        
-        response = self.__database.add_song_to_playlist(autor_id = user.id, playlist_name = playlist_name, video_id = video_id)
-        await self.__logger.send(text = response.message)
+        target_name = session.menu.get_option(index = option_index)
+        source_name = session.state_value
 
-        del self.__requests[user.id]
+        response = await self.__database.merge_playlists(source_name = source_name, target_name = target_name, author_id = user.id)
+        await self.__logger.send(text = f"<@{user.id}> {response.message}")
 
-        return await self.__reset_selection()
-    
-    async def __delete_song_from_playlist(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+        return await self.__close_session(session = session, interaction = interaction)
+
+    @COMMAND_HANDLERS.register(Command.PLAY_PLAYLIST, source = Source.PLAYLISTS, header = "Select **Playlist** to play:")
+    async def __play_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if message:
-            return await message.delete()
+            return await self.__delete_message(message = message)
         
-        if user.id != self.__active_author_id:
-            self.__requests[user.id].state_function = self.__start_function
-            return
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
         
-        if self.__comand_menu.reacted_to_me(reaction = reaction):
-            await self.__reset_selection()
-            self.__requests[user.id].state_function = self.__start_function
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        option_index = await self.__selection_menu.get_selection(reaction = reaction)
+        option_index = await session.menu.get_selection(interaction = interaction)
         if option_index == -1:
+            session.state_function = self.__play_playlist
             return
         
-        playlist_name = self.__selection_menu.get_option(index = option_index)
-        video_id = self.__requests[user.id].state_value
-        
-        response = self.__database.delete_song_from_playlist(autor_id = user.id, playlist_name = playlist_name, video_id = video_id)
-        await self.__logger.send(text = response.message)
+        playlist_name = session.menu.get_option(index = option_index)
+        await self.__close_session(session = session, interaction = interaction)
 
-        del self.__requests[user.id]
+        songs = await self.__database.get_songs_from_playlist(author_id = user.id, playlist_name = playlist_name)
 
-        return await self.__reset_selection()
-    
-    async def __play_playlist(self, reaction : Reaction = None, message : Message = None, user : Member = None):
+        joined = await self.__player_menu.join_voice_channel(user = user)
+        if not joined:
+            return await self.__logger.send(text = f"<@{user.id}> Join a voice channel.")
+
+        unavailable = []
+        # Closed right away when playback stops, so the lookups left are cancelled instead of waiting for garbage collection
+        async with aclosing(self.__resolve_songs(songs = songs)) as resolved:
+            async for song, track in resolved:
+                if track is None:
+                    unavailable.append(song.get_name())
+                    continue
+
+                # Playback was stopped while the playlist was still loading
+                if not await self.__player_menu.add_tracks(tracks = [track], requester_id = user.id):
+                    break
+
+        if unavailable:
+            shown = ", ".join(unavailable[:10]) + (", ..." if len(unavailable) > 10 else "")
+            await self.__logger.send(text = f"<@{user.id}> {len(unavailable)} song(s) of **{playlist_name}** are unavailable : {shown}")
+
+    @COMMAND_HANDLERS.register(Command.SHOW_PLAYLIST, source = Source.PLAYLISTS, header = "Select **Playlist** to show:")
+    async def __show_playlist(self, interaction : Interaction = None, message : Message = None, user : Member = None):
         if message:
-            return await message.delete()
+            return await self.__delete_message(message = message)
         
-        self.__requests[user.id].state_function = self.__start_function
-    
-        if user.id != self.__active_author_id:
-            return
+        session = self.__sessions[user.id]
+        session.state_function = self.__start_function
         
-        if self.__comand_menu.reacted_to_me(reaction = reaction):
-            return await self.__requests[user.id].state_function(message = message, reaction = reaction, user = user)
+        if self.__comand_menu.interacted_with_me(interaction = interaction):
+            return await session.state_function(message = message, interaction = interaction, user = user)
         
-        option_index = await self.__selection_menu.get_selection(reaction = reaction)
+        option_index = await session.menu.get_selection(interaction = interaction)
         if option_index == -1:
+            session.state_function = self.__show_playlist
             return
         
-        playlist_name = self.__selection_menu.get_option(index = option_index)
+        playlist_name = session.menu.get_option(index = option_index)
+        await self.__close_session(session = session, interaction = interaction)
 
-        video_ids = self.__database.get_songs_from_playlist(author_id = user.id, playlist_name = playlist_name)
+        preview = await self.__database.get_playlist_preview(author_id = user.id, playlist_name = playlist_name)
+        if preview.count == 0:
+            return await self.__logger.send(text = f"<@{user.id}> **{playlist_name}** has no songs.")
 
-        tracks = []
-        for video_id in video_ids:
-            track = await self.__player_menu.get_track_from_video_id(video_id = video_id)
-            if track is None:
-                await self.__logger.send(text = f"<@{user.id}> Song video is unavailable from youtube : {video_id}")
-                continue
+        lines = [f"**{playlist_name}** : {preview.count} song(s), {str(timedelta(seconds = preview.length // 1000))}"]
+        lines.extend(f"{song.get_name()}" + (f" ({str(timedelta(seconds = song.length // 1000))})" if song.length else "") for song in preview.songs)
+        if preview.count > len(preview.songs):
+            lines.append(f"... and {preview.count - len(preview.songs)} more")
 
-            tracks.append(track)
+        await self.__logger.send(text = "\n".join(lines))
 
-        for track in tracks:
-            queued = await self.__player_menu.queue_track(track = track, user = user)
-            if not queued:
-                await self.__logger.send(text = f"<@{user.id}> Join a voice channel.")
+    async def __resolve_songs(self, songs : list[PlaylistSong]):
+        """Yields (song, track) in playlist order as soon as each track is ready (track is None if unavailable).
+        Stored tracks are decoded in one batch, the missing or stale ones are loaded again from their uri with bounded concurrency."""
+        stored = await self.__database.get_tracks(track_ids = [song.track_id for song in songs])
+        stored_ids = [song.track_id for song in songs if song.track_id in stored]
 
-        return await self.__reset_selection()
-    
+        decoded = await self.__player_menu.decode_tracks(encoded = [stored[track_id].encoded for track_id in stored_ids])
+        resolved = dict(zip(stored_ids, decoded))
+
+        semaphore = asyncio.Semaphore(PLAYLIST_RESOLVE_CONCURRENCY)
+        async def load(uri : str):
+            async with semaphore:
+                return await self.__player_menu.get_track_from_uri(uri = uri)
 
+        lookups = {song.track_id : asyncio.create_task(load(song.uri)) for song in songs if song.track_id not in resolved}
+        refreshed = []
+        try:
+            for song in songs:
+                track = resolved.get(song.track_id)
+                if track is None:
+                    track = await lookups[song.track_id]
+                    if track is not None:
+                        refreshed.append(StoredTrack.from_track(track = track))
+                yield song, track
+        finally:
+            for lookup in lookups.values():
+                lookup.cancel()
+            await self.__database.store_tracks(tracks = refreshed)
@@ -1,6 +1,10 @@
 from dataclasses import dataclass
+import json
 import sqlite3
-from config import DB_PATH, MAX_NUM_PLAYLISTS
+from time import time
+from cogs.music.migrations import migrate
+from cogs.music.storage_engine import StorageEngine
+from config import DB_PATH, MAX_NUM_PLAYLISTS, TRACK_STORE_TTL
 
 @dataclass
 class Playlist:
@@ -8,125 +12,388 @@ class Playlist:
     author_id : int
     name : str
 
+@dataclass
+class StoredTrack:
+    track_id : str # Lavalink identifier: a youtube video id, a soundcloud track id...
+    encoded : str
+    title : str
+    author : str
+    length : int
+    updated_at : int
+    # Only kept with the playlist entries
+    uri : str = None
+    source : str = "youtube"
+
+    @classmethod
+    def from_track(cls, track) -> "StoredTrack":
+        return cls(track_id = track.identifier, encoded = track.encoded, title = track.title, author = track.author, length = track.length, updated_at = int(time()), uri = track.uri, source = track.source)
+
+@dataclass
+class PlaylistSong:
+    track_id : str
+    source : str
+    uri : str
+    # Unknown for songs added before they were stored with their playlist, until the playlist is played
+    title : str
+    author : str
+    length : int
+
+    def get_name(self) -> str:
+        return f"{self.title} - {self.author}" if self.title else self.uri
+
+@dataclass
+class PlaylistPreview:
+    songs : list[PlaylistSong] # The first ones only
+    count : int
+    length : int # Milliseconds, songs of unknown length left out
+
+@dataclass
+class GuildMenus:
+    guild_id : int
+    channel_id : int
+    command_message_id : int
+    selection_message_id : int
+    player_message_id : int
+
+@dataclass
+class QueueSnapshot:
+    guild_id : int
+    voice_channel_id : int
+    tracks : list[str] # Lavalink encoded tracks
+    index : int
+    position : int
+
+@dataclass
+class JournalEntry:
+    guild_id : int
+    op : str
+    args : list
+
+@dataclass
+class PlayEvent:
+    guild_id : int
+    user_id : int # 0 when the requester is unknown
+    track_id : str
+    title : str
+    started_at : int
+    played_ms : int
+    skipped : bool
+
+@dataclass
+class TrackPlays:
+    track_id : str
+    title : str
+    plays : int
+    skips : int
+    played_ms : int
+
+@dataclass
+class UserPlays:
+    user_id : int
+    plays : int
+    skips : int
+    played_ms : int
+
 @dataclass
 class DB_Reponse:
     result : bool
     message : str
 
+@dataclass
+class BulkResponse(DB_Reponse):
+    added : int = 0
+    duplicates : int = 0
+    failed : int = 0
+
 class Database:
-    def __init__(self):
-        self.__connection  : sqlite3.Connection = self.__get_connection()
-        self.__create_database()
-
-    def __get_connection(self):
-        return sqlite3.connect(DB_PATH)
-
-    def __create_database(self):
-        cursor = self.__connection.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS PLAYLIST(ID INTEGER PRIMARY KEY AUTOINCREMENT, author_id INTEGER, name varchar(30))")
-        cursor.execute("CREATE TABLE IF NOT EXISTS SONG_PLAYLIST(video_id varchar(11), playlist_id INT, PRIMARY KEY(video_id, playlist_id))")
-        cursor.close()
-        self.__connection.commit()
-
-    def __commit_data(self, sql_str : str) -> bool:
-        cursor = self.__connection.cursor()
-        res = True
+    """Async access to the playlists, shared by every server. All SQL runs on the StorageEngine threads."""
+
+    def __init__(self, path : str = DB_PATH):
+        self.__engine : StorageEngine = StorageEngine(path = path)
+
+    async def setup(self):
+        await self.__engine.write(migrate)
+
+    def close(self):
+        self.__engine.close()
+
+    async def __commit_data(self, sql_str : str, params : tuple = ()) -> int:
+        """Executes a parameterized write and returns the number of changed rows, or -1 on a constraint violation"""
         try:
-            cursor.execute(sql_str)
+            return await self.__engine.write(lambda connection: connection.execute(sql_str, params).rowcount)
         except sqlite3.IntegrityError:
-            res = False
-        cursor.close()
-
-        self.__connection.commit()
-        return res
-
-    def __select_data(self, sql_str : str) -> list:
-        cursor = self.__connection.cursor()
-        cursor.execute(sql_str)
-        result = cursor.fetchall()
-        cursor.close()
-        return result
+            return -1
+
+    async def __select_data(self, sql_str : str, params : tuple = ()) -> list:
+        return await self.__engine.read(lambda connection: connection.execute(sql_str, params).fetchall())
     
-    def add_song_to_playlist(self, video_id : str, playlist_name : str, autor_id : int) -> DB_Reponse:
-        """Adds a song, identified by its youtube video_id, into a playlist identified by its playlist_id in the database"""
+    async def add_song_to_playlist(self, track : StoredTrack, playlist_name : str, autor_id : int) -> DB_Reponse:
+        """Adds a song with its metadata into a playlist identified by its author and name, and stores the track"""
+        def add(connection : sqlite3.Connection) -> DB_Reponse:
+            playlist_id = self.__get_playlist_id(connection = connection, author_id = autor_id, playlist_name = playlist_name)
+            if playlist_id is None:
+                return DB_Reponse(result = False, message = f"Playlist **{playlist_name}** does not exist.")
 
-        ids = self.__select_data(sql_str = f"select id from playlist where author_id = {autor_id} and name = '{playlist_name}'")
+            added, _ = self.__insert_songs(connection = connection, playlist_id = playlist_id, tracks = [track])
+            return DB_Reponse(result = added > 0, message = f"Added song to **{playlist_name}**." if added > 0 else f"Song already exists in **{playlist_name}**.")
 
-        if not ids:
-            return False
-        
-        playlist_id = ids[0][0]
-        added = self.__commit_data(sql_str = f"INSERT INTO SONG_PLAYLIST (video_id, playlist_id) VALUES ('{video_id}', {playlist_id})")
-
-        return DB_Reponse(result = added, message = f"Added song to **{playlist_name}**." if added else f"Song already exists in **{playlist_name}**.")
+        return await self.__engine.write(add)
     
-    def create_playlist(self, playlist_name : str, author_id : int) -> DB_Reponse:
+    async def create_playlist(self, playlist_name : str, author_id : int) -> DB_Reponse:
         """Creates a playlist for author_id; checks if it exists already; limited to MAX_NUM_PLAYLISTS."""
-        if self.get_playlists(author_id = author_id, playlist_name = playlist_name):
-            return DB_Reponse(result = False, message = f"Playlist **{playlist_name}** already exists.")
-        
-        if len(self.get_playlists(author_id = author_id)) > MAX_NUM_PLAYLISTS:
-            return DB_Reponse(result = False, message = f"You have reached the maximum number of playlists.")
+        def create(connection : sqlite3.Connection) -> DB_Reponse:
+            count = connection.execute("SELECT COUNT(*) FROM PLAYLIST WHERE author_id = ?", (author_id,)).fetchone()[0]
+            if count > MAX_NUM_PLAYLISTS:
+                return DB_Reponse(result = False, message = f"You have reached the maximum number of playlists.")
 
-        created = self.__commit_data(sql_str = f"INSERT INTO PLAYLIST (author_id, name) VALUES ({author_id},'{playlist_name}')")
+            connection.execute("INSERT INTO PLAYLIST (author_id, name) VALUES (?, ?)", (author_id, playlist_name))
+            return DB_Reponse(result = True, message = f"Created playlist **{playlist_name}**.")
 
-        return DB_Reponse(result = created, message = f"Created playlist **{playlist_name}**." if created else f"Failed to create **{playlist_name}**. I do not know why.")
+        try:
+            return await self.__engine.write(create)
+        except sqlite3.IntegrityError:
+            return DB_Reponse(result = False, message = f"Playlist **{playlist_name}** already exists.")
     
-    def delete_playlist(self, playlist_name : str, author_id : int) -> DB_Reponse:
-        """Deletes a playlist given its playlist_id in the database"""
+    async def delete_playlist(self, playlist_name : str, author_id : int) -> DB_Reponse:
+        """Deletes a playlist and, through the cascade, its songs"""
+        deleted = await self.__commit_data(sql_str = "DELETE FROM PLAYLIST WHERE author_id = ? AND name = ?", params = (author_id, playlist_name))
 
-        playlists = self.get_playlists(author_id = author_id, playlist_name = playlist_name)
-        if not playlists:
+        if deleted == 0:
             return DB_Reponse(result = False, message = f"Playlist **{playlist_name}** does not exist.")
-        
-        playlist = playlists[0]
 
-        deleted = self.__commit_data(sql_str = f"delete from song_playlist where playlist_id = {playlist.id}")
-        if deleted:
-            deleted = self.__commit_data(sql_str = f"delete from playlist where id = {playlist.id}")
-        
-        return DB_Reponse(result = deleted, message = f"Deleted playlist **{playlist_name}**." if deleted else f"Failed to delete playlist **{playlist_name}**. I do not know why.")
+        return DB_Reponse(result = deleted > 0, message = f"Deleted playlist **{playlist_name}**." if deleted > 0 else f"Failed to delete playlist **{playlist_name}**. I do not know why.")
     
-    def delete_song_from_playlist(self, video_id : str, playlist_name : str, autor_id : int) -> DB_Reponse:
-        """Removes a song, identified by its youtube video_id, from a playlist identified by its playlist_id in the database"""
-        ids = self.__select_data(sql_str = f"select id from playlist where author_id = {autor_id} and name = '{playlist_name}'")
+    async def delete_song_from_playlist(self, track_id : str, playlist_name : str, autor_id : int) -> DB_Reponse:
+        """Removes a song, identified by its Lavalink track_id, from a playlist identified by its author and name"""
+        deleted = await self.__commit_data(sql_str = "DELETE FROM SONG_PLAYLIST WHERE playlist_id = (SELECT ID FROM PLAYLIST WHERE author_id = ? AND name = ?) AND track_id = ?", params = (autor_id, playlist_name, track_id))
 
-        if not ids:
+        if deleted == 0:
             return DB_Reponse(result = False, message = f"Song does not exist in playlist **{playlist_name}**.")
 
-        playlist_id = ids[0][0]
-        deleted = self.__commit_data(sql_str = f"delete from SONG_PLAYLIST where video_id = '{video_id}' and playlist_id = {playlist_id}")
-        return DB_Reponse(result = deleted, message = f"Deleted song from **{playlist_name}**." if deleted else f"Failed to delete song from playlist **{playlist_name}**. I do not know why.")
+        return DB_Reponse(result = deleted > 0, message = f"Deleted song from **{playlist_name}**." if deleted > 0 else f"Failed to delete song from playlist **{playlist_name}**. I do not know why.")
     
-    def get_playlists(self, author_id : int, playlist_name : str = None, ordered : bool = True) -> list[Playlist]:
+    async def get_playlists(self, author_id : int, playlist_name : str = None, ordered : bool = True) -> list[Playlist]:
         """Returns a list of playlists from author_id"""
-        sql = f"SELECT ID, name FROM PLAYLIST where author_id = {author_id}"
+        sql = "SELECT ID, name FROM PLAYLIST WHERE author_id = ?"
+        params = (author_id,)
 
         if playlist_name:
-            sql = f"{sql} and name = '{playlist_name}'"
+            sql = f"{sql} AND name = ?"
+            params = (author_id, playlist_name)
 
         if ordered:
-            sql = f"{sql} order by name"
+            sql = f"{sql} ORDER BY name"
         
-        res = self.__select_data(sql_str = sql)
+        res = await self.__select_data(sql_str = sql, params = params)
 
         return [Playlist(id = row[0], author_id = author_id, name = row[1]) for row in res]
 
-    def get_songs_from_playlist(self, author_id : int, playlist_name : str) -> list[str]:
-        """Returns a list of video_ids from a playlist given its playlist_id in the database"""      
-        sql = f"Select video_id from SONG_PLAYLIST where playlist_id = (select id from playlist where author_id = {author_id} and name = '{playlist_name}')"
-        res = self.__select_data(sql_str = sql)
+    async def get_songs_from_playlist(self, author_id : int, playlist_name : str) -> list[PlaylistSong]:
+        """Returns the songs of a playlist, in the order they were added"""
+        sql = "SELECT s.track_id, s.source, s.uri, s.title, s.author, s.length FROM PLAYLIST p JOIN SONG_PLAYLIST s ON s.playlist_id = p.ID WHERE p.author_id = ? AND p.name = ? ORDER BY s.rowid"
+        res = await self.__select_data(sql_str = sql, params = (author_id, playlist_name))
         
-        return [v[0] for v in res]
+        return [PlaylistSong(*row) for row in res]
+
+    async def get_playlist_preview(self, author_id : int, playlist_name : str, limit : int = 10) -> PlaylistPreview:
+        """Returns the first songs of a playlist with its song count and total length, from a single query"""
+        sql = "SELECT s.track_id, s.source, s.uri, s.title, s.author, s.length, COUNT(*) OVER (), SUM(s.length) OVER () FROM PLAYLIST p JOIN SONG_PLAYLIST s ON s.playlist_id = p.ID WHERE p.author_id = ? AND p.name = ? ORDER BY s.rowid LIMIT ?"
+        res = await self.__select_data(sql_str = sql, params = (author_id, playlist_name, limit))
+
+        if not res:
+            return PlaylistPreview(songs = [], count = 0, length = 0)
+
+        return PlaylistPreview(songs = [PlaylistSong(*row[:6]) for row in res], count = res[0][6], length = res[0][7] or 0)
     
-    def playlist_exists(self, author_id : int, playlist_name : str) -> bool:
-        return self.get_playlists(author_id = author_id, playlist_name = playlist_name) is not None
+    async def playlist_exists(self, author_id : int, playlist_name : str) -> bool:
+        return len(await self.get_playlists(author_id = author_id, playlist_name = playlist_name, ordered = False)) > 0
 
-    def rename_playlist(self, author_id : int, old_name : str, new_name : str) -> DB_Reponse:
+    async def rename_playlist(self, author_id : int, old_name : str, new_name : str) -> DB_Reponse:
         """Renames a playlist identified by its old_name in the database"""
-        if not self.playlist_exists(author_id = author_id, playlist_name = old_name):
+        renamed = await self.__commit_data(sql_str = "UPDATE PLAYLIST SET name = ? WHERE author_id = ? AND name = ?", params = (new_name, author_id, old_name))
+
+        if renamed == 0:
             return DB_Reponse(result = False, message = f"Playlist '{old_name}' does not exist.")
-    
-        renamed = self.__commit_data(sql_str = f"update playlist set name='{new_name}' where name='{old_name}' and author_id = {author_id}")
+
+        if renamed < 0:
+            return DB_Reponse(result = False, message = f"Playlist **{new_name}** already exists.")
         
-        return DB_Reponse(result = renamed, message = f"Renamed playlist from **{old_name}** to **{new_name}**." if renamed else f"Failed to rename playlist **{old_name}** to **{new_name}**. I do not know why.")
+        return DB_Reponse(result = True, message = f"Renamed playlist from **{old_name}** to **{new_name}**.")
+
+    async def get_tracks(self, track_ids : list[str], max_age : int = TRACK_STORE_TTL) -> dict[str, StoredTrack]:
+        """Returns the stored Lavalink tracks for track_ids that were resolved less than max_age seconds ago"""
+        oldest = int(time()) - max_age
+        tracks = {}
+
+        # Stay below SQLite's bound parameter limit
+        for start in range(0, len(track_ids), 500):
+            chunk = track_ids[start:start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = await self.__select_data(sql_str = f"SELECT track_id, encoded, title, author, length, updated_at FROM TRACK WHERE updated_at >= ? and track_id in ({placeholders})", params = (oldest, *chunk))
+
+            for row in rows:
+                tracks[row[0]] = StoredTrack(*row)
+
+        return tracks
+
+    async def store_tracks(self, tracks : list[StoredTrack]) -> bool:
+        """Inserts or refreshes resolved Lavalink tracks, identified by their track_id.
+        Playlist entries still missing their metadata get it at the same time."""
+        if not tracks:
+            return True
+
+        def store(connection : sqlite3.Connection):
+            self.__insert_tracks(connection = connection, tracks = tracks)
+            connection.executemany("UPDATE SONG_PLAYLIST SET title = ?, author = ?, length = ? WHERE track_id = ? AND title IS NULL", [(t.title, t.author, t.length, t.track_id) for t in tracks])
+
+        try:
+            await self.__engine.write(store)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    async def get_guild_menus(self) -> list[GuildMenus]:
+        """Returns the menu messages of every server that was set up"""
+        rows = await self.__select_data(sql_str = "SELECT guild_id, channel_id, command_message_id, selection_message_id, player_message_id FROM GUILD_MENU")
+        return [GuildMenus(*row) for row in rows]
+
+    async def save_guild_menus(self, menus : GuildMenus) -> bool:
+        return await self.__commit_data(sql_str = "INSERT OR REPLACE INTO GUILD_MENU (guild_id, channel_id, command_message_id, selection_message_id, player_message_id) VALUES (?, ?, ?, ?, ?)", params = (menus.guild_id, menus.channel_id, menus.command_message_id, menus.selection_message_id, menus.player_message_id)) > 0
+
+    async def get_queue_journals(self) -> dict[int, tuple[QueueSnapshot, list[JournalEntry]]]:
+        """Returns the queue snapshot of every server with the journal entries written after it, oldest first"""
+        def read(connection : sqlite3.Connection) -> dict[int, tuple[QueueSnapshot, list[JournalEntry]]]:
+            journals = {}
+            for guild_id, voice_channel_id, tracks, index, position in connection.execute("SELECT guild_id, voice_channel_id, tracks, track_index, position FROM QUEUE_SNAPSHOT"):
+                journals[guild_id] = (QueueSnapshot(guild_id, voice_channel_id, json.loads(tracks), index, position), [])
+
+            for guild_id, op, args in connection.execute("SELECT guild_id, op, args FROM QUEUE_JOURNAL ORDER BY id"):
+                if guild_id in journals:
+                    journals[guild_id][1].append(JournalEntry(guild_id, op, json.loads(args)))
+            return journals
+
+        return await self.__engine.read(read)
+
+    async def write_queue_journal(self, snapshots : list[QueueSnapshot], entries : list[JournalEntry], positions : list[tuple[int, int, int]]) -> bool:
+        """Writes in one transaction: snapshots replacing the journal of their server, new journal entries and (guild_id, voice_channel_id, position) updates"""
+        now = int(time())
+        def write(connection : sqlite3.Connection):
+            for snapshot in snapshots:
+                connection.execute("INSERT OR REPLACE INTO QUEUE_SNAPSHOT (guild_id, voice_channel_id, tracks, track_index, position, updated_at) VALUES (?, ?, ?, ?, ?, ?)", (snapshot.guild_id, snapshot.voice_channel_id, json.dumps(snapshot.tracks), snapshot.index, snapshot.position, now))
+                connection.execute("DELETE FROM QUEUE_JOURNAL WHERE guild_id = ?", (snapshot.guild_id,))
+
+            connection.executemany("INSERT INTO QUEUE_JOURNAL (guild_id, op, args) VALUES (?, ?, ?)", [(entry.guild_id, entry.op, json.dumps(entry.args)) for entry in entries])
+            connection.executemany("UPDATE QUEUE_SNAPSHOT SET voice_channel_id = ?, position = ?, updated_at = ? WHERE guild_id = ?", [(voice_channel_id, position, now, guild_id) for guild_id, voice_channel_id, position in positions])
+
+        try:
+            await self.__engine.write(write)
+        except sqlite3.Error as e:
+            print(f"[DEBUG] Failed to write the queue journal : {e}")
+            return False
+        return True
+
+    async def write_play_events(self, events : list[PlayEvent]) -> bool:
+        """Appends play events and adds them to the per server track and user counts, in one transaction"""
+        if not events:
+            return True
+
+        def write(connection : sqlite3.Connection):
+            connection.executemany("INSERT INTO PLAY_EVENT (guild_id, user_id, track_id, started_at, played_ms, skipped) VALUES (?, ?, ?, ?, ?, ?)", [(e.guild_id, e.user_id, e.track_id, e.started_at, e.played_ms, int(e.skipped)) for e in events])
+            connection.executemany(
+                "INSERT INTO TRACK_PLAYS (guild_id, track_id, title, plays, skips, played_ms) VALUES (?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT(guild_id, track_id) DO UPDATE SET title = excluded.title, plays = plays + 1, skips = skips + excluded.skips, played_ms = played_ms + excluded.played_ms",
+                [(e.guild_id, e.track_id, e.title, int(e.skipped), e.played_ms) for e in events]
+            )
+            connection.executemany(
+                "INSERT INTO USER_PLAYS (guild_id, user_id, plays, skips, played_ms) VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT(guild_id, user_id) DO UPDATE SET plays = plays + 1, skips = skips + excluded.skips, played_ms = played_ms + excluded.played_ms",
+                [(e.guild_id, e.user_id, int(e.skipped), e.played_ms) for e in events if e.user_id]
+            )
+
+        try:
+            await self.__engine.write(write)
+        except sqlite3.Error as e:
+            print(f"[DEBUG] Failed to write {len(events)} play events : {e}")
+            return False
+        return True
+
+    async def get_top_tracks(self, guild_id : int, limit : int = 10) -> list[TrackPlays]:
+        rows = await self.__select_data(sql_str = "SELECT track_id, title, plays, skips, played_ms FROM TRACK_PLAYS WHERE guild_id = ? ORDER BY plays DESC LIMIT ?", params = (guild_id, limit))
+        return [TrackPlays(*row) for row in rows]
+
+    async def get_top_users(self, guild_id : int, limit : int = 10) -> list[UserPlays]:
+        rows = await self.__select_data(sql_str = "SELECT user_id, plays, skips, played_ms FROM USER_PLAYS WHERE guild_id = ? ORDER BY plays DESC LIMIT ?", params = (guild_id, limit))
+        return [UserPlays(*row) for row in rows]
+
+    @staticmethod
+    def __insert_tracks(connection : sqlite3.Connection, tracks : list[StoredTrack]):
+        connection.executemany("INSERT OR REPLACE INTO TRACK (track_id, encoded, title, author, length, updated_at) VALUES (?, ?, ?, ?, ?, ?)", [(t.track_id, t.encoded, t.title, t.author, t.length, t.updated_at) for t in tracks])
+
+    @staticmethod
+    def __insert_songs(connection : sqlite3.Connection, playlist_id : int, tracks : list[StoredTrack]) -> tuple[int, int]:
+        """Stores tracks and adds them with their metadata to playlist_id with one executemany each. Returns (added, duplicates)."""
+        Database.__insert_tracks(connection = connection, tracks = tracks)
+
+        before = connection.total_changes
+        connection.executemany("INSERT OR IGNORE INTO SONG_PLAYLIST (playlist_id, track_id, source, uri, title, author, length) VALUES (?, ?, ?, ?, ?, ?, ?)", [(playlist_id, t.track_id, t.source, t.uri, t.title, t.author, t.length) for t in tracks])
+        added = connection.total_changes - before
+
+        return added, len(tracks) - added
+
+    @staticmethod
+    def __get_playlist_id(connection : sqlite3.Connection, author_id : int, playlist_name : str) -> int:
+        row = connection.execute("SELECT ID FROM PLAYLIST WHERE author_id = ? AND name = ?", (author_id, playlist_name)).fetchone()
+        return row[0] if row else None
+
+    async def add_songs_to_playlist(self, tracks : list[StoredTrack], playlist_name : str, author_id : int, failed : int = 0) -> BulkResponse:
+        """Adds many songs to a playlist in a single transaction; failed is the number of songs the caller could not convert"""
+        def add(connection : sqlite3.Connection) -> BulkResponse:
+            playlist_id = self.__get_playlist_id(connection = connection, author_id = author_id, playlist_name = playlist_name)
+            if playlist_id is None:
+                return BulkResponse(result = False, message = f"Playlist **{playlist_name}** does not exist.", failed = failed + len(tracks))
+
+            added, duplicates = self.__insert_songs(connection = connection, playlist_id = playlist_id, tracks = tracks)
+            return BulkResponse(result = added > 0, message = f"Added {added} song(s) to **{playlist_name}**{bulk_summary(duplicates = duplicates, failed = failed)}.", added = added, duplicates = duplicates, failed = failed)
+
+        return await self.__engine.write(add)
+
+    async def save_playlist(self, tracks : list[StoredTrack], playlist_name : str, author_id : int, failed : int = 0) -> BulkResponse:
+        """Creates a playlist already filled with tracks, in a single transaction"""
+        def save(connection : sqlite3.Connection) -> BulkResponse:
+            count = connection.execute("SELECT COUNT(*) FROM PLAYLIST WHERE author_id = ?", (author_id,)).fetchone()[0]
+            if count > MAX_NUM_PLAYLISTS:
+                return BulkResponse(result = False, message = f"You have reached the maximum number of playlists.", failed = failed + len(tracks))
+
+            playlist_id = connection.execute("INSERT INTO PLAYLIST (author_id, name) VALUES (?, ?)", (author_id, playlist_name)).lastrowid
+            added, duplicates = self.__insert_songs(connection = connection, playlist_id = playlist_id, tracks = tracks)
+            return BulkResponse(result = True, message = f"Saved {added} song(s) to **{playlist_name}**{bulk_summary(duplicates = duplicates, failed = failed)}.", added = added, duplicates = duplicates, failed = failed)
+
+        try:
+            return await self.__engine.write(save)
+        except sqlite3.IntegrityError:
+            return BulkResponse(result = False, message = f"Playlist **{playlist_name}** already exists.", failed = failed + len(tracks))
+
+    async def merge_playlists(self, source_name : str, target_name : str, author_id : int) -> BulkResponse:
+        """Copies every song of source_name into target_name, in a single statement"""
+        def merge(connection : sqlite3.Connection) -> BulkResponse:
+            source_id = self.__get_playlist_id(connection = connection, author_id = author_id, playlist_name = source_name)
+            target_id = self.__get_playlist_id(connection = connection, author_id = author_id, playlist_name = target_name)
+            if source_id is None or target_id is None:
+                return BulkResponse(result = False, message = f"Playlist **{source_name if source_id is None else target_name}** does not exist.")
+
+            total = connection.execute("SELECT COUNT(*) FROM SONG_PLAYLIST WHERE playlist_id = ?", (source_id,)).fetchone()[0]
+            added = connection.execute("INSERT OR IGNORE INTO SONG_PLAYLIST (playlist_id, track_id, source, uri, title, author, length) SELECT ?, track_id, source, uri, title, author, length FROM SONG_PLAYLIST WHERE playlist_id = ? ORDER BY rowid", (target_id, source_id)).rowcount
+            duplicates = total - added
+            return BulkResponse(result = added > 0, message = f"Added {added} song(s) from **{source_name}** to **{target_name}**{bulk_summary(duplicates = duplicates, failed = 0)}.", added = added, duplicates = duplicates)
+
+        return await self.__engine.write(merge)
+
+
+def bulk_summary(duplicates : int, failed : int) -> str:
+    parts = []
+    if duplicates:
+        parts.append(f"{duplicates} already there")
+    if failed:
+        parts.append(f"{failed} failed")
+
+    return f" ({', '.join(parts)})" if parts else ""
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum, auto
+from time import perf_counter
+from typing import Awaitable, Callable, Hashable, Iterator
+
+class Check(Enum):
+    """What must hold before a handler runs, the user is told why otherwise"""
+    SAME_VOICE_CHANNEL = auto() # The user listens in the bot's voice channel
+    TRACK = auto() # Something is playing, the session keeps that track for the handler
+    SESSION_TRACKS = auto() # The queue or its history has tracks
+
+class Source(Enum):
+    """What the user answers a command with"""
+    NONE = auto() # Nothing, the handler runs right away
+    PROMPT = auto() # A message typed in the channel
+    PLAYLISTS = auto() # One of their playlists, picked in their selection menu
+
+@dataclass(frozen = True)
+class Handler:
+    function : Callable[..., Awaitable]
+    checks : tuple[Check, ...] = ()
+    source : Source = Source.NONE
+    header : str = ""
+    min_playlists : int = 1
+
+@dataclass
+class DispatchStats:
+    calls : int = 0
+    rejected : int = 0
+    seconds : float = 0.0
+
+class Registry:
+    """Handlers of one menu by key (a Command, a player button action), filled once by the register decorator when Control is defined.
+    The registry also counts what it dispatches."""
+
+    def __init__(self, name : str):
+        self.name : str = name
+        self.__handlers : dict[Hashable, Handler] = {}
+        self.__stats : dict[Hashable, DispatchStats] = {}
+
+    def register(self, *keys : Hashable, checks : tuple[Check, ...] = (), source : Source = Source.NONE, header : str = "", min_playlists : int = 1) -> Callable:
+        def decorator(function : Callable[..., Awaitable]) -> Callable[..., Awaitable]:
+            for key in keys:
+                assert key not in self.__handlers, f"[ERROR] Registry {self.name} - {key} is registered twice."
+                self.__handlers[key] = Handler(function = function, checks = checks, source = source, header = header, min_playlists = min_playlists)
+                self.__stats[key] = DispatchStats()
+            return function
+        return decorator
+
+    def get(self, key : Hashable) -> Handler:
+        return self.__handlers.get(key)
+
+    def keys(self) -> list[Hashable]:
+        return list(self.__handlers)
+
+    @contextmanager
+    def count(self, key : Hashable) -> Iterator[DispatchStats]:
+        """Counts one dispatch of key and the time spent in the block"""
+        stats = self.__stats[key]
+        stats.calls += 1
+        start = perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds += perf_counter() - start
+
+    def get_stats(self) -> dict[str, DispatchStats]:
+        return {getattr(key, "name", str(key)).lower() : stats for key, stats in self.__stats.items()}
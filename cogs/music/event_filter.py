@@ -0,0 +1,91 @@
+from collections import Counter
+from typing import Any, Callable
+
+from discord.state import ConnectionState
+
+# Gateway events whose raw payload carries the channel they happened in
+FILTERED_EVENTS = ("MESSAGE_CREATE", "MESSAGE_UPDATE", "MESSAGE_DELETE", "MESSAGE_DELETE_BULK", "INTERACTION_CREATE")
+
+class EventFilter:
+    """Index of the music channels, checked on raw gateway payloads before discord.py builds any object from them.
+    Events from other channels are dropped, except messages starting with the command prefix so !setup keeps working."""
+
+    def __init__(self):
+        # Raw payloads carry ids as strings, the index stores them the same way
+        self.__channel_ids : set[str] = set()
+        self.__guild_channels : dict[int, str] = {}
+        self.__prefix : str = ""
+
+        self.__parsers : dict[str, Callable[[Any], None]] = {}
+        self.__connection : ConnectionState = None
+
+        self.passed : Counter = Counter()
+        self.dropped : Counter = Counter()
+
+    # ---------------------- INDEX --------------------------#
+    def register(self, guild_id : int, channel_id : int):
+        previous = self.__guild_channels.get(guild_id)
+        if previous is not None:
+            self.__channel_ids.discard(previous)
+
+        self.__guild_channels[guild_id] = str(channel_id)
+        self.__channel_ids.add(str(channel_id))
+
+    def unregister(self, guild_id : int):
+        channel_id = self.__guild_channels.pop(guild_id, None)
+        if channel_id is not None:
+            self.__channel_ids.discard(channel_id)
+
+    def is_music_channel(self, channel_id : int) -> bool:
+        return str(channel_id) in self.__channel_ids
+
+    # ---------------------- GATEWAY --------------------------#
+    def install(self, connection : ConnectionState, prefix : str):
+        """Wraps the parsers of the filtered events. The gateway looks parsers up in this same dict for every event."""
+        if self.__connection is not None:
+            return
+
+        self.__connection = connection
+        self.__prefix = prefix
+        for event in FILTERED_EVENTS:
+            parser = connection.parsers.get(event)
+            if parser is None:
+                continue
+            self.__parsers[event] = parser
+            connection.parsers[event] = self.__wrap(event = event, parser = parser)
+
+    def uninstall(self):
+        if self.__connection is None:
+            return
+
+        self.__connection.parsers.update(self.__parsers)
+        self.__parsers = {}
+        self.__connection = None
+
+    def __wrap(self, event : str, parser : Callable[[Any], None]) -> Callable[[Any], None]:
+        def parse(data : dict):
+            if self.accepts(event = event, data = data):
+                self.passed[event] += 1
+                return parser(data)
+            self.dropped[event] += 1
+        return parse
+
+    def accepts(self, event : str, data : dict) -> bool:
+        """Must never raise: an exception here would drop the event for every other listener as well"""
+        try:
+            if data.get("channel_id") in self.__channel_ids:
+                return True
+
+            if event == "MESSAGE_CREATE":
+                return data.get("content", "").startswith(self.__prefix)
+
+            if event == "INTERACTION_CREATE":
+                # Only our menus live in music channels, anything else (slash commands, other components) is not ours to drop
+                return not data.get("data", {}).get("custom_id", "").startswith("music:")
+
+            return False
+        except (AttributeError, TypeError):
+            return True
+
+
+event_filter = EventFilter()
@@ -1,25 +1,86 @@
+import asyncio
+
 from discord import TextChannel, Message, Embed
-from discord.errors import NotFound
+from discord.errors import HTTPException, NotFound
+
+from cogs.music.scheduler import Priority, scheduler
+from config import LOGGER_COALESCE_WINDOW
 
+MAX_MESSAGE_LENGTH = 2000
 
 class Logger:
-    def __init__(self, text_channel : TextChannel):
+    """Keeps a single status message per channel and edits it in place.
+    Notifications sent within LOGGER_COALESCE_WINDOW are shown together in one edit."""
+
+    def __init__(self, text_channel : TextChannel, window : float = LOGGER_COALESCE_WINDOW):
         self.__text_channel : TextChannel = text_channel
+        self.__window : float = window
         self.__last_notification : Message = None
 
+        self.__pending : list[str] = []
+        self.__pending_embed : Embed = None
+        self.__flush_task : asyncio.Task = None
+
     async def send(self, text : str, embed : Embed = None):
-        await self.clear()
-        
         text = "".join([f"> {line}\n" for line in text.split("\n")])
 
-        self.__last_notification = await self.__text_channel.send(f"{text}", embed = embed)
+        # The same notification twice in a row says nothing new
+        if not self.__pending or self.__pending[-1] != text:
+            self.__pending.append(text)
+        if embed is not None:
+            self.__pending_embed = embed
+
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.create_task(self.__flush_later())
+
+    async def __flush_later(self):
+        try:
+            while self.__pending:
+                await asyncio.sleep(self.__window)
+                await self.flush()
+        finally:
+            if self.__flush_task is asyncio.current_task():
+                self.__flush_task = None
+
+    async def flush(self):
+        """Shows the pending notifications now, dropping the oldest ones if they do not fit in one message"""
+        if not self.__pending:
+            return
+
+        texts, embed = self.__pending, self.__pending_embed
+        self.__pending, self.__pending_embed = [], None
+
+        content = ""
+        for text in reversed(texts):
+            if len(content) + len(text) > MAX_MESSAGE_LENGTH:
+                break
+            content = text + content
+        content = content or texts[-1][:MAX_MESSAGE_LENGTH]
+
+        # Notifications are not worth retrying, a failed batch is dropped instead of failing the flush task
+        try:
+            if self.__last_notification is not None:
+                try:
+                    await scheduler.edit(message = self.__last_notification, priority = Priority.NOTIFICATION, content = content, embed = embed)
+                    return
+                except NotFound:
+                    self.__last_notification = None
+
+            self.__last_notification = await scheduler.send(channel = self.__text_channel, priority = Priority.NOTIFICATION, content = content, embed = embed)
+        except HTTPException as e:
+            print(f"[DEBUG] Dropped {len(texts)} notifications for {self.__text_channel.id} : {e}")
 
     async def clear(self):
+        self.__pending, self.__pending_embed = [], None
+        if self.__flush_task is not None:
+            self.__flush_task.cancel()
+            self.__flush_task = None
+
         if self.__last_notification is None:
             return
-        
+
         try:
-            await self.__last_notification.delete() 
+            await scheduler.delete(message = self.__last_notification, priority = Priority.NOTIFICATION)
         except NotFound:
             print("Caught exception for some reason.")
-            return
+        self.__last_notification = None
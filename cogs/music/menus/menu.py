@@ -1,85 +1,191 @@
-from discord import Message, Reaction, TextChannel
+from discord import ButtonStyle, HTTPException, Interaction, Message, SelectOption, TextChannel
+from discord.ui import Button, Select, View
 
-from cogs.music.utils import emote_from_index, emote_to_index
+from cogs.music.profiler import profiler
+from cogs.music.scheduler import Priority, scheduler
+from cogs.music.utils import emote_from_index, get_custom_id, responding
 
 ITEMS_PER_PAGE = 10
 
 class Menu:
-    def __init__(self, text_channel : TextChannel, options : list[str] = [], default_message : str = '', fixed : bool = False):
-        self._reactions  = [emote_from_index(index = i) for i in range(min(10, len(options)) if fixed else 10)] 
-        self._reactions += ["⬅️", "➡️"]
+    """A message listing options, picked with a select menu and paged with buttons.
+    Components are identified by their custom_id (music:<name>:select|prev|next) and the message they are on.
+    An ephemeral menu is only seen by one user: it is sent as the answer to one of their interactions and edited through its token."""
 
+    def __init__(self, text_channel : TextChannel, name : str, options : list[str] = [], default_message : str = '', priority : Priority = Priority.SELECTION, ephemeral : bool = False):
         self.__text_channel : TextChannel = text_channel
+        self.__name : str = name
         self.options : list[str] = options
         self.__default_message : str = default_message
+        self.__header : str = ""
 
         self.__display_message : Message = None
+        self.__priority : Priority = priority
+        self.__ephemeral : bool = ephemeral
         self.page_idx : int = 0
 
     def change_options(self, options : list[str]):
         self.options = options
+        self.page_idx = 0
+        self.__header = ""
+
+    async def display(self, header : str = None, interaction : Interaction = None):
+        """Shows the current page. When interaction was a click on this menu, the refresh is its response."""
+        if header is not None:
+            self.__header = header
 
-    async def display(self, header : str = ""):        
         content = self.__get_message_content()
-        content = f"{header}\n{content}" if header != "" else content
+        content = f"{self.__header}\n{content}" if self.__header != "" else content
+        view = self.__get_view()
+
+        if interaction is not None:
+            if self.__is_my_message(interaction = interaction):
+                # Already acknowledged, the message is edited like any other update below
+                async with responding(interaction = interaction) as unanswered:
+                    if unanswered:
+                        with profiler.step("discord:interaction"):
+                            await interaction.response.edit_message(content = content, view = view)
+                        return
+
+            elif self.__ephemeral:
+                await self.__send_ephemeral(interaction = interaction, content = content, view = view)
+                return
+
+        if self.__ephemeral:
+            await self.__edit_ephemeral(content = content, view = view)
+            return
 
         if self.__display_message is not None:
-            await self.__display_message.edit(content = content)
+            await scheduler.edit(message = self.__display_message, priority = self.__priority, content = content, view = view)
+            return
+
+        self.__display_message = await scheduler.send(channel = self.__text_channel, priority = self.__priority, content = content, view = view)
+
+    async def __send_ephemeral(self, interaction : Interaction, content : str, view : View):
+        # A new answer replaces the previous one, whose options would be out of date
+        previous = self.__display_message
+        with profiler.step("discord:interaction"):
+            async with responding(interaction = interaction) as unanswered:
+                if unanswered:
+                    await interaction.response.send_message(content = content, view = view, ephemeral = True)
+                    self.__display_message = await interaction.original_response()
+                else:
+                    self.__display_message = await interaction.followup.send(content = content, view = view, ephemeral = True, wait = True)
+
+        if previous is not None:
+            try:
+                await previous.delete()
+            except HTTPException:
+                pass
+
+    async def __edit_ephemeral(self, content : str, view : View):
+        if self.__display_message is None:
             return
-            
-        self.__display_message = await self.__text_channel.send(content)
-        for reaction in self._reactions:
-            await self.__display_message.add_reaction(reaction)
-   
+
+        try:
+            with profiler.step("discord:interaction"):
+                await self.__display_message.edit(content = content, view = view)
+        except HTTPException as e:
+            # Interaction tokens only last 15 minutes
+            print(f"[DEBUG] Failed to edit ephemeral menu {self.__display_message.id} : {e}")
+
+    async def attach(self, message : Message):
+        """Reuses a menu message from a previous run, only editing it when it is out of date"""
+        self.__display_message = message
+
+        # Menus from the reaction based version still carry their reactions
+        if any(reaction.me for reaction in message.reactions):
+            scheduler.clear_reactions(message = message)
+
+        if message.content != self.__get_message_content() or not message.components:
+            await self.display()
+
+    def get_message_id(self) -> int:
+        return self.__display_message.id
+
     def get_option(self, index : int) -> str:
         if index >= len(self.options):
             return ""
-        
+
         return self.options[index]
-    
+
     def __get_message_content(self) -> str:
-        start_idx = self.page_idx * ITEMS_PER_PAGE
+        start_idx = self.page_idx
         end_idx = min(start_idx + ITEMS_PER_PAGE, len(self.options))
 
         if len(self.options) == 0:
             return self.__default_message
-        
+
         content = ""
         for i in range(start_idx, end_idx):
             index = i - start_idx
             content += f"{emote_from_index(index = index)} - {self.options[i]}\n"
-            
+
         return content
 
-    def reacted_to_me(self, reaction : Reaction) -> bool:
-        return reaction.message.id == self.__display_message.id
-    
-    async def previous_page(self):
+    def __get_view(self) -> View:
+        view = View(timeout = None)
+        if len(self.options) == 0:
+            return view
+
+        page = range(self.page_idx, min(self.page_idx + ITEMS_PER_PAGE, len(self.options)))
+        view.add_item(Select(
+            custom_id = f"music:{self.__name}:select",
+            placeholder = "Select an option",
+            options = [SelectOption(label = self.options[i][:100], value = str(i), emoji = emote_from_index(index = i - self.page_idx)) for i in page],
+            row = 0
+        ))
+
+        if len(self.options) > ITEMS_PER_PAGE:
+            view.add_item(Button(custom_id = f"music:{self.__name}:prev", emoji = "⬅️", style = ButtonStyle.secondary, disabled = self.page_idx == 0, row = 1))
+            view.add_item(Button(custom_id = f"music:{self.__name}:next", emoji = "➡️", style = ButtonStyle.secondary, disabled = self.page_idx + ITEMS_PER_PAGE >= len(self.options), row = 1))
+
+        return view
+
+    def __is_my_message(self, interaction : Interaction) -> bool:
+        return self.__display_message is not None and interaction.message is not None and interaction.message.id == self.__display_message.id
+
+    def interacted_with_me(self, interaction : Interaction) -> bool:
+        return get_custom_id(interaction = interaction).startswith(f"music:{self.__name}:") and self.__is_my_message(interaction = interaction)
+
+    async def previous_page(self, interaction : Interaction = None):
         self.page_idx = max(0, self.page_idx - ITEMS_PER_PAGE)
-        await self.display()
+        await self.display(interaction = interaction)
 
-    async def next_page(self):
+    async def next_page(self, interaction : Interaction = None):
         if self.page_idx + ITEMS_PER_PAGE < len(self.options):
             self.page_idx += ITEMS_PER_PAGE
 
-        await self.display()
+        await self.display(interaction = interaction)
 
-    async def get_selection(self, reaction : Reaction) -> int:
-        if reaction.emoji not in self._reactions:
+    async def get_selection(self, interaction : Interaction) -> int:
+        if not self.interacted_with_me(interaction = interaction):
             return -1
-        
-        if reaction.emoji == "⬅️":
-            await self.previous_page()
+
+        action = get_custom_id(interaction = interaction).split(":")[-1]
+
+        if action == "prev":
+            await self.previous_page(interaction = interaction)
+            return -1
+
+        if action == "next":
+            await self.next_page(interaction = interaction)
             return -1
-        
-        if reaction.emoji == "➡️":
-            await self.next_page()
+
+        values = interaction.data.get("values", [])
+        if action != "select" or not values:
             return -1
-        
-        
-        index = self.page_idx + emote_to_index(reaction.emoji)
+
+        # Clears the choice shown in the client, otherwise picking the same option again sends nothing.
+        # Ephemeral menus are redrawn by whatever comes next anyway.
+        if not self.__ephemeral:
+            async with responding(interaction = interaction) as unanswered:
+                if unanswered:
+                    with profiler.step("discord:interaction"):
+                        await interaction.response.edit_message(view = self.__get_view())
+
+        index = int(values[0])
         if index >= len(self.options):
             return -1
-    
+
         return index
-    
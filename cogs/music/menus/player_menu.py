@@ -1,18 +1,57 @@
-from discord import Member, Message, TextChannel, VoiceChannel, Reaction
-import wavelink
+import asyncio
+from dataclasses import dataclass
+from functools import partial
+from time import monotonic, time
 
-from cogs.music.menus.menu import Menu
+from discord import ButtonStyle, Interaction, Member, Message, TextChannel, VoiceChannel
+from discord.ui import Button, View
+import wavelink
 
 from wavelink import Playable, Player, tracks
 
+from cogs.music.database import PlayEvent, QueueSnapshot
+from cogs.music.metrics import metrics
+from cogs.music.play_history import play_history
+from cogs.music.profiler import profiler
 from cogs.music.queue import Queue
+from cogs.music.queue_journal import queue_journal
+from cogs.music.node_pool import node_pool
+from cogs.music.scheduler import Priority, scheduler
+from cogs.music.search_cache import search_cache
+from cogs.music.utils import get_custom_id, responding
+
+
+@dataclass
+class PlaybackStats:
+    """Time between the end of a track and the start of the next one, over all servers"""
+    transitions : int = 0
+    total_gap : float = 0.0
+    max_gap : float = 0.0
+    last_gap : float = 0.0
+    skipped_unavailable : int = 0
 
+    def record_gap(self, gap : float):
+        self.transitions += 1
+        self.total_gap += gap
+        self.max_gap = max(self.max_gap, gap)
+        self.last_gap = gap
+
+playback_stats = PlaybackStats()
+
+LAVALINK_LATENCY = metrics.histogram(name = "musicbot_lavalink_seconds", help = "Duration of Lavalink lookups made by the bot", label = "kind")
+PLAYER_LATENCY = metrics.histogram(name = "musicbot_player_seconds", help = "Duration of player updates: voice connections and Lavalink play, stop, pause and resume", label = "action")
 
 class PlayerMenu:
     def __init__(self, text_channel : TextChannel):
-        self.__reactions = ["⏮", "⏸", "▶", "⏭", "⏹", "🔄", "🔀", "❌","💿", "ℹ️", "🇭", "🇶"] # "🎵"
+        # custom_id action -> emoji, buttons are laid out 5 per row in this order
+        self.__buttons = {
+            "previous" : "⏮", "pause" : "⏸", "resume" : "▶", "skip" : "⏭", "stop" : "⏹",
+            "restart" : "🔄", "shuffle" : "🔀", "remove" : "❌", "add" : "💿", "info" : "ℹ️",
+            "history" : "🇭", "queue" : "🇶"
+        }
         self.__text_channel : TextChannel = text_channel
         self.__display_message : Message = None
+        self.__display_text : str = None
 
         self.__queue = Queue()
 
@@ -20,37 +59,139 @@ class PlayerMenu:
         self.__voice_channel : VoiceChannel = None
         self.__vc : Player = None
 
-    async def display(self, text : str = None):
+        # The next queued track checked ahead of time as (queued track, track to play instead)
+        self.__prefetched : tuple[Playable, Playable] = None
+        self.__prefetch_task : asyncio.Task = None
+        self.__track_ended_at : float = None
+        # (track, unix time it started, position it started from) for the play history
+        self.__now_playing : tuple[Playable, int, int] = None
+
+        self.__guild_id : int = text_channel.guild.id
+        queue_journal.register(guild_id = self.__guild_id, get_snapshot = self.get_queue_snapshot, get_position = self.get_playback_position)
+
+    async def display(self, text : str = None, interaction : Interaction = None):
+        """Shows text on the player. When interaction was a press on the player, the refresh is its response."""
         if text is None:
             text = 'Nothing playing.'
 
+        if interaction is not None and self.__is_my_message(interaction = interaction):
+            async with responding(interaction = interaction) as unanswered:
+                if unanswered:
+                    self.__display_text = text
+                    with profiler.step("discord:interaction"):
+                        await interaction.response.edit_message(content = text)
+                    return
+
         if self.__display_message is not None:
-            await self.__display_message.edit(content = text)
+            # Already shown, usually as the answer to the press that caused it
+            if text == self.__display_text:
+                return
+            self.__display_text = text
+            await scheduler.edit(message = self.__display_message, priority = Priority.PLAYER, content = text)
             return
         
-        self.__display_message = await self.__text_channel.send(text)
-        for reaction in self.__reactions:
-            await self.__display_message.add_reaction(reaction)
+        self.__display_text = text
+        self.__display_message = await scheduler.send(channel = self.__text_channel, priority = Priority.PLAYER, content = text, view = self.__get_view())
+
+    async def attach(self, message : Message):
+        """Reuses the player message from a previous run, only editing it when it is out of date"""
+        self.__display_message = message
+        self.__display_text = 'Nothing playing.'
+
+        # Player messages from the reaction based version still carry their reactions
+        if any(reaction.me for reaction in message.reactions):
+            scheduler.clear_reactions(message = message)
+
+        if message.content != 'Nothing playing.' or not message.components:
+            await scheduler.edit(message = message, priority = Priority.PLAYER, content = 'Nothing playing.', view = self.__get_view())
+
+    def __get_view(self) -> View:
+        view = View(timeout = None)
+        for i, (action, emoji) in enumerate(self.__buttons.items()):
+            view.add_item(Button(custom_id = f"music:player:{action}", emoji = emoji, style = ButtonStyle.secondary, row = i // 5))
+        return view
+
+    def get_message_id(self) -> int:
+        return self.__display_message.id
+
+    def interacted_with_me(self, interaction : Interaction) -> bool:
+        return get_custom_id(interaction = interaction).startswith("music:player:")
+
+    def __is_my_message(self, interaction : Interaction) -> bool:
+        return self.__display_message is not None and interaction.message is not None and interaction.message.id == self.__display_message.id
 
-    def reacted_to_me(self, reaction : Reaction) -> bool:
-        return reaction.message.id == self.__display_message.id
+    def get_action(self, interaction : Interaction) -> str:
+        return get_custom_id(interaction = interaction).split(":")[-1]
 
     async def search_query(self, query : str) -> wavelink.Search:
-        return await wavelink.Playable.search(query)
+        with LAVALINK_LATENCY.time("search"):
+            return await search_cache.get(query = query, loader = lambda query: Playable.search(query, node = node_pool.get_best_node()))
+    
+    async def load_playlist(self, url : str) -> wavelink.Playlist:
+        """Loads a playlist url of any enabled source, None if it is not a playlist. Not cached, playlists can be large."""
+        try:
+            with LAVALINK_LATENCY.time("playlist"):
+                result = await Playable.search(url, node = node_pool.get_best_node())
+        except wavelink.LavalinkLoadException as e:
+            print(f"[DEBUG] Failed to load {url} : {e}")
+            return None
+
+        return result if isinstance(result, wavelink.Playlist) else None
     
     async def queue_track(self, track : tracks.Playable, user : Member) -> bool:
         joined = await self.join_voice_channel(user = user)
         if not joined:
             return False
      
-        added = self.__queue.add_track(track)
-        print(f"[DEBUG] Added {track.title} to queue" if added else "Failed to add song to queue")
+        return await self.add_tracks(tracks = [track], requester_id = user.id)
+
+    async def add_tracks(self, tracks : list[tracks.Playable], requester_id : int = 0) -> bool:
+        """Queues tracks in the already joined voice channel and starts playing if idle."""
+        if self.__vc is None:
+            return False
+
+        added_tracks = []
+        for track in tracks:
+            if track is not None:
+                track = self.__with_requester(track = track, requester_id = requester_id)
+            added = self.__queue.add_track(track)
+            print(f"[DEBUG] Added {track.title} to queue" if added else "Failed to add song to queue")
+            if added:
+                added_tracks.append(track.encoded)
+        queue_journal.record(self.__guild_id, "add_tracks", added_tracks)
 
         return await self.__play()
         
     
+    @staticmethod
+    def __with_requester(track : Playable, requester_id : int) -> Playable:
+        # Search results are cached and shared between servers, the requester goes on a copy
+        track = Playable(data = track.raw_data)
+        track.extras = {"requester_id" : requester_id}
+        return track
+
+    def __log_play(self, skipped : bool):
+        if self.__now_playing is None:
+            return
+
+        track, started_at, start = self.__now_playing
+        self.__now_playing = None
+
+        position = self.__vc.position if skipped and self.__vc is not None else track.length
+        play_history.record(PlayEvent(
+            guild_id = self.__guild_id,
+            user_id = getattr(track.extras, "requester_id", 0),
+            track_id = track.identifier,
+            title = track.title,
+            started_at = started_at,
+            played_ms = max(0, position - start),
+            skipped = skipped
+        ))
+
     async def play_next_track(self) -> bool:
+        self.__log_play(skipped = False)
         self.__is_playing = False
+        self.__track_ended_at = monotonic()
         if self.__queue.is_empty():
             return False
 
@@ -58,6 +199,15 @@ class PlayerMenu:
         return await self.__play()
         
 
+    async def resume_stalled(self) -> bool:
+        """Plays the next track when the player was moved off a node while nothing was playing:
+        a skip sent to a node that was going down never gets its track end event"""
+        if self.__is_playing or self.__vc is None or self.__queue.is_empty():
+            return False
+
+        print(f"[DEBUG] Resuming the queue of {self.__guild_id} after moving its player")
+        return await self.play_next_track()
+
     async def join_voice_channel(self, user : Member) -> bool:
         if not getattr(user.voice, 'channel', None):
             return False
@@ -65,25 +215,129 @@ class PlayerMenu:
         new_channel = user.voice.channel
         if self.__voice_channel is None or new_channel.id != self.__voice_channel.id:
             self.__voice_channel = new_channel
-            self.__vc : Player = await self.__voice_channel.connect(cls = Player)
+            with PLAYER_LATENCY.time("connect"):
+                self.__vc : Player = await self.__voice_channel.connect(cls = partial(Player, nodes = [node_pool.get_best_node()]))
 
         return True
     
-    async def __play(self) -> bool:
+    async def __play(self, start : int = 0) -> bool:
         if self.__is_playing:
             return True
         
         
         track = self.__queue.get_next_track()
+        if track is None:
+            return False
+        queue_journal.record(self.__guild_id, "get_next_track")
+
+        if self.__prefetched is not None and self.__prefetched[0] is track:
+            track = self.__prefetched[1]
+        self.__prefetched = None
+
+        # Audio first, the player message can wait
+        with PLAYER_LATENCY.time("play"):
+            await self.__vc.play(track, start = start)
+        self.__is_playing = True
+        self.__now_playing = (track, int(time()), start)
+        if self.__track_ended_at is not None:
+            playback_stats.record_gap(monotonic() - self.__track_ended_at)
+            self.__track_ended_at = None
+
+        self.__start_prefetch()
 
         url = track.uri
-        await self.display(text = url)
         print(f"[DEBUG] Playing {track.title} | {url}")
-        await self.__vc.play(track)
-        self.__is_playing = True
+        await self.display(text = url)
 
         return True
+
+    def __start_prefetch(self):
+        if self.__prefetch_task is not None:
+            self.__prefetch_task.cancel()
+        self.__prefetch_task = asyncio.create_task(self.__prefetch_next())
+
+    async def __prefetch_next(self):
+        """Checks the next queued track while the current one plays, unavailable ones are removed from the queue before their turn"""
+        while True:
+            track = self.__queue.peek_next_track()
+            if track is None:
+                return
+
+            try:
+                checked = await self.__check_track(track = track)
+            except Exception as e:
+                # Nobody awaits this task, the queued track is played as it is instead
+                print(f"[DEBUG] Could not check {track.uri} : {type(e).__name__} {e}")
+                checked = track
+
+            # The queue changed while checking, check whatever is next now
+            if self.__queue.peek_next_track() is not track:
+                continue
+
+            if checked is not None:
+                checked.extras = dict(track.extras)
+                self.__prefetched = (track, checked)
+                return
+
+            print(f"[DEBUG] Skipping unavailable {track.title} | {track.uri}")
+            self.__queue.remove_track(0)
+            queue_journal.record(self.__guild_id, "remove_track", 0)
+            playback_stats.skipped_unavailable += 1
+
+    @staticmethod
+    async def __check_track(track : Playable) -> Playable:
+        """Loads the track again from its uri. Returns None if it is gone, or the track itself when Lavalink cannot tell."""
+        if not track.uri:
+            return track
+
+        # Not the search cache, a cached answer cannot tell whether the track is still available
+        try:
+            with LAVALINK_LATENCY.time("check"):
+                results = await Playable.search(track.uri, node = node_pool.get_best_node())
+        except wavelink.LavalinkLoadException:
+            return None
+        except (wavelink.LavalinkException, wavelink.NodeException) as e:
+            print(f"[DEBUG] Could not check {track.uri} : {e}")
+            return track
+
+        if isinstance(results, wavelink.Playlist):
+            return track
+        if len(results) == 0:
+            return None
+        return results[0]
+
+    async def restore(self, voice_channel_id : int, encoded : list[str], index : int, position : int) -> bool:
+        """Rejoins the voice channel of a queue saved before a restart and resumes its current track near position"""
+        voice_channel = self.__text_channel.guild.get_channel(voice_channel_id) if voice_channel_id is not None else None
+        if voice_channel is None or not 0 <= index < len(encoded):
+            return False
+
+        tracks = await self.decode_tracks(encoded = encoded)
+        if len(tracks) != len(encoded):
+            return False
+
+        self.__voice_channel = voice_channel
+        self.__vc : Player = await voice_channel.connect(cls = partial(Player, nodes = [node_pool.get_best_node()]))
+
+        # __play moves to the next track, start one before the current one
+        self.__queue.load(tracks = tracks, index = index - 1)
+        queue_journal.request_snapshot(guild_id = self.__guild_id)
+        return await self.__play(start = position)
+
+    def get_queue_snapshot(self) -> QueueSnapshot:
+        tracks, index = self.__queue.get_state()
+        voice_channel_id, position = self.get_playback_position()
+        return QueueSnapshot(guild_id = self.__guild_id, voice_channel_id = voice_channel_id, tracks = [track.encoded for track in tracks], index = index, position = position)
+
+    def get_playback_position(self) -> tuple[int, int]:
+        # No voice channel means nothing to resume after a restart
+        if not self.__is_playing or self.__vc is None:
+            return None, 0
+        return self.__voice_channel.id, self.__vc.position
     
+    def get_queue_length(self) -> int:
+        return self.__queue.get_queue_length()
+
     def get_current_track(self) -> tracks.Playable:
         return self.__queue.get_current_track()
     
@@ -93,12 +347,17 @@ class PlayerMenu:
     def get_queued_tracks(self) -> list[tracks.Playable]:
         return self.__queue.get_queued_tracks()
 
-    def get_reactions(self) -> list[str]:
-        return self.__reactions
+    def get_buttons(self) -> dict[str, str]:
+        return self.__buttons
     
-    async def get_track_from_video_id(self, video_id : str) -> tracks.Playable:
-        url = f"https://www.youtube.com/watch?v={video_id}"
-        tracks = await Playable.search(url)
+    async def get_track_from_uri(self, uri : str) -> tracks.Playable:
+        """Loads a track from any source enabled on Lavalink (youtube, soundcloud, bandcamp...) by its uri"""
+        try:
+            with LAVALINK_LATENCY.time("resolve"):
+                tracks = await Playable.search(uri, node = node_pool.get_best_node())
+        except wavelink.LavalinkLoadException as e:
+            print(f"[DEBUG] Failed to load {uri} : {e}")
+            return None
         
         # Not sure if this is enough for when a video is deleted/privated, maybe a try catch is better, time will tell when a song video is deleted
         if len(tracks) == 0:
@@ -106,46 +365,96 @@ class PlayerMenu:
         
         return tracks[0]
     
+    async def decode_tracks(self, encoded : list[str]) -> list[tracks.Playable]:
+        """Rebuilds stored tracks with a single Lavalink decode call. Returns an empty list if the batch is rejected."""
+        if not encoded:
+            return []
+
+        node = node_pool.get_best_node()
+        try:
+            with LAVALINK_LATENCY.time("decode"):
+                data = await node.send("POST", path = "v4/decodetracks", data = encoded)
+        except (wavelink.LavalinkException, wavelink.NodeException) as e:
+            print(f"[DEBUG] Failed to decode {len(encoded)} stored tracks : {e}")
+            return []
+
+        return [Playable(data = track_data) for track_data in data]
+    
     def get_voice_channel(self) -> VoiceChannel:
         return self.__voice_channel
     
-    async def pause(self):
+    async def __show_next(self, interaction : Interaction = None):
+        """Answers a press that ended the current track with the track about to play, the player is then up to date when it starts"""
+        track = self.__queue.peek_next_track()
+        await self.display(text = track.uri if track is not None else self.__display_text, interaction = interaction)
+
+    async def pause(self, interaction : Interaction = None):
         if self.__vc is not None:
-            await self.__vc.pause()
+            with PLAYER_LATENCY.time("pause"):
+                await self.__vc.pause()
+            if self.__is_playing:
+                await self.display(text = f"Paused : {self.__queue.get_current_track().uri}", interaction = interaction)
 
-    async def previous(self):
-        if self.__is_playing and len(self.__queue.get_history_tracks()) > 0:
+    async def previous(self, interaction : Interaction = None):
+        if self.__is_playing and self.__queue.get_history_length() > 0:
             self.__queue.skip_by(jump = -2)
-            await self.__vc.stop()
+            queue_journal.record(self.__guild_id, "skip_by", -2)
+            self.__log_play(skipped = True)
+            with PLAYER_LATENCY.time("stop"):
+                await self.__vc.stop()
             self.__is_playing = False
+            await self.__show_next(interaction = interaction)
 
-    async def restart(self):
+    async def restart(self, interaction : Interaction = None):
         if self.__is_playing:
             self.__queue.skip_by(jump = -1)
-            await self.__vc.stop()
+            queue_journal.record(self.__guild_id, "skip_by", -1)
+            self.__log_play(skipped = True)
+            with PLAYER_LATENCY.time("stop"):
+                await self.__vc.stop()
             self.__is_playing = False
+            await self.__show_next(interaction = interaction)
 
-    async def resume(self):
+    async def resume(self, interaction : Interaction = None):
         if self.__vc is not None:
-            await self.__vc.resume()
+            with PLAYER_LATENCY.time("resume"):
+                await self.__vc.resume()
+            if self.__is_playing:
+                await self.display(text = self.__queue.get_current_track().uri, interaction = interaction)
 
     def shuffle(self):
         self.__queue.shuffle()
+        queue_journal.record(self.__guild_id, "shuffle")
     
-    async def skip(self):
+    async def skip(self, interaction : Interaction = None):
         if self.__is_playing:
-            await self.__vc.stop()
+            self.__log_play(skipped = True)
+            with PLAYER_LATENCY.time("stop"):
+                await self.__vc.stop()
             self.__is_playing = False
+            await self.__show_next(interaction = interaction)
+
+    async def stop(self, interaction : Interaction = None):
+        if self.__prefetch_task is not None:
+            self.__prefetch_task.cancel()
+            self.__prefetch_task = None
+        self.__prefetched = None
 
-    async def stop(self):
+        self.__log_play(skipped = True)
         self.__queue.reset()
+        queue_journal.record(self.__guild_id, "reset")
 
         if self.__vc is not None:
-            await self.__vc.stop()
-            await self.__vc.disconnect()
+            with PLAYER_LATENCY.time("disconnect"):
+                try:
+                    await self.__vc.stop()
+                except (wavelink.LavalinkException, wavelink.NodeException) as e:
+                    # The node went down with the player on it, disconnecting still leaves the voice channel
+                    print(f"[DEBUG] Could not stop the player of {self.__guild_id} : {e}")
+                await self.__vc.disconnect()
 
         self.__is_playing : bool = False
         self.__voice_channel : VoiceChannel = None
         self.__vc : Player = None
 
-        await self.display(text = "Not playing anything.")
+        await self.display(text = "Not playing anything.", interaction = interaction)
@@ -0,0 +1,163 @@
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from time import monotonic, perf_counter
+from typing import Callable, Iterator
+
+from cogs.music.profiler import profiler
+from config import METRICS_HOST, METRICS_PORT, LOOP_LAG_INTERVAL
+
+# Seconds, from a cached lookup to a slow Lavalink search
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape(value : str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labels : dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels.items()) + "}"
+
+@dataclass
+class HistogramSeries:
+    buckets : list[int]
+    sum : float = 0.0
+    count : int = 0
+
+@dataclass
+class Histogram:
+    name : str
+    help : str
+    label : str = None
+    buckets : tuple[float, ...] = DEFAULT_BUCKETS
+    series : dict[str, HistogramSeries] = field(default_factory = dict)
+
+    def observe(self, value : float, label_value : str = ""):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = HistogramSeries(buckets = [0] * len(self.buckets))
+
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series.buckets[index] += 1
+        series.sum += value
+        series.count += 1
+
+    @contextmanager
+    def time(self, label_value : str = "") -> Iterator[None]:
+        """Also a step of the handler being profiled, named after the histogram and label (musicbot_db_seconds, read -> db:read)"""
+        start = perf_counter()
+        try:
+            with profiler.step(f"{self.name.removeprefix('musicbot_').removesuffix('_seconds')}:{label_value}"):
+                yield
+        finally:
+            self.observe(perf_counter() - start, label_value = label_value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in self.series.items():
+            labels = {self.label : label_value} if self.label else {}
+
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.buckets):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le' : repr(bound)})} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels({**labels, 'le' : '+Inf'})} {series.count}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series.sum}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series.count}")
+        return lines
+
+def render_samples(name : str, help : str, kind : str, samples : list[tuple[dict[str, str], float]]) -> list[str]:
+    """Renders a gauge or counter read at scrape time, samples are (labels, value)"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    lines.extend(f"{name}{format_labels(labels)} {value}" for labels, value in samples)
+    return lines
+
+class MetricsRegistry:
+    """Prometheus text metrics of the bot, served on METRICS_HOST:METRICS_PORT at /metrics.
+    Histograms are filled where things happen, everything else is read from its owner by collectors at scrape time."""
+
+    def __init__(self):
+        self.__histograms : dict[str, Histogram] = {}
+        self.__collectors : list[Callable[[], list[str]]] = []
+        self.__server : asyncio.Server = None
+        self.__lag_task : asyncio.Task = None
+
+        self.loop_lag = self.histogram(name = "musicbot_event_loop_lag_seconds", help = "How late the event loop woke up a sleeping task")
+        self.__last_lag : float = 0.0
+        self.add_collector(lambda: render_samples("musicbot_event_loop_lag_last_seconds", "Last measured event loop lag", "gauge", [({}, self.__last_lag)]))
+
+    def histogram(self, name : str, help : str, label : str = None, buckets : tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        histogram = self.__histograms.get(name)
+        if histogram is None:
+            histogram = self.__histograms[name] = Histogram(name = name, help = help, label = label, buckets = buckets)
+        return histogram
+
+    def add_collector(self, collector : Callable[[], list[str]]):
+        self.__collectors.append(collector)
+
+    def remove_collector(self, collector : Callable[[], list[str]]):
+        if collector in self.__collectors:
+            self.__collectors.remove(collector)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.__histograms.values():
+            lines.extend(histogram.render())
+
+        for collector in self.__collectors:
+            try:
+                lines.extend(collector())
+            except Exception as e:
+                # One broken collector must not hide every other metric
+                print(f"[DEBUG] Metrics collector failed : {e}")
+        return "\n".join(lines) + "\n"
+
+    # ---------------------- SERVER --------------------------#
+    async def start(self, host : str = METRICS_HOST, port : int = METRICS_PORT):
+        if self.__lag_task is None:
+            self.__lag_task = asyncio.create_task(self.__watch_loop_lag())
+
+        if port is None or self.__server is not None:
+            return
+
+        self.__server = await asyncio.start_server(self.__handle, host = host, port = port)
+        print(f"Metrics served on http://{host}:{port}/metrics")
+
+    async def close(self):
+        if self.__lag_task is not None:
+            self.__lag_task.cancel()
+            self.__lag_task = None
+
+        if self.__server is not None:
+            self.__server.close()
+            await self.__server.wait_closed()
+            self.__server = None
+
+    async def __handle(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout = 5)
+            method, path = request.split(b" ", 2)[:2]
+
+            if method == b"GET" and path.split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not Found\n"
+
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def __watch_loop_lag(self):
+        while True:
+            start = monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.__last_lag = max(0.0, monotonic() - start - LOOP_LAG_INTERVAL)
+            self.loop_lag.observe(self.__last_lag)
+
+
+metrics = MetricsRegistry()
@@ -0,0 +1,74 @@
+import sqlite3
+
+# Each entry upgrades the schema by one version, the applied version is kept in PRAGMA user_version.
+# Never edit an entry that has been released, append a new one instead.
+MIGRATIONS : list[list[str]] = [
+    # 1 - Original schema
+    [
+        "CREATE TABLE IF NOT EXISTS PLAYLIST(ID INTEGER PRIMARY KEY AUTOINCREMENT, author_id INTEGER, name varchar(30))",
+        "CREATE TABLE IF NOT EXISTS SONG_PLAYLIST(video_id varchar(11), playlist_id INT, PRIMARY KEY(video_id, playlist_id))",
+        "CREATE TABLE IF NOT EXISTS TRACK(video_id varchar(11) PRIMARY KEY, encoded TEXT, title TEXT, author TEXT, length INTEGER, updated_at INTEGER)",
+    ],
+    # 2 - Unique playlist names per author, songs keyed by playlist first and deleted with their playlist
+    [
+        "UPDATE OR IGNORE SONG_PLAYLIST SET playlist_id = (SELECT MIN(k.ID) FROM PLAYLIST d JOIN PLAYLIST k ON k.author_id = d.author_id AND k.name = d.name WHERE d.ID = SONG_PLAYLIST.playlist_id) WHERE playlist_id IN (SELECT ID FROM PLAYLIST)",
+        "DELETE FROM PLAYLIST WHERE ID NOT IN (SELECT MIN(ID) FROM PLAYLIST GROUP BY author_id, name)",
+        "CREATE UNIQUE INDEX PLAYLIST_AUTHOR_NAME ON PLAYLIST(author_id, name)",
+        "CREATE TABLE SONG_PLAYLIST_V2(video_id varchar(11) NOT NULL, playlist_id INTEGER NOT NULL REFERENCES PLAYLIST(ID) ON DELETE CASCADE, PRIMARY KEY(playlist_id, video_id))",
+        "INSERT INTO SONG_PLAYLIST_V2 (video_id, playlist_id) SELECT video_id, playlist_id FROM SONG_PLAYLIST WHERE playlist_id IN (SELECT ID FROM PLAYLIST) ORDER BY rowid",
+        "DROP TABLE SONG_PLAYLIST",
+        "ALTER TABLE SONG_PLAYLIST_V2 RENAME TO SONG_PLAYLIST",
+    ],
+    # 3 - Menu messages of each server, reused after a restart
+    [
+        "CREATE TABLE GUILD_MENU(guild_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, command_message_id INTEGER NOT NULL, selection_message_id INTEGER NOT NULL, player_message_id INTEGER NOT NULL)",
+    ],
+    # 4 - Queue of each server: last snapshot plus the changes made since, replayed after a restart
+    [
+        "CREATE TABLE QUEUE_SNAPSHOT(guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER, tracks TEXT NOT NULL, track_index INTEGER NOT NULL, position INTEGER NOT NULL DEFAULT 0, updated_at INTEGER NOT NULL)",
+        "CREATE TABLE QUEUE_JOURNAL(id INTEGER PRIMARY KEY AUTOINCREMENT, guild_id INTEGER NOT NULL, op TEXT NOT NULL, args TEXT NOT NULL)",
+        "CREATE INDEX QUEUE_JOURNAL_GUILD ON QUEUE_JOURNAL(guild_id, id)",
+    ],
+    # 5 - Every played track, with per server play counts kept up to date alongside for the top commands
+    [
+        "CREATE TABLE PLAY_EVENT(id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, track_id TEXT NOT NULL, started_at INTEGER NOT NULL, played_ms INTEGER NOT NULL, skipped INTEGER NOT NULL)",
+        "CREATE INDEX PLAY_EVENT_GUILD_STARTED ON PLAY_EVENT(guild_id, started_at)",
+        "CREATE TABLE TRACK_PLAYS(guild_id INTEGER NOT NULL, track_id TEXT NOT NULL, title TEXT NOT NULL, plays INTEGER NOT NULL, skips INTEGER NOT NULL, played_ms INTEGER NOT NULL, PRIMARY KEY(guild_id, track_id))",
+        "CREATE INDEX TRACK_PLAYS_TOP ON TRACK_PLAYS(guild_id, plays DESC)",
+        "CREATE TABLE USER_PLAYS(guild_id INTEGER NOT NULL, user_id INTEGER NOT NULL, plays INTEGER NOT NULL, skips INTEGER NOT NULL, played_ms INTEGER NOT NULL, PRIMARY KEY(guild_id, user_id))",
+        "CREATE INDEX USER_PLAYS_TOP ON USER_PLAYS(guild_id, plays DESC)",
+    ],
+    # 6 - Songs of any Lavalink source, keyed by track identifier and listed without resolving them: metadata is captured when they are added
+    [
+        "CREATE TABLE SONG_PLAYLIST_V3(playlist_id INTEGER NOT NULL REFERENCES PLAYLIST(ID) ON DELETE CASCADE, track_id TEXT NOT NULL, source TEXT NOT NULL, uri TEXT NOT NULL, title TEXT, author TEXT, length INTEGER, PRIMARY KEY(playlist_id, track_id))",
+        "INSERT INTO SONG_PLAYLIST_V3 (playlist_id, track_id, source, uri, title, author, length) SELECT s.playlist_id, s.video_id, 'youtube', 'https://www.youtube.com/watch?v=' || s.video_id, t.title, t.author, t.length FROM SONG_PLAYLIST s LEFT JOIN TRACK t ON t.video_id = s.video_id ORDER BY s.rowid",
+        "DROP TABLE SONG_PLAYLIST",
+        "ALTER TABLE SONG_PLAYLIST_V3 RENAME TO SONG_PLAYLIST",
+        # Entries of a playlist in the order they were added, the rowid comes with every index entry
+        "CREATE INDEX SONG_PLAYLIST_ORDER ON SONG_PLAYLIST(playlist_id)",
+        "ALTER TABLE TRACK RENAME COLUMN video_id TO track_id",
+    ],
+    # 7 - Entries still missing their metadata by track, so storing a resolved track fills them without scanning every playlist
+    [
+        "CREATE INDEX SONG_PLAYLIST_MISSING ON SONG_PLAYLIST(track_id) WHERE title IS NULL",
+    ],
+]
+
+def get_version(connection : sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(connection : sqlite3.Connection) -> int:
+    """Applies the missing migrations in order and returns the resulting schema version."""
+    version = get_version(connection = connection)
+
+    for target, statements in enumerate(MIGRATIONS, start = 1):
+        if target <= version:
+            continue
+
+        for statement in statements:
+            connection.execute(statement)
+        connection.execute(f"PRAGMA user_version = {target}")
+        print(f"[DEBUG] Migrated database to version {target}")
+        version = target
+
+    return version
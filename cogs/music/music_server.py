@@ -1,38 +1,77 @@
-from discord.ext import commands
-from discord import Message, Reaction, Member
+import asyncio
+
+from discord import Guild, HTTPException, Interaction, Message, Member, TextChannel
+from discord.errors import Forbidden, NotFound
 from cogs.music.control import Control
-from cogs.music.database import Database
+from cogs.music.database import Database, GuildMenus
+from cogs.music.event_filter import event_filter
+from cogs.music.utils import responding
+from config import INTERACTION_ACK_DELAY, MENU_HISTORY_LIMIT
 
 from cogs.music.logger import Logger
 
 class MusicServer:
-    def __init__(self):
+    def __init__(self, database : Database):
         self.__initialized = False
         self.__logger : Logger = None
-        self.__database : Database = None
+        self.__database : Database = database
         self.__control : Control = None
+        self.__text_channel : TextChannel = None
 
-    async def setup(self, ctx : commands.Context):        
-        text_channels = ctx.guild.text_channels
-        channel_names = [str(channel) for channel in text_channels]
-        if 'music-bot' not in channel_names:
-            text_channel = await ctx.guild.create_text_channel('music-bot')
-        else:
-            text_channel = text_channels[channel_names.index('music-bot')]
-        
-        await text_channel.purge()
+    async def setup(self, guild : Guild, menus : GuildMenus = None):
+        """Reattaches to the menus stored for this guild, or creates them in a clean music-bot channel when they are gone"""
+        text_channel = guild.get_channel(menus.channel_id) if menus is not None else None
+        messages = await self.__fetch_menu_messages(text_channel = text_channel, menus = menus) if text_channel is not None else None
 
-        self.__database = Database()
+        if messages is None:
+            text_channel = await self.__get_text_channel(guild = guild)
+            await text_channel.purge()
+        self.__text_channel = text_channel
                
         self.__logger = Logger(text_channel = text_channel)
-        await self.send_notification("Initializing, please wait...")
+        if messages is None:
+            await self.send_notification("Initializing, please wait...")
         
         self.__control = Control(text_channel = text_channel, database = self.__database, logger = self.__logger)
-        await self.__control.setup()
+        await self.__control.setup(messages = messages)
+
+        if messages is None:
+            await self.__logger.clear()
 
-        await self.__logger.clear()
+        await self.__database.save_guild_menus(menus = GuildMenus(guild.id, text_channel.id, *self.__control.get_menu_message_ids()))
+        event_filter.register(guild_id = guild.id, channel_id = text_channel.id)
         self.__initialized = True
 
+    @staticmethod
+    async def __get_text_channel(guild : Guild) -> TextChannel:
+        text_channels = guild.text_channels
+        channel_names = [str(channel) for channel in text_channels]
+        if 'music-bot' not in channel_names:
+            return await guild.create_text_channel('music-bot')
+        
+        return text_channels[channel_names.index('music-bot')]
+
+    @staticmethod
+    async def __fetch_menu_messages(text_channel : TextChannel, menus : GuildMenus) -> list[Message]:
+        """Returns the stored (command, selection, player) messages, or None if any of them is gone"""
+        ids = [menus.command_message_id, menus.selection_message_id, menus.player_message_id]
+        found = {}
+        try:
+            # The menus are the oldest messages of the channel, one history page usually returns all of them
+            async for message in text_channel.history(limit = MENU_HISTORY_LIMIT, oldest_first = True):
+                if message.id in ids:
+                    found[message.id] = message
+                if len(found) == len(ids):
+                    break
+
+            for message_id in ids:
+                if message_id not in found:
+                    found[message_id] = await text_channel.fetch_message(message_id)
+        except (NotFound, Forbidden):
+            return None
+
+        return [found[message_id] for message_id in ids]
+
     async def process_message(self, message : Message):
         if not self.__initialized:
             return
@@ -40,15 +79,48 @@ class MusicServer:
         return await self.__control.process_input(message = message)
         
 
-    async def process_reaction(self, reaction : Reaction, user : Member):
-        if not self.__initialized:
+    async def process_interaction(self, interaction : Interaction, user : Member):
+        if not self.__initialized or not self.__control.interacted_with_me(interaction = interaction):
             return
-        
-        if self.__control.reacted_to_me(reaction = reaction):
-            return await self.__control.process_input(reaction = reaction, user = user)
+
+        # Discord drops interactions left unanswered for 3 seconds, slow requests are deferred before that
+        ack = asyncio.get_running_loop().call_later(INTERACTION_ACK_DELAY, lambda: asyncio.create_task(self.__acknowledge(interaction = interaction)))
+        try:
+            await self.__control.process_input(interaction = interaction, user = user)
+        finally:
+            ack.cancel()
+            await self.__acknowledge(interaction = interaction)
+
+    @staticmethod
+    async def __acknowledge(interaction : Interaction):
+        # Waits for a response being sent by the handler instead of sending a second one
+        async with responding(interaction = interaction) as unanswered:
+            if not unanswered:
+                return
+
+            try:
+                await interaction.response.defer()
+            except HTTPException as e:
+                print(f"[DEBUG] Failed to acknowledge interaction {interaction.id} : {e}")
+
+    def get_queue_length(self) -> int:
+        return self.__control.get_queue_length() if self.__initialized else 0
+
+    def get_session_count(self) -> int:
+        return self.__control.get_session_count() if self.__initialized else 0
 
     async def send_notification(self, text : str, embed = None):
         await self.__logger.send(text = text, embed = embed)
 
     async def song_ended_notification(self):
         await self.__control.song_ended_notification()
+
+    async def player_moved_notification(self):
+        if self.__initialized:
+            await self.__control.player_moved_notification()
+
+    async def restore_queue(self, voice_channel_id : int, encoded : list[str], index : int, position : int) -> bool:
+        if not self.__initialized:
+            return False
+
+        return await self.__control.restore_queue(voice_channel_id = voice_channel_id, encoded = encoded, index = index, position = position)
@@ -0,0 +1,157 @@
+import asyncio
+from dataclasses import dataclass
+
+import discord
+import wavelink
+
+from config import LAVALINK_NODES, NODE_STATS_INTERVAL, NODE_MAX_CPU_LOAD, NODE_MAX_FRAME_DEFICIT
+
+# Frames Lavalink expects to send per player per minute
+FRAMES_PER_MINUTE = 3000
+
+@dataclass
+class NodeLoad:
+    system_load : float = 0.0
+    deficit : float = 0.0
+    nulled : float = 0.0
+
+    def is_degraded(self) -> bool:
+        return self.system_load >= NODE_MAX_CPU_LOAD or self.deficit >= NODE_MAX_FRAME_DEFICIT
+
+class NodePool:
+    """Places players on the least loaded Lavalink node and moves them away from nodes that disconnect, degrade or are drained."""
+
+    def __init__(self):
+        self.__client : discord.Client = None
+        self.__loads : dict[str, NodeLoad] = {}
+        self.__drained : set[str] = set()
+        self.__stats_task : asyncio.Task = None
+
+    async def connect(self, client : discord.Client):
+        self.__client = client
+
+        nodes = [
+            wavelink.Node(uri = f"http://{node['host']}:{node['port']}", password = node['password'], identifier = node['identifier'])
+            for node in LAVALINK_NODES
+        ]
+        await wavelink.Pool.connect(client = client, nodes = nodes)
+
+        if self.__stats_task is None:
+            self.__stats_task = asyncio.create_task(self.__watch_stats())
+
+    def close(self):
+        if self.__stats_task is not None:
+            self.__stats_task.cancel()
+            self.__stats_task = None
+
+    # ---------------------- PLACEMENT --------------------------#
+    def get_score(self, node : wavelink.Node) -> float:
+        """Lavalink's usual penalty formula, lower is better. The player count is live, CPU and frames come from the last stats."""
+        load = self.__loads.get(node.identifier, NodeLoad())
+
+        cpu_penalty = 1.05 ** (100 * load.system_load) * 10 - 10
+        deficit_penalty = 1.03 ** (500 * load.deficit) * 600 - 600
+        nulled_penalty = (1.03 ** (500 * load.nulled) * 300 - 300) * 2
+
+        return len(node.players) + cpu_penalty + deficit_penalty + nulled_penalty
+
+    def get_available_nodes(self, exclude : wavelink.Node = None) -> list[wavelink.Node]:
+        return [
+            node for node in wavelink.Pool.nodes.values()
+            if node.status is wavelink.NodeStatus.CONNECTED
+            and node.identifier not in self.__drained
+            and (exclude is None or node.identifier != exclude.identifier)
+        ]
+
+    def get_best_node(self, exclude : wavelink.Node = None) -> wavelink.Node:
+        nodes = self.get_available_nodes(exclude = exclude)
+        if not nodes:
+            # Everything is drained or down, let wavelink pick (or raise) rather than refusing to play
+            return wavelink.Pool.get_node()
+
+        return min(nodes, key = self.get_score)
+
+    def get_players(self, node : wavelink.Node) -> list[wavelink.Player]:
+        # node.players is emptied when the websocket drops, the voice clients still know where they were
+        if self.__client is None:
+            return []
+
+        return [
+            voice_client for voice_client in self.__client.voice_clients
+            if isinstance(voice_client, wavelink.Player) and voice_client.node.identifier == node.identifier
+        ]
+
+    # ---------------------- MIGRATION --------------------------#
+    async def migrate_players(self, node : wavelink.Node, players : list[wavelink.Player] = None) -> int:
+        """Moves the players of node to the best other nodes. Returns how many were moved."""
+        if players is None:
+            players = self.get_players(node = node)
+
+        moved = 0
+        for player in players:
+            target = self.get_best_node(exclude = node)
+            if target.identifier == node.identifier:
+                print(f"[DEBUG] No other Lavalink node to move players of {node.identifier} to")
+                break
+
+            try:
+                await player.switch_node(target)
+                moved += 1
+                # Handled by MusicCog.on_player_moved
+                self.__client.dispatch("player_moved", player)
+            except (RuntimeError, wavelink.InvalidNodeException, wavelink.LavalinkException, wavelink.NodeException) as e:
+                print(f"[DEBUG] Failed to move player {player.guild.id} from {node.identifier} to {target.identifier} : {e}")
+
+        if players:
+            print(f"[DEBUG] Moved {moved}/{len(players)} players off Lavalink node {node.identifier}")
+        return moved
+
+    async def drain(self, identifier : str) -> int:
+        """Stops placing players on a node and moves its current players away."""
+        node = wavelink.Pool.get_node(identifier)
+        self.__drained.add(identifier)
+        return await self.migrate_players(node = node)
+
+    def undrain(self, identifier : str):
+        self.__drained.discard(identifier)
+
+    def is_drained(self, identifier : str) -> bool:
+        return identifier in self.__drained
+
+    # ---------------------- STATS --------------------------#
+    async def refresh_stats(self):
+        for node in list(wavelink.Pool.nodes.values()):
+            if node.status is not wavelink.NodeStatus.CONNECTED:
+                continue
+
+            try:
+                stats = await node.fetch_stats()
+            except (wavelink.LavalinkException, wavelink.NodeException) as e:
+                print(f"[DEBUG] Failed to fetch stats of Lavalink node {node.identifier} : {e}")
+                continue
+
+            load = NodeLoad(system_load = stats.cpu.system_load)
+            if stats.frames is not None:
+                load.deficit = max(0, stats.frames.deficit) / FRAMES_PER_MINUTE
+                load.nulled = max(0, stats.frames.nulled) / FRAMES_PER_MINUTE
+            self.__loads[node.identifier] = load
+
+    def get_load(self, identifier : str) -> NodeLoad:
+        return self.__loads.get(identifier, NodeLoad())
+
+    async def __watch_stats(self):
+        while True:
+            await asyncio.sleep(NODE_STATS_INTERVAL)
+            await self.refresh_stats()
+
+            for node in list(wavelink.Pool.nodes.values()):
+                if not self.get_load(node.identifier).is_degraded():
+                    continue
+
+                healthy = [other for other in self.get_available_nodes(exclude = node) if not self.get_load(other.identifier).is_degraded()]
+                if healthy:
+                    print(f"[DEBUG] Lavalink node {node.identifier} is degraded, moving its players")
+                    await self.migrate_players(node = node)
+
+
+node_pool = NodePool()
@@ -0,0 +1,54 @@
+import asyncio
+
+from cogs.music.database import Database, PlayEvent
+from config import PLAY_HISTORY_FLUSH_INTERVAL, PLAY_HISTORY_MAX_BATCH
+
+class PlayHistory:
+    """Write-behind log of played tracks. record() only appends to a buffer that is written in one transaction
+    every PLAY_HISTORY_FLUSH_INTERVAL, or as soon as PLAY_HISTORY_MAX_BATCH events are waiting."""
+
+    def __init__(self, interval : float = PLAY_HISTORY_FLUSH_INTERVAL, max_batch : int = PLAY_HISTORY_MAX_BATCH):
+        self.__interval : float = interval
+        self.__max_batch : int = max_batch
+        self.__database : Database = None
+        self.__pending : list[PlayEvent] = []
+        self.__wakeup : asyncio.Event = asyncio.Event()
+        self.__flush_task : asyncio.Task = None
+
+    def start(self, database : Database):
+        self.__database = database
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.create_task(self.__flush_periodically())
+
+    async def close(self):
+        if self.__flush_task is not None:
+            self.__flush_task.cancel()
+            self.__flush_task = None
+        await self.flush()
+
+    def record(self, event : PlayEvent):
+        self.__pending.append(event)
+        if len(self.__pending) >= self.__max_batch:
+            self.__wakeup.set()
+
+    def get_pending_count(self) -> int:
+        return len(self.__pending)
+
+    async def flush(self):
+        if self.__database is None or not self.__pending:
+            return
+
+        events, self.__pending = self.__pending, []
+        await self.__database.write_play_events(events = events)
+
+    async def __flush_periodically(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), timeout = self.__interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__wakeup.clear()
+            await self.flush()
+
+
+play_history = PlayHistory()
@@ -0,0 +1,206 @@
+import asyncio
+import os
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from time import perf_counter
+from types import CodeType, FrameType
+from typing import Awaitable, Iterator
+
+from config import PROFILE_HANDLERS, PROFILE_SAMPLE_INTERVAL, SLOW_HANDLER_THRESHOLD
+
+# Functions the event loop thread is sitting in while it waits for something to do
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "kqueue", "control", "_run_once"}
+
+@dataclass
+class Trace:
+    """Where the time of one handler run went: seconds spent awaiting each named step.
+    Steps awaited in parallel are all counted, so the steps can add up to more than the total."""
+    guild_id : int
+    state : str
+    started_at : float = field(default_factory = perf_counter)
+    steps : Counter = field(default_factory = Counter)
+    ended : bool = False
+
+    def get_breakdown(self, total : float) -> str:
+        parts = [f"{name} {seconds * 1000:.0f} ms" for name, seconds in self.steps.most_common()]
+        parts.append(f"other {max(0.0, total - sum(self.steps.values())) * 1000:.0f} ms")
+        return ", ".join(parts)
+
+@dataclass
+class HandlerStats:
+    runs : int = 0
+    total : float = 0.0
+    slowest : float = 0.0
+    steps : Counter = field(default_factory = Counter)
+
+current_trace : ContextVar[Trace] = ContextVar("current_trace", default = None)
+# Set while a step is awaited, steps nested in it (a database read inside a Lavalink lookup...) are not counted twice
+in_step : ContextVar[bool] = ContextVar("in_step", default = False)
+
+class GuildSampler:
+    """Samples the stack of the event loop thread from a thread of its own.
+    A sample belongs to the guild when one of its handlers, run through HandlerProfiler.run, is on the stack."""
+
+    def __init__(self, guild_id : int, thread_id : int, run_code : CodeType, interval : float = PROFILE_SAMPLE_INTERVAL):
+        self.guild_id : int = guild_id
+        self.__thread_id : int = thread_id
+        self.__run_code : CodeType = run_code
+        self.__interval : float = interval
+        self.__stopped : threading.Event = threading.Event()
+        self.__thread : threading.Thread = None
+
+        self.samples : int = 0
+        self.idle_samples : int = 0
+        self.guild_samples : int = 0
+        # Samples with the function running (own) or anywhere on the guild's part of the stack (cumulative)
+        self.own : Counter = Counter()
+        self.cumulative : Counter = Counter()
+        self.handlers : dict[str, HandlerStats] = {}
+
+    def start(self):
+        self.__thread = threading.Thread(target = self.__sample_loop, name = f"profiler-{self.guild_id}", daemon = True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def add_trace(self, trace : Trace, total : float):
+        stats = self.handlers.setdefault(trace.state, HandlerStats())
+        stats.runs += 1
+        stats.total += total
+        stats.slowest = max(stats.slowest, total)
+        stats.steps.update(trace.steps)
+
+    def __sample_loop(self):
+        while not self.__stopped.wait(self.__interval):
+            frame = sys._current_frames().get(self.__thread_id)
+            if frame is not None:
+                self.__sample(frame = frame)
+
+    def __sample(self, frame : FrameType):
+        self.samples += 1
+        if frame.f_code.co_name in IDLE_FUNCTIONS:
+            self.idle_samples += 1
+            return
+
+        # From the running function down to the handler of the guild, if there is one
+        stack = []
+        while frame is not None:
+            if frame.f_code is self.__run_code and frame.f_locals.get("guild_id") == self.guild_id:
+                break
+            stack.append(frame.f_code)
+            frame = frame.f_back
+
+        if frame is None or not stack:
+            return
+
+        self.guild_samples += 1
+        self.own[stack[0]] += 1
+        self.cumulative.update(set(stack))
+
+    @staticmethod
+    def format_code(code : CodeType) -> str:
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def get_report(self, duration : float, top : int = 8) -> str:
+        if self.samples == 0:
+            return "No samples were taken."
+
+        lines = [f"Profiled **{self.guild_id}** for {duration:.0f} s : {self.samples} samples, event loop busy {1 - self.idle_samples / self.samples:.0%}, this server {self.guild_samples / self.samples:.1%}"]
+
+        if self.handlers:
+            lines.append("**Handlers**")
+            for state, stats in sorted(self.handlers.items(), key = lambda item: item[1].total, reverse = True)[:top]:
+                step = stats.steps.most_common(1)
+                slowest_step = f", mostly {step[0][0]}" if step else ""
+                lines.append(f"{state} : {stats.runs} runs, mean {stats.total / stats.runs * 1000:.0f} ms, max {stats.slowest * 1000:.0f} ms{slowest_step}")
+
+        if self.guild_samples:
+            lines.append("**Own time**")
+            lines.extend(f"{count / self.guild_samples:5.1%} {self.format_code(code)}" for code, count in self.own.most_common(top))
+            lines.append("**Cumulative time**")
+            lines.extend(f"{count / self.guild_samples:5.1%} {self.format_code(code)}" for code, count in self.cumulative.most_common(top))
+
+        return "\n".join(lines)
+
+class HandlerProfiler:
+    """Times the state functions of Control and the steps they await (Lavalink, database, Discord).
+    Off by default: with PROFILE_HANDLERS every handler is traced and the ones slower than SLOW_HANDLER_THRESHOLD are logged with a breakdown.
+    profile_guild traces one guild and samples the event loop for a while, whatever PROFILE_HANDLERS says."""
+
+    def __init__(self, enabled : bool = PROFILE_HANDLERS, threshold : float = SLOW_HANDLER_THRESHOLD):
+        self.enabled : bool = enabled
+        self.threshold : float = threshold
+        self.slow_handlers : Counter = Counter()
+        self.__sampler : GuildSampler = None
+
+    def is_tracing(self, guild_id : int) -> bool:
+        return self.enabled or (self.__sampler is not None and self.__sampler.guild_id == guild_id)
+
+    async def run(self, guild_id : int, state : str, handler : Awaitable):
+        """Awaits handler, tracing it when profiling is on for guild_id. This frame is also how the sampler recognizes the guild's handlers."""
+        if not self.is_tracing(guild_id = guild_id):
+            return await handler
+
+        trace = Trace(guild_id = guild_id, state = state)
+        token = current_trace.set(trace)
+        try:
+            return await handler
+        finally:
+            current_trace.reset(token)
+            trace.ended = True
+            self.__finish(trace = trace, total = perf_counter() - trace.started_at)
+
+    def __finish(self, trace : Trace, total : float):
+        if self.__sampler is not None and self.__sampler.guild_id == trace.guild_id:
+            self.__sampler.add_trace(trace = trace, total = total)
+
+        if total >= self.threshold:
+            self.slow_handlers[trace.state] += 1
+            print(f"[DEBUG] Slow handler {trace.state} in {trace.guild_id} took {total * 1000:.0f} ms : {trace.get_breakdown(total = total)}")
+
+    @contextmanager
+    def step(self, name : str) -> Iterator[None]:
+        """Counts the time spent in the block towards the handler being traced, if any"""
+        trace = current_trace.get()
+        if trace is None or trace.ended or in_step.get():
+            yield
+            return
+
+        token = in_step.set(True)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            trace.steps[name] += perf_counter() - start
+            in_step.reset(token)
+
+    # ---------------------- SAMPLING --------------------------#
+    def is_sampling(self) -> bool:
+        return self.__sampler is not None
+
+    async def profile_guild(self, guild_id : int, duration : float) -> str:
+        """Traces the handlers of guild_id and samples the event loop for duration seconds. Returns the report."""
+        if self.__sampler is not None:
+            raise RuntimeError(f"Already profiling {self.__sampler.guild_id}")
+
+        sampler = GuildSampler(guild_id = guild_id, thread_id = threading.get_ident(), run_code = HandlerProfiler.run.__code__)
+        self.__sampler = sampler
+        sampler.start()
+        try:
+            await asyncio.sleep(duration)
+        finally:
+            self.__sampler = None
+            # Joining takes at most one sampling interval
+            sampler.stop()
+
+        return sampler.get_report(duration = duration)
+
+
+profiler = HandlerProfiler()
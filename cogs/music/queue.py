@@ -1,75 +1,126 @@
-from random import randint
+from random import shuffle
 from wavelink.tracks import Playable
 
+from config import MAX_HISTORY_LENGTH
+
 class Queue:
-    def __init__(self):
+    """All tracks live in one list with a cursor on the current track: what comes before it is the history, what comes after it is queued.
+    Positions given to remove_track, move_track and jump_to count from the next queued track (0)."""
+
+    def __init__(self, max_history : int = MAX_HISTORY_LENGTH):
         self._tracks : list[Playable] = []
         self._index : int = -1
+        self._max_history : int = max_history
 
     def add_track(self, track : Playable) -> bool:
         if track is None:
             return False
-        
+
         self._tracks.append(track)
         return True
-    
+
+    def add_tracks(self, tracks : list[Playable]) -> int:
+        tracks = [track for track in tracks if track is not None]
+        self._tracks.extend(tracks)
+        return len(tracks)
+
     def get_current_track(self) -> Playable:
-        if self._index < 0:
+        if self._index < 0 or self._index >= len(self._tracks):
             return None
         return self._tracks[self._index]
-    
+
     def get_queued_tracks(self) -> list[Playable]:
-        if self._index == -1:
-            return self._tracks
-        
         return self._tracks[self._index + 1:]
-    
+
     def get_history_tracks(self) -> list[Playable]:
-        return self._tracks[:self._index]
-    
+        return self._tracks[max(0, self._index - self._max_history):max(0, self._index)]
+
+    def get_history_length(self) -> int:
+        return min(max(0, self._index), self._max_history)
+
+    def peek_next_track(self) -> Playable:
+        if self.is_empty():
+            return None
+        return self._tracks[self._index + 1]
+
     def get_next_track(self) -> Playable:
+        if self.is_empty():
+            return None
+
         self._index += 1
-        return self.get_current_track()
-    
+        self.__trim_history()
+        return self._tracks[self._index]
+
     def get_queue_length(self) -> int:
-        return len(self.get_queued_tracks())
-    
+        return len(self._tracks) - self._index - 1
+
     def is_empty(self) -> bool:
-        return not self.get_queue_length() > 0
-    
+        return self.get_queue_length() <= 0
+
     def next(self) -> Playable:
-        if self.get_queue_length == 0:
-            return None
-        self._index += 1
-        return self._tracks[self._index]
-    
+        return self.get_next_track()
+
     def previous(self) -> Playable:
-        if self.get_queue_length == 0:
+        if self.get_history_length() == 0:
             return None
         self._index -= 1
         return self._tracks[self._index]
-    
+
     def remove_track(self, index : int) -> bool:
-        if index < len(self._tracks):
-            del self._tracks[index]
-            return True
+        """Removes the queued track at position index"""
+        if not 0 <= index < self.get_queue_length():
+            return False
+
+        del self._tracks[self._index + 1 + index]
+        return True
+
+    def move_track(self, source : int, destination : int) -> bool:
+        """Moves the queued track at position source to position destination"""
+        length = self.get_queue_length()
+        if not (0 <= source < length and 0 <= destination < length):
+            return False
+
+        offset = self._index + 1
+        self._tracks.insert(offset + destination, self._tracks.pop(offset + source))
+        return True
+
+    def jump_to(self, index : int) -> bool:
+        """Makes the queued track at position index the next one, the tracks before it go to the history"""
+        if not 0 <= index < self.get_queue_length():
+            return False
+
+        self._index += index
+        self.__trim_history()
+        return True
+
+    def get_state(self) -> tuple[list[Playable], int]:
+        """Returns every track kept (history, current and queued) and the position of the current one"""
+        return self._tracks, self._index
+
+    def load(self, tracks : list[Playable], index : int):
+        self._tracks = list(tracks)
+        self._index = index
 
-        return False
-    
     def reset(self):
         self._tracks = []
         self._index = -1
 
-
     def skip_by(self, jump : int):
-        self._index += jump
-    
+        self._index = max(-1, min(self._index + jump, len(self._tracks) - 1))
+        self.__trim_history()
+
     def shuffle(self):
-        shuffled_tracks = []
-
-        queued_tracks = self.get_queued_tracks()
-        while len(queued_tracks) > 0:
-            index = randint(0, len(queued_tracks) - 1)
-            shuffled_tracks.append(queued_tracks[index])
-            del queued_tracks[index]
-        self._tracks = self.get_history_tracks() + [self.get_current_track()] + shuffled_tracks
+        """Shuffles only the queued tracks (Fisher-Yates)"""
+        start = self._index + 1
+        queued_tracks = self._tracks[start:]
+        shuffle(queued_tracks)
+        self._tracks[start:] = queued_tracks
+
+    def __trim_history(self):
+        # Trimmed in chunks of max_history so the cost of shifting the list is amortized over many tracks
+        if self._index <= 2 * self._max_history:
+            return
+
+        drop = self._index - self._max_history
+        del self._tracks[:drop]
+        self._index -= drop
@@ -0,0 +1,123 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable
+
+from cogs.music.database import Database, JournalEntry, QueueSnapshot
+from cogs.music.queue import Queue
+from config import JOURNAL_COMPACT_EVERY, JOURNAL_FLUSH_INTERVAL
+
+# Queue methods replayed from the journal. Anything else (shuffle, reset) is written as a new snapshot.
+REPLAYED_OPS = {"add_tracks", "get_next_track", "skip_by", "remove_track", "move_track", "jump_to"}
+
+@dataclass
+class GuildJournal:
+    get_snapshot : Callable[[], QueueSnapshot]
+    get_position : Callable[[], tuple[int, int]]
+    pending : list[JournalEntry] = field(default_factory = list)
+    written : int = 0
+    needs_snapshot : bool = True
+    # (voice_channel_id, position) last written, only changes are written again
+    position : tuple[int, int] = None
+
+class QueueJournal:
+    """Append-only log of the queue changes of every server, so queues survive a restart.
+    record() only buffers the change: every JOURNAL_FLUSH_INTERVAL the changes of all servers are written in one transaction,
+    and the log of a server is replaced by a snapshot of its queue once it is JOURNAL_COMPACT_EVERY entries long."""
+
+    def __init__(self, interval : float = JOURNAL_FLUSH_INTERVAL, compact_every : int = JOURNAL_COMPACT_EVERY):
+        self.__interval : float = interval
+        self.__compact_every : int = compact_every
+        self.__database : Database = None
+        self.__journals : dict[int, GuildJournal] = {}
+        self.__flush_task : asyncio.Task = None
+
+    def start(self, database : Database):
+        """Starts writing. Call it once the stored queues were restored, the first write replaces them."""
+        self.__database = database
+        if self.__flush_task is None:
+            self.__flush_task = asyncio.create_task(self.__flush_periodically())
+
+    async def close(self):
+        if self.__flush_task is None:
+            return
+
+        self.__flush_task.cancel()
+        self.__flush_task = None
+        await self.flush()
+
+    def register(self, guild_id : int, get_snapshot : Callable[[], QueueSnapshot], get_position : Callable[[], tuple[int, int]]):
+        """get_snapshot returns the whole queue state, get_position the (voice_channel_id, position) of what is playing"""
+        self.__journals[guild_id] = GuildJournal(get_snapshot = get_snapshot, get_position = get_position)
+
+    def record(self, guild_id : int, op : str, *args):
+        journal = self.__journals.get(guild_id)
+        if journal is None or journal.needs_snapshot:
+            # The next snapshot includes this change anyway
+            return
+
+        if op not in REPLAYED_OPS:
+            return self.request_snapshot(guild_id = guild_id)
+
+        journal.pending.append(JournalEntry(guild_id = guild_id, op = op, args = list(args)))
+
+    def request_snapshot(self, guild_id : int):
+        journal = self.__journals.get(guild_id)
+        if journal is not None:
+            journal.needs_snapshot = True
+            journal.pending = []
+
+    async def flush(self):
+        if self.__database is None:
+            return
+
+        snapshots, entries, positions = [], [], []
+        guild_ids = list(self.__journals)
+        for guild_id, journal in self.__journals.items():
+            if journal.written + len(journal.pending) >= self.__compact_every:
+                journal.needs_snapshot = True
+
+            if journal.needs_snapshot:
+                snapshot = journal.get_snapshot()
+                snapshots.append(snapshot)
+                journal.needs_snapshot, journal.written, journal.pending = False, 0, []
+                journal.position = (snapshot.voice_channel_id, snapshot.position)
+                continue
+
+            entries.extend(journal.pending)
+            journal.written += len(journal.pending)
+            journal.pending = []
+
+            # Idle servers keep the same position, only the playing ones are written every flush
+            position = journal.get_position()
+            if position != journal.position:
+                positions.append((guild_id, *position))
+                journal.position = position
+
+        if not (snapshots or entries or positions):
+            return
+
+        if not await self.__database.write_queue_journal(snapshots = snapshots, entries = entries, positions = positions):
+            # The entries of the batch are lost, the stored journals no longer match the queues until a new snapshot
+            for guild_id in guild_ids:
+                self.request_snapshot(guild_id = guild_id)
+
+    async def __flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.__interval)
+            await self.flush()
+
+
+def replay(snapshot : QueueSnapshot, entries : list[JournalEntry]) -> tuple[list[str], int]:
+    """Applies the journal entries on top of the snapshot and returns the resulting (encoded tracks, index of the current track)"""
+    # The queue holds the encoded strings, they are only decoded once the final state is known
+    queue = Queue()
+    queue.load(tracks = snapshot.tracks, index = snapshot.index)
+
+    for entry in entries:
+        if entry.op in REPLAYED_OPS:
+            getattr(queue, entry.op)(*entry.args)
+
+    return queue.get_state()
+
+
+queue_journal = QueueJournal()
@@ -0,0 +1,246 @@
+import asyncio
+import heapq
+import logging
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from itertools import count
+from time import monotonic
+from typing import Any, Awaitable, Callable
+
+from discord import Embed, Message, PartialMessage, TextChannel
+from discord.ui import View
+
+from cogs.music.profiler import profiler
+from config import ROUTE_BUDGETS
+
+# Route of the call being made, discord.py logs its rate limits from inside that call
+current_route : ContextVar[str] = ContextVar("current_route", default = None)
+# Route counted for the calls that do not go through the scheduler, like interaction responses
+UNSCHEDULED_ROUTE = "unscheduled"
+
+class Priority(IntEnum):
+    PLAYER = 0
+    SELECTION = 1
+    NOTIFICATION = 2
+    CLEANUP = 3
+
+@dataclass(order = True)
+class OutboundJob:
+    priority : int
+    sequence : int
+    route : str = field(compare = False)
+    factory : Callable[[], Awaitable] = field(compare = False)
+    merge_key : str = field(compare = False)
+    created_at : float = field(compare = False)
+    futures : list[asyncio.Future] = field(compare = False, default_factory = list)
+
+@dataclass
+class RouteBudget:
+    """Token bucket mirroring one Discord route bucket"""
+    capacity : float
+    rate : float
+    tokens : float
+    updated_at : float
+
+    def get_delay(self) -> float:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+@dataclass
+class RouteStats:
+    calls : int = 0
+    failed : int = 0
+    rate_limited : int = 0
+    merged : int = 0
+    total_wait : float = 0.0
+    max_wait : float = 0.0
+
+class RateLimitHandler(logging.Handler):
+    """Counts the 429s discord.py answers itself: it waits and retries them, a call only fails once its retries ran out.
+    Both its retried and its given up 429s are logged as "We are being rate limited." warnings."""
+
+    def __init__(self, on_rate_limited : Callable[[str], None]):
+        super().__init__(level = logging.WARNING)
+        self.__on_rate_limited : Callable[[str], None] = on_rate_limited
+
+    def emit(self, record : logging.LogRecord):
+        if isinstance(record.msg, str) and record.msg.startswith("We are being rate limited."):
+            self.__on_rate_limited(current_route.get() or UNSCHEDULED_ROUTE)
+
+@dataclass
+class GuildQueue:
+    heap : list[OutboundJob] = field(default_factory = list)
+    merges : dict[str, OutboundJob] = field(default_factory = dict)
+    wakeup : asyncio.Event = field(default_factory = asyncio.Event)
+    worker : asyncio.Task = None
+
+class OutboundScheduler:
+    """Every Discord REST call of the cog goes through here.
+    Each guild has a priority queue drained by one worker, routes are paced by token buckets shared by all guilds,
+    and a pending edit of a message is replaced by a newer edit of the same message instead of being sent twice."""
+
+    def __init__(self, route_budgets : dict[str, tuple[int, float]] = ROUTE_BUDGETS):
+        self.__route_budgets : dict[str, tuple[int, float]] = route_budgets
+        self.__budgets : dict[str, RouteBudget] = {}
+        self.__queues : dict[int, GuildQueue] = {}
+        self.__stats : dict[str, RouteStats] = {}
+        self.__sequence = count()
+        self.__rate_limit_handler : RateLimitHandler = None
+
+    def install(self):
+        """Starts counting the rate limits discord.py logs"""
+        if self.__rate_limit_handler is not None:
+            return
+
+        self.__rate_limit_handler = RateLimitHandler(on_rate_limited = self.__on_rate_limited)
+        logging.getLogger("discord.http").addHandler(self.__rate_limit_handler)
+
+    def uninstall(self):
+        if self.__rate_limit_handler is None:
+            return
+
+        logging.getLogger("discord.http").removeHandler(self.__rate_limit_handler)
+        self.__rate_limit_handler = None
+
+    def __on_rate_limited(self, route : str):
+        self.__get_stats(route = route).rate_limited += 1
+
+    # ---------------------- CORE --------------------------#
+    def post(self, guild_id : int, priority : Priority, route : str, factory : Callable[[], Awaitable], merge_key : str = None) -> asyncio.Future:
+        """Queues a call and returns a future of its result"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self.__queues.setdefault(guild_id, GuildQueue())
+
+        pending = queue.merges.get(merge_key) if merge_key is not None else None
+        if pending is not None:
+            # Only the newest content matters, everyone waiting gets the result of the newest call
+            pending.factory = factory
+            pending.futures.append(future)
+            self.__get_stats(route = route).merged += 1
+            if priority < pending.priority:
+                pending.priority = priority
+                heapq.heapify(queue.heap)
+        else:
+            job = OutboundJob(priority = priority, sequence = next(self.__sequence), route = route, factory = factory, merge_key = merge_key, created_at = monotonic(), futures = [future])
+            heapq.heappush(queue.heap, job)
+            if merge_key is not None:
+                queue.merges[merge_key] = job
+
+        queue.wakeup.set()
+        if queue.worker is None:
+            queue.worker = asyncio.create_task(self.__work(guild_id = guild_id, queue = queue))
+
+        return future
+
+    async def submit(self, guild_id : int, priority : Priority, route : str, factory : Callable[[], Awaitable], merge_key : str = None) -> Any:
+        """Queues a call and waits for its result"""
+        with profiler.step(f"discord:{route.split(':')[0]}"):
+            return await self.post(guild_id = guild_id, priority = priority, route = route, factory = factory, merge_key = merge_key)
+
+    async def __work(self, guild_id : int, queue : GuildQueue):
+        try:
+            while queue.heap:
+                job = queue.heap[0]
+                budget = self.__get_budget(route = job.route)
+
+                delay = budget.get_delay()
+                if delay > 0:
+                    # Wake up early if something more urgent arrives in the meantime
+                    queue.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(queue.wakeup.wait(), timeout = delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                heapq.heappop(queue.heap)
+                if job.merge_key is not None and queue.merges.get(job.merge_key) is job:
+                    del queue.merges[job.merge_key]
+                budget.take()
+
+                await self.__run(job = job)
+        finally:
+            queue.worker = None
+            if not queue.heap:
+                self.__queues.pop(guild_id, None)
+
+    async def __run(self, job : OutboundJob):
+        stats = self.__get_stats(route = job.route)
+        wait = monotonic() - job.created_at
+        stats.calls += 1
+        stats.total_wait += wait
+        stats.max_wait = max(stats.max_wait, wait)
+
+        # The worker task runs the call itself, so the rate limits discord.py logs during it see this route
+        token = current_route.set(job.route)
+        try:
+            result = await job.factory()
+        except Exception as e:
+            stats.failed += 1
+            for future in job.futures:
+                if not future.done():
+                    future.set_exception(e)
+                    # Fire and forget callers never look at the future, do not warn about it
+                    future.exception()
+            print(f"[DEBUG] Outbound {job.route} failed : {e}")
+            return
+        finally:
+            current_route.reset(token)
+
+        for future in job.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def __get_budget(self, route : str) -> RouteBudget:
+        budget = self.__budgets.get(route)
+        if budget is None:
+            capacity, per = self.__route_budgets.get(route.split(":")[0], (1, 1.0))
+            budget = RouteBudget(capacity = capacity, rate = capacity / per, tokens = capacity, updated_at = monotonic())
+            self.__budgets[route] = budget
+        return budget
+
+    def __get_stats(self, route : str) -> RouteStats:
+        return self.__stats.setdefault(route.split(":")[0], RouteStats())
+
+    # ---------------------- METRICS --------------------------#
+    def get_queue_depth(self, guild_id : int = None) -> int:
+        if guild_id is not None:
+            queue = self.__queues.get(guild_id)
+            return len(queue.heap) if queue else 0
+        return sum(len(queue.heap) for queue in self.__queues.values())
+
+    def get_queue_depth_by_priority(self) -> dict[Priority, int]:
+        depths = {priority : 0 for priority in Priority}
+        for queue in self.__queues.values():
+            for job in queue.heap:
+                depths[Priority(job.priority)] += 1
+        return depths
+
+    def get_stats(self) -> dict[str, RouteStats]:
+        return dict(self.__stats)
+
+    # ---------------------- DISCORD CALLS --------------------------#
+    async def send(self, channel : TextChannel, priority : Priority, content : str = None, embed : Embed = None, view : View = None) -> Message:
+        fields = {"embed" : embed} if view is None else {"embed" : embed, "view" : view}
+        return await self.submit(guild_id = channel.guild.id, priority = priority, route = f"send:{channel.id}", factory = lambda: channel.send(content, **fields))
+
+    async def edit(self, message : Message, priority : Priority, **fields) -> Message:
+        return await self.submit(guild_id = message.guild.id, priority = priority, route = f"edit:{message.channel.id}", factory = lambda: message.edit(**fields), merge_key = f"edit:{message.id}")
+
+    async def delete(self, message : Message | PartialMessage, priority : Priority, wait : bool = True):
+        future = self.post(guild_id = message.guild.id, priority = priority, route = f"delete:{message.channel.id}", factory = message.delete)
+        if wait:
+            await future
+
+    def clear_reactions(self, message : Message | PartialMessage, priority : Priority = Priority.CLEANUP) -> asyncio.Future:
+        return self.post(guild_id = message.guild.id, priority = priority, route = f"reaction:{message.channel.id}", factory = message.clear_reactions)
+
+
+scheduler = OutboundScheduler()
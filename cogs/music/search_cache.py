@@ -0,0 +1,103 @@
+import asyncio
+from collections import OrderedDict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Awaitable, Callable
+
+from config import SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+
+@dataclass
+class CacheEntry:
+    value : object
+    expires_at : float
+
+@dataclass
+class CacheStats:
+    size : int
+    hits : int
+    misses : int
+    coalesced : int
+
+class SearchCache:
+    """Process-wide LRU + TTL cache for search results, shared by every guild.
+    Concurrent lookups of the same normalized query share one outstanding load."""
+
+    def __init__(self, max_size : int = SEARCH_CACHE_SIZE, ttl : float = SEARCH_CACHE_TTL):
+        self.__max_size : int = max_size
+        self.__ttl : float = ttl
+        self.__entries : OrderedDict[str, CacheEntry] = OrderedDict()
+        self.__in_flight : dict[str, asyncio.Task] = {}
+
+        self.__hits : int = 0
+        self.__misses : int = 0
+        self.__coalesced : int = 0
+
+    @staticmethod
+    def get_key(query : str) -> str:
+        """Urls are kept as typed, video ids are case sensitive. Searches ignore case and spacing only,
+        qualifiers like (Live) or [Acoustic] find other songs."""
+        query = query.strip()
+        if query.startswith(("http://", "https://")):
+            return query
+        return " ".join(query.lower().split())
+
+    async def get(self, query : str, loader : Callable[[str], Awaitable[list]]) -> list:
+        """Returns the cached result for query, calling loader(query) on a miss."""
+        key = self.get_key(query)
+
+        entry = self.__entries.get(key)
+        if entry is not None:
+            if entry.expires_at > monotonic():
+                self.__entries.move_to_end(key)
+                self.__hits += 1
+                return entry.value
+            del self.__entries[key]
+
+        in_flight = self.__in_flight.get(key)
+        if in_flight is not None:
+            self.__coalesced += 1
+            return await asyncio.shield(in_flight)
+
+        self.__misses += 1
+        # The load runs in a task of its own, cancelling the caller that started it does not fail the others waiting for it
+        load = asyncio.create_task(self.__load(key = key, query = query, loader = loader))
+        load.add_done_callback(self.__consume)
+        self.__in_flight[key] = load
+        return await asyncio.shield(load)
+
+    async def __load(self, key : str, query : str, loader : Callable[[str], Awaitable[list]]) -> list:
+        try:
+            value = await loader(query)
+        finally:
+            del self.__in_flight[key]
+
+        # Empty results are not cached, the video may just not be indexed yet
+        if value:
+            self.__store(key = key, value = value)
+
+        return value
+
+    @staticmethod
+    def __consume(load : asyncio.Task):
+        # Waiters re-raise the exception, do not warn when there are none left
+        if not load.cancelled():
+            load.exception()
+
+    def __store(self, key : str, value : object):
+        self.__entries[key] = CacheEntry(value = value, expires_at = monotonic() + self.__ttl)
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last = False)
+
+    def invalidate(self, query : str):
+        self.__entries.pop(self.get_key(query), None)
+
+    def clear(self):
+        self.__entries.clear()
+
+    def get_stats(self) -> CacheStats:
+        return CacheStats(size = len(self.__entries), hits = self.__hits, misses = self.__misses, coalesced = self.__coalesced)
+
+
+search_cache = SearchCache()
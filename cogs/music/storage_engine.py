@@ -0,0 +1,134 @@
+import asyncio
+import queue
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from cogs.music.metrics import metrics
+from config import DB_PATH, DB_READER_THREADS, DB_MAX_WRITE_BATCH, DB_STATEMENT_CACHE_SIZE, DB_MMAP_SIZE, DB_CACHE_SIZE_KB
+
+DB_TIMINGS = metrics.histogram(name = "musicbot_db_seconds", help = "Time from submitting a database read or write to its result, queueing included", label = "op")
+
+@dataclass
+class WriteJob:
+    function : Callable[[sqlite3.Connection], Any]
+    future : asyncio.Future
+    loop : asyncio.AbstractEventLoop
+
+class StorageEngine:
+    """Runs every SQLite statement off the event loop.
+    Writes go through one writer thread that groups all pending jobs into a single transaction,
+    reads run on a small pool of threads that each own a connection."""
+
+    def __init__(self, path : str = DB_PATH, readers : int = DB_READER_THREADS, max_write_batch : int = DB_MAX_WRITE_BATCH):
+        self.__path : str = path
+        self.__max_write_batch : int = max_write_batch
+
+        self.__writes : queue.SimpleQueue = queue.SimpleQueue()
+        self.__writer : threading.Thread = threading.Thread(target = self.__write_loop, name = "db-writer", daemon = True)
+        self.__local = threading.local()
+        # Every reader connection, closed once their threads are stopped
+        self.__reader_connections : list[sqlite3.Connection] = []
+        self.__readers : ThreadPoolExecutor = ThreadPoolExecutor(max_workers = readers, thread_name_prefix = "db-reader", initializer = self.__open_reader)
+
+        self.__writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Transactions are handled explicitly by the writer.
+        # Each connection is only used by the thread that opened it, close() may run on another one after that thread stopped.
+        connection = sqlite3.connect(self.__path, isolation_level = None, cached_statements = DB_STATEMENT_CACHE_SIZE, check_same_thread = False)
+
+        # WAL lets the readers run while the writer commits
+        connection.execute("PRAGMA journal_mode = WAL")
+        connection.execute("PRAGMA synchronous = NORMAL")
+        connection.execute("PRAGMA foreign_keys = ON")
+        connection.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        connection.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        connection.execute("PRAGMA busy_timeout = 5000")
+        return connection
+
+    def __open_reader(self):
+        self.__local.connection = self._connect()
+        self.__reader_connections.append(self.__local.connection)
+
+    def __run_read(self, function : Callable[[sqlite3.Connection], Any]) -> Any:
+        return function(self.__local.connection)
+
+    async def read(self, function : Callable[[sqlite3.Connection], Any]) -> Any:
+        """Runs function(connection) on a reader thread and returns its result."""
+        with DB_TIMINGS.time("read"):
+            return await asyncio.get_running_loop().run_in_executor(self.__readers, self.__run_read, function)
+
+    async def write(self, function : Callable[[sqlite3.Connection], Any]) -> Any:
+        """Runs function(connection) inside the next grouped write transaction and returns its result.
+        If function raises, only its own changes are rolled back and the exception is re-raised here."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.__writes.put(WriteJob(function = function, future = future, loop = loop))
+        with DB_TIMINGS.time("write"):
+            return await future
+
+    def __write_loop(self):
+        connection = self._connect()
+
+        while True:
+            jobs = [self.__writes.get()]
+            while len(jobs) < self.__max_write_batch:
+                try:
+                    jobs.append(self.__writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            closing = None in jobs
+            jobs = [job for job in jobs if job is not None]
+            if jobs:
+                self.__run_batch(connection = connection, jobs = jobs)
+
+            if closing:
+                break
+
+        connection.close()
+
+    def __run_batch(self, connection : sqlite3.Connection, jobs : list[WriteJob]):
+        results = []
+        try:
+            connection.execute("BEGIN")
+            for job in jobs:
+                # Each job gets a savepoint so one failing statement does not undo the other guilds' writes
+                connection.execute("SAVEPOINT job")
+                try:
+                    results.append((True, job.function(connection)))
+                except Exception as e:
+                    connection.execute("ROLLBACK TO job")
+                    results.append((False, e))
+                connection.execute("RELEASE job")
+            connection.execute("COMMIT")
+        except Exception as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            results = [(False, e)] * len(jobs)
+
+        for job, (succeeded, value) in zip(jobs, results):
+            job.loop.call_soon_threadsafe(self.__resolve, job.future, succeeded, value)
+
+    @staticmethod
+    def __resolve(future : asyncio.Future, succeeded : bool, value : Any):
+        if future.cancelled():
+            return
+
+        if succeeded:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    def close(self):
+        """Flushes the pending writes and closes every connection."""
+        self.__writes.put(None)
+        self.__writer.join()
+        self.__readers.shutdown(wait = True)
+
+        for connection in self.__reader_connections:
+            connection.close()
+        self.__reader_connections = []
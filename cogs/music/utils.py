@@ -1,3 +1,11 @@
+import asyncio
+import re
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+# Youtube playlists (or videos played from one), soundcloud sets and bandcamp albums
+PLAYLIST_URL = re.compile(r"^https?://\S*(?:[?&]list=|soundcloud\.com/[^/\s]+/sets/|bandcamp\.com/album/)")
+
 number_emotes = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
 
 def emote_from_index(index : int):
@@ -6,10 +14,11 @@ def emote_from_index(index : int):
 def emote_to_index(emote: str):
     return number_emotes.index(emote)
 
+def is_playlist_url(query : str) -> bool:
+    return PLAYLIST_URL.match(query.strip()) is not None
+
 def format_input(string : str):
-    import re
     string = string.lower()  # -- Lower case
-    string = string.replace("\'", "\'\'")  # -- Treat '
 
     # Remove ()
     string = re.sub(r'\(.*\)', '', string)
@@ -27,3 +36,14 @@ def format_input(string : str):
         params.remove("")
     string = ' '.join(params)
     return string.title()
+
+def get_custom_id(interaction) -> str:
+    return (interaction.data or {}).get("custom_id", "")
+
+@asynccontextmanager
+async def responding(interaction) -> AsyncIterator[bool]:
+    """Holds the right to answer interaction and yields whether it is still unanswered.
+    is_done only turns true once the response is sent, so the handlers and the timed acknowledgement take turns here."""
+    lock = interaction.extras.setdefault("response_lock", asyncio.Lock())
+    async with lock:
+        yield not interaction.response.is_done()
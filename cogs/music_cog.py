@@ -1,33 +1,213 @@
+import asyncio
+from datetime import timedelta
+
 import wavelink
 import discord
 from discord.ext import commands
+from cogs.music.control import BUTTON_HANDLERS, COMMAND_HANDLERS
+from cogs.music.database import Database, GuildMenus, JournalEntry, QueueSnapshot
+from cogs.music.event_filter import event_filter
+from cogs.music.menus.player_menu import playback_stats
+from cogs.music.metrics import metrics, render_samples
 from cogs.music.music_server import MusicServer
-from config import LAVALINK_HOST, LAVALINK_PORT, LAVALINK_PASSWORD
+from cogs.music.node_pool import node_pool
+from cogs.music.play_history import play_history
+from cogs.music.profiler import profiler
+from cogs.music.queue_journal import queue_journal, replay
+from cogs.music.scheduler import scheduler
+from cogs.music.search_cache import search_cache
+from cogs.music.utils import get_custom_id
+from config import MENU_RESTORE_CONCURRENCY
 
 class MusicCog(commands.Cog):
-    def __init__(self, bot : commands.Bot):
+    def __init__(self, bot : commands.Bot, database : Database = None):
         self.bot : commands.Bot = bot
         self.bot.loop.create_task(self.node_connect())
 
+        self.database : Database = database or Database()
         self.servers : dict = {}
+        self.__restored : bool = False
+        self.__menus_restored : asyncio.Event = asyncio.Event()
+        self.__queues_restored : bool = False
+
+    async def cog_load(self):
+        await self.database.setup()
+        play_history.start(database = self.database)
+        event_filter.install(connection = self.bot._connection, prefix = self.bot.command_prefix)
+        scheduler.install()
+        metrics.add_collector(self.collect_metrics)
+        await metrics.start()
+
+    async def cog_unload(self):
+        metrics.remove_collector(self.collect_metrics)
+        await metrics.close()
+        event_filter.uninstall()
+        scheduler.uninstall()
+        node_pool.close()
+        await queue_journal.close()
+        await play_history.close()
+        self.database.close()
+
+    def collect_metrics(self) -> list[str]:
+        """Gauges and counters read from their owners when /metrics is scraped"""
+        routes = scheduler.get_stats()
+        cache = search_cache.get_stats()
+        servers = list(self.servers.values())
+        queue_lengths = [server.get_queue_length() for server in servers]
+        nodes = list(wavelink.Pool.nodes.values())
+        dispatched = [(registry.name, key, stats) for registry in (COMMAND_HANDLERS, BUTTON_HANDLERS) for key, stats in registry.get_stats().items()]
+
+        return [
+            *render_samples("musicbot_rest_calls_total", "Discord REST calls made by the outbound scheduler", "counter", [({"route" : route}, stats.calls) for route, stats in routes.items()]),
+            *render_samples("musicbot_rest_failed_total", "Discord REST calls that raised", "counter", [({"route" : route}, stats.failed) for route, stats in routes.items()]),
+            *render_samples("musicbot_rest_rate_limited_total", "429 responses to Discord REST calls, including the ones discord.py waited out and retried", "counter", [({"route" : route}, stats.rate_limited) for route, stats in routes.items()]),
+            *render_samples("musicbot_rest_merged_total", "Edits replaced by a newer edit of the same message before being sent", "counter", [({"route" : route}, stats.merged) for route, stats in routes.items()]),
+            *render_samples("musicbot_rest_wait_seconds_max", "Longest time a call waited in the outbound scheduler", "gauge", [({"route" : route}, stats.max_wait) for route, stats in routes.items()]),
+            *render_samples("musicbot_outbound_queue_depth", "Calls waiting in the outbound scheduler", "gauge", [({"priority" : priority.name}, depth) for priority, depth in scheduler.get_queue_depth_by_priority().items()]),
+            *render_samples("musicbot_search_cache_lookups_total", "Search cache lookups", "counter", [({"result" : "hit"}, cache.hits), ({"result" : "miss"}, cache.misses), ({"result" : "coalesced"}, cache.coalesced)]),
+            *render_samples("musicbot_search_cache_size", "Queries in the search cache", "gauge", [({}, cache.size)]),
+            *render_samples("musicbot_gateway_events_total", "Gateway events seen by the music channel filter", "counter", [({"event" : event, "result" : "passed"}, count) for event, count in event_filter.passed.items()] + [({"event" : event, "result" : "dropped"}, count) for event, count in event_filter.dropped.items()]),
+            *render_samples("musicbot_players", "Players connected to each Lavalink node", "gauge", [({"node" : node.identifier}, len(node.players)) for node in nodes]),
+            *render_samples("musicbot_node_cpu_load", "System load of each Lavalink node at the last stats refresh", "gauge", [({"node" : node.identifier}, node_pool.get_load(node.identifier).system_load) for node in nodes]),
+            *render_samples("musicbot_servers", "Servers with the music menus set up", "gauge", [({}, len(servers))]),
+            *render_samples("musicbot_queued_tracks", "Tracks waiting in the queues of all servers", "gauge", [({}, sum(queue_lengths))]),
+            *render_samples("musicbot_queued_tracks_max", "Longest queue of a single server", "gauge", [({}, max(queue_lengths, default = 0))]),
+            *render_samples("musicbot_selection_sessions", "Open per user selection sessions", "gauge", [({}, sum(server.get_session_count() for server in servers))]),
+            *render_samples("musicbot_track_transitions_total", "Tracks started after another one ended", "counter", [({}, playback_stats.transitions)]),
+            *render_samples("musicbot_track_gap_seconds_total", "Time between a track ending and the next one starting, summed", "counter", [({}, playback_stats.total_gap)]),
+            *render_samples("musicbot_track_gap_seconds_max", "Longest time between a track ending and the next one starting", "gauge", [({}, playback_stats.max_gap)]),
+            *render_samples("musicbot_unavailable_tracks_skipped_total", "Queued tracks removed because they could not be loaded anymore", "counter", [({}, playback_stats.skipped_unavailable)]),
+            *render_samples("musicbot_play_history_pending", "Play events waiting to be written", "gauge", [({}, play_history.get_pending_count())]),
+            *render_samples("musicbot_dispatch_total", "Commands and player buttons dispatched by the handler registries", "counter", [({"menu" : menu, "key" : key}, stats.calls) for menu, key, stats in dispatched]),
+            *render_samples("musicbot_dispatch_rejected_total", "Dispatches refused by a check (voice channel, nothing playing, no playlists...)", "counter", [({"menu" : menu, "key" : key}, stats.rejected) for menu, key, stats in dispatched]),
+            *render_samples("musicbot_dispatch_seconds_total", "Time spent dispatching, checks and handlers included", "counter", [({"menu" : menu, "key" : key}, stats.seconds) for menu, key, stats in dispatched]),
+            *render_samples("musicbot_slow_handlers_total", "Traced handlers slower than SLOW_HANDLER_THRESHOLD", "counter", [({"state" : state}, count) for state, count in profiler.slow_handlers.items()]),
+        ]
 
      #-------------- Wave link block ----------------------------------#
     async def node_connect(self):
         await self.bot.wait_until_ready()
+        await node_pool.connect(client = self.bot)
+
+    @commands.Cog.listener()
+    async def on_wavelink_node_ready(self, payload : wavelink.NodeReadyEventPayload):
+        print(f'Bot and wavelink node {payload.node.identifier} ready : {discord.__version__}')
+
+        # Queues can only be played again once a node is up and the menus are back
+        if self.__queues_restored:
+            return
+        self.__queues_restored = True
+        await self.__menus_restored.wait()
+        await self.__restore_queues()
+
+    async def __restore_queues(self):
+        semaphore = asyncio.Semaphore(MENU_RESTORE_CONCURRENCY)
+        async def restore(snapshot : QueueSnapshot, entries : list[JournalEntry]) -> bool:
+            server = self.servers.get(str(snapshot.guild_id))
+            if server is None or snapshot.voice_channel_id is None:
+                return False
 
-        node: wavelink.Node = wavelink.Node(
-            uri = f"http://{LAVALINK_HOST}:{LAVALINK_PORT}", 
-            password = LAVALINK_PASSWORD
-        )
-        await wavelink.Pool.connect(client = self.bot, nodes = [node])
+            # One broken queue is dropped, it must not keep the others from being restored
+            try:
+                encoded, index = replay(snapshot = snapshot, entries = entries)
+                async with semaphore:
+                    return await server.restore_queue(voice_channel_id = snapshot.voice_channel_id, encoded = encoded, index = index, position = snapshot.position)
+            except Exception as e:
+                print(f"[DEBUG] Failed to restore the queue of {snapshot.guild_id} : {type(e).__name__} {e}")
+                return False
+
+        try:
+            journals = await self.database.get_queue_journals()
+            restored = await asyncio.gather(*[restore(snapshot, entries) for snapshot, entries in journals.values()])
+            print(f"Restored {sum(restored)}/{len(journals)} queues")
+        finally:
+            # Everything not restored is overwritten by the first write
+            queue_journal.start(database = self.database)
+
+    @commands.Cog.listener()
+    async def on_wavelink_node_disconnected(self, payload : wavelink.NodeDisconnectedEventPayload):
+        print(f"[DEBUG] Lavalink node {payload.node.identifier} disconnected")
+        await node_pool.migrate_players(node = payload.node)
 
     @commands.Cog.listener()
-    async def on_wavelink_node_ready(self, node : wavelink.Node):
-        print(f'Bot and wavelink node ready : {discord.__version__}')
+    async def on_wavelink_node_closed(self, node : wavelink.Node, disconnected : list[wavelink.Player]):
+        await node_pool.migrate_players(node = node, players = disconnected)
+
+    @commands.Cog.listener()
+    async def on_player_moved(self, player : wavelink.Player):
+        server = self.__get_server_by_id(server_id = player.guild.id)
+        if server is None:
+            return
+        await server.player_moved_notification()
+
+    @commands.command()
+    @commands.is_owner()
+    async def nodes(self, ctx : commands.Context):
+        lines = []
+        for node in wavelink.Pool.nodes.values():
+            load = node_pool.get_load(node.identifier)
+            drained = " (drained)" if node_pool.is_drained(node.identifier) else ""
+            lines.append(f"**{node.identifier}**{drained} : {node.status.name}, {len(node.players)} players, cpu {load.system_load:.0%}, deficit {load.deficit:.1%}")
+        await ctx.send("\n".join(lines) if lines else "No Lavalink nodes.")
+
+    @commands.command()
+    @commands.is_owner()
+    async def drain(self, ctx : commands.Context, identifier : str):
+        if identifier not in wavelink.Pool.nodes:
+            return await ctx.send(f"Unknown Lavalink node **{identifier}**.")
+
+        moved = await node_pool.drain(identifier = identifier)
+        await ctx.send(f"Drained **{identifier}**, moved {moved} players.")
+
+    @commands.command()
+    @commands.is_owner()
+    async def undrain(self, ctx : commands.Context, identifier : str):
+        node_pool.undrain(identifier = identifier)
+        await ctx.send(f"**{identifier}** accepts players again.")
+
+    @commands.command()
+    @commands.is_owner()
+    async def profile(self, ctx : commands.Context, seconds : float = 30.0, guild_id : int = None):
+        guild_id = guild_id or ctx.guild.id
+        if profiler.is_sampling():
+            return await ctx.send("A profile is already running.")
+
+        await ctx.send(f"Profiling **{guild_id}** for {seconds:.0f} s...")
+        report = await profiler.profile_guild(guild_id = guild_id, duration = min(seconds, 600.0))
+        # Discord messages are limited to 2000 characters
+        await ctx.send(report[:2000])
+
+    @commands.command()
+    @commands.is_owner()
+    async def slowlog(self, ctx : commands.Context, threshold : float = None):
+        profiler.enabled = not profiler.enabled
+        if threshold is not None:
+            profiler.threshold = threshold
+        await ctx.send(f"Handler tracing {'on' if profiler.enabled else 'off'}, slower than {profiler.threshold:.2f} s is logged.")
+
+    @commands.command(aliases = ['tt'])
+    async def toptracks(self, ctx : commands.Context):
+        tracks = await self.database.get_top_tracks(guild_id = ctx.guild.id)
+        if not tracks:
+            return await ctx.send("Nothing was played yet.")
+
+        lines = [f"{i + 1}. **{track.title}** : {track.plays} plays, {track.skips} skipped" for i, track in enumerate(tracks)]
+        await ctx.send("\n".join(lines))
+
+    @commands.command(aliases = ['tu'])
+    async def topusers(self, ctx : commands.Context):
+        users = await self.database.get_top_users(guild_id = ctx.guild.id)
+        if not users:
+            return await ctx.send("Nothing was played yet.")
+
+        lines = [f"{i + 1}. <@{user.user_id}> : {user.plays} plays, {str(timedelta(milliseconds = user.played_ms)).split('.')[0]} listened" for i, user in enumerate(users)]
+        await ctx.send("\n".join(lines), allowed_mentions = discord.AllowedMentions.none())
 
     @commands.Cog.listener()
     async def on_wavelink_track_end(self, payload):
-        server = await self.__get_server_by_id(server_id = payload.player.guild.id)
+        server = self.__get_server_by_id(server_id = payload.player.guild.id)
+        if server is None:
+            return
         await server.song_ended_notification()
 
     #-------------- Servers -------------------------------------------#
@@ -38,30 +218,61 @@ class MusicCog(commands.Cog):
     async def __get_server(self, ctx : commands.Context) -> MusicServer:
         server_id = str(ctx.guild.id)
         if server_id not in self.servers.keys():
-            self.servers[server_id] = MusicServer()
-            await self.servers[server_id].setup(ctx = ctx)
+            self.servers[server_id] = MusicServer(database = self.database)
+            await self.servers[server_id].setup(guild = ctx.guild)
         return self.servers[server_id]
-    
-    async def __get_server_by_id(self, server_id : int) -> MusicServer:
-        server_id = str(server_id)
-        assert server_id in self.servers.keys()
 
-        return self.servers[server_id]
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready fires again after every gateway reconnect
+        if self.__restored:
+            return
+        self.__restored = True
+
+        semaphore = asyncio.Semaphore(MENU_RESTORE_CONCURRENCY)
+        async def restore(menus : GuildMenus):
+            guild = self.bot.get_guild(menus.guild_id)
+            server_id = str(menus.guild_id)
+            if guild is None or server_id in self.servers:
+                return
+
+            async with semaphore:
+                self.servers[server_id] = MusicServer(database = self.database)
+                try:
+                    await self.servers[server_id].setup(guild = guild, menus = menus)
+                except discord.HTTPException as e:
+                    print(f"[DEBUG] Failed to restore the menus of {guild.name} : {e}")
+                    del self.servers[server_id]
+
+        stored = await self.database.get_guild_menus()
+        await asyncio.gather(*[restore(menus) for menus in stored])
+        print(f"Restored {len(self.servers)}/{len(stored)} servers")
+        self.__menus_restored.set()
+    
+    def __get_server_by_id(self, server_id : int) -> MusicServer:
+        """Returns None for servers that were never set up"""
+        return self.servers.get(str(server_id))
     
     # ---------------------- PROCESSING --------------------------#
     @commands.Cog.listener()
-    async def on_reaction_add(self, reaction : discord.Reaction, user : discord.Member):
-        if user.bot:
+    async def on_interaction(self, interaction : discord.Interaction):
+        if interaction.type is not discord.InteractionType.component or interaction.guild_id is None or interaction.user.bot:
+            return
+        if not get_custom_id(interaction = interaction).startswith("music:"):
             return
-        server = await self.__get_server_by_id(server_id = reaction.message.guild.id)
-        await server.process_reaction(reaction = reaction, user = user)
-        await reaction.remove(user = user)
+        server = self.__get_server_by_id(server_id = interaction.guild_id)
+        if server is None:
+            return
+        await server.process_interaction(interaction = interaction, user = interaction.user)
 
     @commands.Cog.listener()
     async def on_message(self, message : discord.Message):
-        if message.author.bot:
+        # Messages outside music channels only get this far when they look like a command
+        if message.author.bot or message.guild is None or not event_filter.is_music_channel(message.channel.id):
+            return
+        server = self.__get_server_by_id(server_id = message.guild.id)
+        if server is None:
             return
-        server = await self.__get_server_by_id(server_id = message.guild.id)
         await server.process_message(message = message)
 
 
@@ -4,7 +4,53 @@ LAVALINK_HOST = "127.0.0.1" # Lavalink server IP (must be the same as applicatio
 LAVALINK_PORT = 2333 # Lavalink server port (must be the same as application.yml)
 LAVALINK_PASSWORD = 'youshallnotpass' # Lavalink server password (must be the same as application.yml)
 
+# Every Lavalink server the bot can use, players are spread over them by load. Add one entry per extra server.
+LAVALINK_NODES = [
+    {"identifier": "main", "host": LAVALINK_HOST, "port": LAVALINK_PORT, "password": LAVALINK_PASSWORD},
+]
+NODE_STATS_INTERVAL = 30 # Seconds between Lavalink stats checks
+NODE_MAX_CPU_LOAD = 0.9 # Players are moved off a node whose system load reaches this
+NODE_MAX_FRAME_DEFICIT = 0.05 # Players are moved off a node missing this fraction of audio frames
+
 DB_PATH = './database.db' # Name of the Database file
+DB_READER_THREADS = 4 # Threads answering database reads (each has its own connection)
+DB_MAX_WRITE_BATCH = 64 # Max number of queued writes grouped into one transaction
+DB_STATEMENT_CACHE_SIZE = 128 # Prepared statements cached per database connection
+DB_MMAP_SIZE = 256 * 1024 * 1024 # Bytes of the database file memory-mapped by each connection
+DB_CACHE_SIZE_KB = 16 * 1024 # Page cache size of each connection, in KiB
 MAX_NUM_PLAYLISTS = 10 # Max number of playlists for each discord user
+PLAYLIST_RESOLVE_CONCURRENCY = 8 # Max number of parallel Lavalink lookups when a playlist has tracks that are not stored yet
+PLAYLIST_IMPORT_CHUNK = 50 # Songs of a pasted playlist url queued at once, the first ones start playing while the rest are queued in the background
+TRACK_STORE_TTL = 7 * 24 * 3600 # Seconds before a stored Lavalink track is resolved again from youtube
+
+SESSION_IDLE_TIMEOUT = 300 # Seconds before an unused per-user selection session is forgotten (interaction tokens last 900)
+MAX_SESSIONS = 100 # Max number of per-user selection sessions kept for each server, the least recently used goes first
+INTERACTION_ACK_DELAY = 2.0 # Seconds before a slow button or select press is deferred, Discord gives up after 3
+MENU_RESTORE_CONCURRENCY = 8 # Servers whose menus are reattached in parallel at startup
+MENU_HISTORY_LIMIT = 20 # Oldest messages of the music channel searched for the menus before fetching them one by one
+
+SEARCH_CACHE_SIZE = 1024 # Max number of distinct search queries kept in memory (shared by all servers)
+SEARCH_CACHE_TTL = 600 # Seconds a cached search result stays valid
+
+METRICS_HOST = "127.0.0.1" # Interface the Prometheus metrics are served on
+METRICS_PORT = 9101 # Port of the /metrics endpoint, None to disable it
+LOOP_LAG_INTERVAL = 0.5 # Seconds between two event loop lag measurements
+PROFILE_HANDLERS = False # Trace what every menu handler awaits (Lavalink, database, Discord), !profile traces one server on demand
+SLOW_HANDLER_THRESHOLD = 1.0 # Seconds a traced handler may take before it is logged with its breakdown
+PROFILE_SAMPLE_INTERVAL = 0.005 # Seconds between two stack samples of the event loop during !profile
+
+MAX_HISTORY_LENGTH = 100 # Played tracks kept per server for the history view and previous
+JOURNAL_FLUSH_INTERVAL = 2.0 # Seconds between two batched writes of the queue journal
+JOURNAL_COMPACT_EVERY = 500 # Journal entries of a server replaced by a snapshot of its queue
+PLAY_HISTORY_FLUSH_INTERVAL = 10.0 # Seconds between two batched writes of the play history
+PLAY_HISTORY_MAX_BATCH = 500 # Buffered play events that trigger a write without waiting for the interval
+
+LOGGER_COALESCE_WINDOW = 0.5 # Seconds notifications are gathered before the status message is edited
 
-SELECTION_WAIT_TIME = 5
+# Discord REST budgets per route and channel : (calls, per seconds)
+ROUTE_BUDGETS = {
+    "send": (5, 5.0),
+    "edit": (5, 5.0),
+    "delete": (5, 5.0),
+    "reaction": (1, 0.25),
+}